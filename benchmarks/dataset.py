@@ -0,0 +1,161 @@
+import json
+import os
+import random
+import zipfile
+
+import zipfile_zstd # Hotpatch zipfile for zstd-compressed archives
+
+
+COMPRESSIONS = {"stored": zipfile.ZIP_STORED, "deflate": zipfile.ZIP_DEFLATED, "zstd": zipfile.ZIP_ZSTANDARD} # type: ignore
+DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+MANIFEST_FILENAME = "manifest.json"
+
+class DatasetShape:
+    '''
+    Shape of the synthetic content: how many files each layer has, how large they are and how they are packed.
+    '''
+    layers: int
+    archives: int # archives per layer
+    files: int # files per layer
+    mean_size: int
+    distribution: str
+    compression: str
+    compressibility: float # share of every file that is zeros, 0 for incompressible content
+    seed: int
+
+    def __init__(self, layers=1, archives=1, files=1000, mean_size=64 * 1024, distribution="lognormal", compression="deflate", compressibility=0.5, seed=0) -> None:
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError("Unknown size distribution " + distribution)
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression " + compression)
+        self.layers = layers
+        self.archives = archives
+        self.files = files
+        self.mean_size = mean_size
+        self.distribution = distribution
+        self.compression = compression
+        self.compressibility = compressibility
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def file_size(self, rng):
+        if self.distribution == "fixed":
+            return self.mean_size
+        if self.distribution == "uniform":
+            return rng.randint(0, 2 * self.mean_size)
+        # many small files and a few large ones, with the given mean
+        return int(rng.lognormvariate(0, 1) * self.mean_size / 1.6487)
+
+    def file_data(self, rng, size):
+        random_size = int(size * (1 - self.compressibility))
+        return rng.randbytes(random_size) + bytes(size - random_size)
+
+class Dataset:
+    '''
+    Versions of synthetic layers written as archives and manifests into a directory served by the stand-in server.
+    '''
+    shape: DatasetShape
+    root: str
+    base_url: str
+    mirror_urls: list[str] # base URLs of mirrors serving the same directory, listed with every archive
+    version: int
+    contents: dict[str, dict[str, bytes]] # layer -> path -> data of the current version
+    _rng: random.Random
+
+    def __init__(self, shape, root, base_url, mirror_urls=()) -> None:
+        self.shape = shape
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+        self.mirror_urls = [url.rstrip("/") for url in mirror_urls]
+        self.version = 0
+        self.contents = {}
+        self._rng = random.Random(shape.seed)
+
+    @property
+    def manifest_url(self):
+        return f"{self.base_url}/{MANIFEST_FILENAME}"
+
+    @property
+    def total_size(self):
+        return sum(len(data) for files in self.contents.values() for data in files.values())
+
+    def _layer_name(self, index):
+        return "base" if index == 0 else f"layer{index}"
+
+    def generate(self):
+        '''
+        Write the first version of all layers.
+        '''
+        for index in range(self.shape.layers):
+            files = {}
+            for i in range(self.shape.files):
+                path = f"{self._layer_name(index)}/d{i % 32:02}/file{i:06}.bin"
+                files[path] = self.shape.file_data(self._rng, self.shape.file_size(self._rng))
+            self.contents[self._layer_name(index)] = files
+        self._publish(list(self.contents))
+
+    def change(self, fraction=0.1, count=None, layers=None):
+        '''
+        Publish a new version where fraction (or count) of the files of the given layers were rewritten.
+        Returns the number of changed files.
+        '''
+        layers = list(self.contents) if layers is None else layers
+        changed = 0
+        for layer in layers:
+            files = self.contents[layer]
+            n = count if count is not None else max(1, int(len(files) * fraction))
+            for path in self._rng.sample(sorted(files), min(n, len(files))):
+                files[path] = self.shape.file_data(self._rng, self.shape.file_size(self._rng))
+                changed += 1
+        self._publish(layers)
+        return changed
+
+    def _archive_names(self, layer):
+        return [f"{layer}-{i}.zip" for i in range(self.shape.archives)]
+
+    def _write_archives(self, layer):
+        names = self._archive_names(layer)
+        archives = [zipfile.ZipFile(os.path.join(self.root, name + ".tmp"), "w", COMPRESSIONS[self.shape.compression]) for name in names]
+        try:
+            for i, (path, data) in enumerate(sorted(self.contents[layer].items())):
+                archives[i % len(archives)].writestr(path, data)
+        finally:
+            for archive in archives:
+                archive.close()
+        for name in names:
+            os.replace(os.path.join(self.root, name + ".tmp"), os.path.join(self.root, name))
+
+    def _archive_url(self, name):
+        if not self.mirror_urls:
+            return f"{self.base_url}/{name}"
+        return [f"{base}/{name}" for base in [self.base_url, *self.mirror_urls]]
+
+    def _publish(self, changed_layers):
+        self.version += 1
+        for layer in changed_layers:
+            self._write_archives(layer)
+        previous = self._read_manifest()
+        manifest = {
+            "brand": {"name": "Benchmark"},
+            "self": {platform: {"url": f"{self.base_url}/updater", "sha256": "0" * 64} for platform in ("linux", "windows")},
+            "branches": {"public": {"layers": list(self.contents)}},
+            "version": self.version,
+            "layers": {
+                layer: {
+                    "updated": self.version if layer in changed_layers else previous["layers"][layer]["updated"],
+                    "url": [self._archive_url(name) for name in self._archive_names(layer)],
+                } for layer in self.contents
+            },
+        }
+        with open(os.path.join(self.root, MANIFEST_FILENAME + ".tmp"), "w") as f:
+            json.dump(manifest, f)
+        os.replace(os.path.join(self.root, MANIFEST_FILENAME + ".tmp"), os.path.join(self.root, MANIFEST_FILENAME))
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.root, MANIFEST_FILENAME)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"layers": {}}
@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import aiohttp
+
+from cupdater.backend import InstallerBackend
+from cupdater.backend.filedb import UPDATE_DATA_DB_FILENAME
+from cupdater.backend.objstore import OBJECT_STORE_DIRNAME
+from cupdater.frontend.frontend import Frontend, ProgressReportInterface
+
+from .dataset import COMPRESSIONS, DISTRIBUTIONS, Dataset, DatasetShape
+from .server import ServerConditions, start_server
+
+
+logger = logging.getLogger(__name__)
+
+SCENARIOS = ("clean_install", "noop_update", "incremental_update", "selective_download")
+
+class BenchmarkError(Exception):
+    pass
+
+class QuietProgress(ProgressReportInterface):
+    def __enter__(self):
+        return self
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        pass
+    def update(self, count=1):
+        pass
+    def set(self, value):
+        pass
+    def status(self, status):
+        logger.debug(status)
+
+class QuietFrontend(Frontend):
+    '''
+    Frontend without output, so terminal rendering doesn't end up in the measurements. Fatal errors raise BenchmarkError.
+    '''
+    def notify(self, notice):
+        logger.debug(notice)
+    async def ask(self, question):
+        raise BenchmarkError("Asked for input: " + question)
+    def fatal(self, error):
+        raise BenchmarkError(error)
+    def progress(self, title, total=None, unit=None, leave=True):
+        return QuietProgress(title, total)
+    def set_branding(self, branding):
+        pass
+    def pause(self):
+        pass
+
+def _verify(install_dir, dataset):
+    '''
+    Check that the installation holds exactly the files of the current dataset version.
+    '''
+    expected = {path: data for files in dataset.contents.values() for path, data in files.items()}
+    found = set()
+    for root, dirs, files in os.walk(install_dir):
+        if root == install_dir:
+            dirs[:] = [d for d in dirs if d != OBJECT_STORE_DIRNAME]
+            # the database with its WAL and shared memory files
+            files = [f for f in files if not f.startswith(UPDATE_DATA_DB_FILENAME)]
+        found.update(os.path.relpath(os.path.join(root, f), install_dir).replace(os.sep, "/") for f in files)
+    if found != expected.keys():
+        return False
+    for path, data in expected.items():
+        try:
+            with open(os.path.join(install_dir, path), "rb") as f:
+                if zlib.crc32(f.read()) != zlib.crc32(data):
+                    return False
+        except FileNotFoundError:
+            return False
+    return True
+
+async def _server_stats(session, base_url, reset=False):
+    if reset:
+        async with session.post(f"{base_url}/_stats/reset") as response:
+            return await response.json()
+    async with session.get(f"{base_url}/_stats") as response:
+        return await response.json()
+
+async def run_update(install_dir, manifest_url, options):
+    '''
+    Run one update into install_dir like the launcher does. Returns the elapsed seconds.
+    '''
+    cwd = os.getcwd()
+    os.chdir(install_dir)
+    try:
+        start = time.perf_counter()
+        backend = InstallerBackend(QuietFrontend(), **options)
+        try:
+            await backend.load_manifest_from_url(manifest_url)
+            backend.set_branch("public")
+            await backend.update()
+            return time.perf_counter() - start
+        finally:
+            await backend._close_session()
+            backend._db.close()
+    finally:
+        os.chdir(cwd)
+
+async def run_scenario(name, dataset, install_dir, options, session, changed):
+    '''
+    Publish the dataset version the scenario starts from and time the update to it.
+    '''
+    files_changed = 0
+    if name == "clean_install":
+        shutil.rmtree(install_dir, ignore_errors=True)
+        os.makedirs(install_dir)
+    elif name == "incremental_update":
+        files_changed = dataset.change(fraction=changed)
+    elif name == "selective_download":
+        files_changed = dataset.change(count=1)
+    for base_url in [dataset.base_url, *dataset.mirror_urls]:
+        await _server_stats(session, base_url, reset=True)
+    result = {"scenario": name, "seconds": None, "files_changed": files_changed, "error": None}
+    try:
+        result["seconds"] = await run_update(install_dir, dataset.manifest_url, options)
+    except Exception as e:
+        result["error"] = str(e) or type(e).__name__
+    result.update(await _server_stats(session, dataset.base_url))
+    if dataset.mirror_urls:
+        result["mirrors"] = [await _server_stats(session, base_url) for base_url in dataset.mirror_urls]
+    result["verified"] = result["error"] is None and await asyncio.to_thread(_verify, install_dir, dataset)
+    return result
+
+async def run_benchmarks(shape, conditions, options, scenarios, repeat=1, changed=0.1, port=8790, workdir=None, mirrors=()):
+    '''
+    Run the scenarios repeat times, every repetition against freshly generated content and an empty installation.
+    Every ServerConditions in mirrors starts another stand-in server on the following ports, listed as a mirror of every archive.
+    '''
+    if workdir is not None:
+        os.makedirs(workdir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="cupd-bench-", dir=workdir)
+    base_url = f"http://127.0.0.1:{port}"
+    mirror_urls = [f"http://127.0.0.1:{port + 1 + i}" for i in range(len(mirrors))]
+    results = []
+    try:
+        for i in range(repeat):
+            content_dir = os.path.join(workdir, f"content{i}")
+            os.makedirs(content_dir)
+            dataset = Dataset(shape, content_dir, base_url, mirror_urls)
+            dataset.generate()
+            servers = [start_server(content_dir, c, port + i) for i, c in enumerate([conditions, *mirrors])]
+            try:
+                async with aiohttp.ClientSession() as session:
+                    install_dir = os.path.join(workdir, f"install{i}")
+                    # later scenarios start from the installation the previous ones left behind
+                    for name in SCENARIOS:
+                        if name not in scenarios and name != "clean_install":
+                            continue
+                        result = await run_scenario(name, dataset, install_dir, options, session, changed)
+                        result["repeat"] = i
+                        result["install_size"] = dataset.total_size
+                        if name in scenarios:
+                            results.append(result)
+                        logger.info("%s #%i: %s", name, i, "failed: " + result["error"] if result["error"] else "%.3f s" % result["seconds"])
+            finally:
+                for server in servers:
+                    server.terminate()
+                    server.join()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def summarize(results):
+    summary = {}
+    for name in SCENARIOS:
+        seconds = [r["seconds"] for r in results if r["scenario"] == name and r["error"] is None]
+        if seconds:
+            summary[name] = {"runs": len(seconds), "min": min(seconds), "median": statistics.median(seconds), "max": max(seconds)}
+    return summary
+
+def _revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _option(value):
+    key, _, raw = value.partition("=")
+    try:
+        return key, json.loads(raw)
+    except json.JSONDecodeError:
+        return key, raw
+
+def _mirror_conditions(value, args, seed):
+    '''
+    Parse LATENCY[:BANDWIDTH[:FAILURE_RATE]] into the conditions of a mirror server.
+    '''
+    latency, bandwidth, failure_rate = (value.split(":") + ["", ""])[:3]
+    return ServerConditions(latency=float(latency or 0) / 1000, bandwidth=int(bandwidth or 0), failure_rate=float(failure_rate or 0),
+                            ranges=not args.no_ranges, multipart=not args.no_multipart, seed=seed)
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Time updates of synthetic content served by a local stand-in server"
+    )
+    parser.add_argument("--scenarios", help="Comma-separated scenarios to report: " + ", ".join(SCENARIOS), default=",".join(SCENARIOS))
+    parser.add_argument("--repeat", help="Number of times every scenario is run", type=int, default=3)
+    parser.add_argument("--layers", help="Number of layers", type=int, default=1)
+    parser.add_argument("--archives", help="Number of archives per layer", type=int, default=1)
+    parser.add_argument("--files", help="Number of files per layer", type=int, default=1000)
+    parser.add_argument("--mean-size", help="Mean file size in bytes", type=int, default=64 * 1024)
+    parser.add_argument("--distribution", help="File size distribution", choices=DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--compression", help="Compression of archive members", choices=list(COMPRESSIONS), default="deflate")
+    parser.add_argument("--compressibility", help="Share of every file that compresses away", type=float, default=0.5)
+    parser.add_argument("--changed", help="Share of files changed for the incremental update", type=float, default=0.1)
+    parser.add_argument("--seed", help="Seed for content and failure injection", type=int, default=0)
+    parser.add_argument("--latency", help="Server latency per request in milliseconds", type=float, default=0)
+    parser.add_argument("--bandwidth", help="Server bandwidth in bytes per second, 0 for unlimited", type=int, default=0)
+    parser.add_argument("--failure-rate", help="Share of server responses that fail", type=float, default=0)
+    parser.add_argument("--no-ranges", help="Make the server ignore Range requests", action="store_true")
+    parser.add_argument("--no-multipart", help="Make the server return only the first of several requested ranges", action="store_true")
+    parser.add_argument("--mirror", help="Start another server listed as a mirror of every archive, with LATENCY[:BANDWIDTH[:FAILURE_RATE]] in the units above, may be repeated", action="append", default=[])
+    parser.add_argument("-o", "--option", help="InstallerBackend option as KEY=VALUE with a JSON value, may be repeated", action="append", default=[])
+    parser.add_argument("--port", help="Port of the stand-in server", type=int, default=8790)
+    parser.add_argument("--workdir", help="Directory for generated content and installations (default: system temporary directory)", default=None)
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout", default=None)
+    parser.add_argument("-v", "--verbose", help="Enable verbose logging", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    logging.getLogger("cupdater").setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario " + name)
+    shape = DatasetShape(layers=args.layers, archives=args.archives, files=args.files, mean_size=args.mean_size, distribution=args.distribution,
+                         compression=args.compression, compressibility=args.compressibility, seed=args.seed)
+    conditions = ServerConditions(latency=args.latency / 1000, bandwidth=args.bandwidth, failure_rate=args.failure_rate,
+                                  ranges=not args.no_ranges, multipart=not args.no_multipart, seed=args.seed)
+    mirrors = [_mirror_conditions(m, args, args.seed + 1 + i) for i, m in enumerate(args.mirror)]
+    options = dict(_option(o) for o in args.option)
+    started = datetime.datetime.now(datetime.timezone.utc)
+    results = asyncio.run(run_benchmarks(shape, conditions, options, scenarios, repeat=args.repeat, changed=args.changed, port=args.port, workdir=args.workdir, mirrors=mirrors))
+    report = {
+        "started": started.isoformat(),
+        "environment": {
+            "revision": _revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "shape": shape.to_dict(),
+        "conditions": conditions.to_dict(),
+        "mirrors": [m.to_dict() for m in mirrors],
+        "changed": args.changed,
+        "options": options,
+        "results": results,
+        "summary": summarize(results),
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
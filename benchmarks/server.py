@@ -0,0 +1,167 @@
+import asyncio
+import email.utils
+import logging
+import multiprocessing
+import os
+import random
+import time
+
+from aiohttp import web
+
+from cupdater.byteranges import parse_ranges, range_response
+
+
+logger = logging.getLogger(__name__)
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+class ServerConditions:
+    '''
+    Network conditions the stand-in server imposes on every response.
+    '''
+    latency: float # seconds before a response starts
+    bandwidth: int # bytes per second shared by all responses, 0 for unlimited
+    failure_rate: float # share of responses failing with 503 or a cut connection
+    ranges: bool # whether Range requests are honoured
+    multipart: bool # whether several ranges are returned at once, otherwise only the first one is
+    seed: int
+
+    def __init__(self, latency=0.0, bandwidth=0, failure_rate=0.0, ranges=True, multipart=True, seed=0) -> None:
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.ranges = ranges
+        self.multipart = multipart
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(vars(self))
+
+class StandInServer:
+    '''
+    Serves the files of a directory like a static file server or CDN would, with ETags, conditional
+    and range requests, under the given network conditions. Counts requests and transferred bytes.
+    '''
+    root: str
+    conditions: ServerConditions
+    stats: dict
+    _rng: random.Random
+    _next_send: float
+    _cache: dict[str, tuple[tuple[int, int], bytes]]
+
+    def __init__(self, root, conditions) -> None:
+        self.root = root
+        self.conditions = conditions
+        self._rng = random.Random(conditions.seed)
+        self._next_send = 0.0
+        self._cache = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"requests": 0, "range_requests": 0, "bytes_sent": 0, "not_modified": 0, "failures": 0}
+
+    def application(self):
+        app = web.Application()
+        app.router.add_get("/_stats", self._handle_stats)
+        app.router.add_post("/_stats/reset", self._handle_reset)
+        app.router.add_route("*", "/{name:.+}", self._handle_file)
+        return app
+
+    async def _handle_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def _handle_reset(self, request):
+        self.reset_stats()
+        return web.json_response(self.stats)
+
+    def _load(self, name):
+        path = os.path.join(self.root, name)
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.root):
+            return None, None
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None, None
+        key = (st.st_size, st.st_mtime_ns)
+        cached = self._cache.get(name)
+        if cached is None or cached[0] != key:
+            with open(path, "rb") as f:
+                cached = self._cache[name] = (key, f.read())
+        return cached[1], st
+
+    async def _send(self, request, response, data):
+        '''
+        Write the body at the shared bandwidth, cutting the connection halfway if this response should fail.
+        '''
+        cut = len(data) // 2 if response.status < 300 and self._rng.random() < self.conditions.failure_rate / 2 else None
+        for pos in range(0, len(data), STREAM_CHUNK_SIZE):
+            chunk = data[pos:pos + STREAM_CHUNK_SIZE]
+            if cut is not None and pos >= cut:
+                self.stats["failures"] += 1
+                request.transport.close()
+                return response
+            if self.conditions.bandwidth:
+                now = time.monotonic()
+                self._next_send = max(now, self._next_send) + len(chunk) / self.conditions.bandwidth
+                await asyncio.sleep(self._next_send - now)
+            await response.write(chunk)
+            self.stats["bytes_sent"] += len(chunk)
+        await response.write_eof()
+        return response
+
+    async def _handle_file(self, request):
+        self.stats["requests"] += 1
+        if self.conditions.latency:
+            await asyncio.sleep(self.conditions.latency)
+        if self._rng.random() < self.conditions.failure_rate / 2:
+            self.stats["failures"] += 1
+            return web.Response(status=503)
+        data, st = self._load(request.match_info["name"])
+        if data is None:
+            return web.Response(status=404)
+        etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size) # type: ignore
+        headers = {"ETag": etag, "Last-Modified": email.utils.formatdate(st.st_mtime, usegmt=True), "Content-Type": "application/octet-stream"} # type: ignore
+        if self.conditions.ranges:
+            headers["Accept-Ranges"] = "bytes"
+        if request.headers.get("If-None-Match") == etag:
+            self.stats["not_modified"] += 1
+            return web.Response(status=304, headers=headers)
+        ranges = None
+        if self.conditions.ranges and "Range" in request.headers and request.headers.get("If-Range", etag) == etag:
+            self.stats["range_requests"] += 1
+            ranges = parse_ranges(request.headers["Range"], len(data))
+            if ranges is None:
+                return web.Response(status=416, headers={**headers, "Content-Range": f"bytes */{len(data)}"})
+            if not self.conditions.multipart:
+                ranges = ranges[:1]
+        if request.method == "HEAD":
+            return web.Response(headers={**headers, "Content-Length": str(len(data))})
+        status, body_headers, parts, trailer = range_response(ranges, len(data), headers.pop("Content-Type"))
+        headers.update(body_headers)
+        body = b"".join(header + data[start:end + 1] for start, end, header in parts) + trailer
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        return await self._send(request, response, body)
+
+def _serve(root, conditions, port, ready):
+    # cut connections and clients dropping responses they don't need are expected here
+    logging.getLogger("aiohttp.server").setLevel(logging.CRITICAL)
+    async def serve():
+        runner = web.AppRunner(StandInServer(root, conditions).application(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+def start_server(root, conditions, port):
+    '''
+    Run the stand-in server in a separate process, so it doesn't compete with the updater for the event loop or the GIL.
+    '''
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=_serve, args=(root, conditions, port, ready), daemon=True)
+    process.start()
+    if not ready.wait(30):
+        process.terminate()
+        raise RuntimeError("Stand-in server didn't start")
+    return process
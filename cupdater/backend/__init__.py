@@ -1 +1,6 @@
-from .backend import InstallerBackend
\ No newline at end of file
+def __getattr__(name):
+    # the backend pulls in aiohttp, which the launcher only needs once there is something to update
+    if name == "InstallerBackend":
+        from .backend import InstallerBackend
+        return InstallerBackend
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
@@ -1,32 +1,64 @@
-import json
+import collections
+import io
 import logging
 import os, sys
 import traceback
 from zipfile import ZipFile
-import jsonschema
 import asyncio
 import aiohttp
-import hashlib
-import pathlib
+import zipfile_zstd # Hotpatch zipfile for zstd-compressed archives
+import time
 
 from ..frontend import Frontend
-from .filedb import FileDB
-from .remotezip import RemoteZip
+from .filedb import FileDB, cached_sha256sum, crc_files, file_fingerprint, CLEAN_INSTALL_COMPLETE, UPDATE_COMPLETE_BRANCH
+from .fsops import delete_files, prune_empty_dirs
+from . import tracing
+from .zipstream import StreamingNotSupported, StreamState, download_and_extract
+from .extract import extract_members
+from .zipdir import CentralDirectory, read_central_directory, read_local_central_directory
+from .rangefetch import RangedMemberFetcher, RangeNotSupported, DEFAULT_RANGE_GAP
+from .segmented import Download, DEFAULT_SEGMENT_SIZE, DEFAULT_SEGMENT_CONNECTIONS
+from .delta import apply_patch
+from .objstore import ObjectStore, DEFAULT_OBJECT_STORE_LIMIT
+from .mirrors import Mirrors
+from .throttle import Throttle
+from .sources import CacheServerSource, DirectorySource, LocalFileSource, file_url_path
+from .scheduler import ArchiveJob, ResourceLimits, resolve_owners, run_jobs, DEFAULT_NETWORK_JOBS, DEFAULT_DISK_JOBS
 
 from .manifest import MANIFEST_SCHEMA
+from .manifestio import apply_manifest_delta, decode_manifest, delta_url, dump_cached_manifest, load_cached_manifest, \
+    MANIFEST_CACHED_KEY, MANIFEST_URL_META_KEY, MANIFEST_ETAG_META_KEY, MANIFEST_LAST_MODIFIED_META_KEY
 
 
 logger = logging.getLogger(__name__)
 
-def sha256sum(filename):
-    with open(filename, 'rb', buffering=0) as f:
-        return hashlib.file_digest(f, 'sha256').hexdigest()
-
 OLD_UPDATER_FILENAME = ".cupd.old"
+# fetch changed members with range requests only if that transfers less than this share of the archive
+SELECTIVE_DOWNLOAD_MAX_RATIO = 0.5
+# how often the number of downloaded bytes is recorded for resuming after the updater was killed
+DOWNLOAD_JOURNAL_INTERVAL = 8 * 1024 * 1024
+# archives up to this size are downloaded into memory and extracted from there during clean installs
+IN_MEMORY_ARCHIVE_LIMIT = 64 * 1024 * 1024
 
 class InstallerBackend:
     _tcp_connections: int
+    _range_gap: int
+    _range_multipart: bool
+    _range_concurrency: int
+    _cd_cache_ttl: float
+    _index_workers: int | None
+    _stream_extract: bool
+    _extract_workers: int | None
+    _segment_size: int
+    _segment_connections: int
+    _limits: ResourceLimits
+    _store: ObjectStore | None
     _session: aiohttp.ClientSession
+    _mirrors: Mirrors
+    _throttle: Throttle
+    _sources: dict[str, list[str]] # archive URL -> URLs of all its mirrors, the archive URL first
+    _content_sources: list # ContentSources checked before the mirrors
+    _fetch_urls: dict[str, list[str]] # archive URL -> URLs of content sources serving it
 
     _frontend: Frontend
     _db: FileDB
@@ -36,18 +68,62 @@ class InstallerBackend:
     _selected_branch: str
     _selected_branch_data: dict
     
-    _deletable_files: list[str]
+    _deletable_files: set[str]
+    _tracked: dict[str, tuple[int | None, str]] # path -> (crc, layer), crc is None for removed files
 
-    def __init__(self, frontend, tcp_connections=50, timeout=None) -> None:
+    def __init__(
+        self,
+        frontend,
+        tcp_connections=50,
+        timeout=None,
+        range_gap=DEFAULT_RANGE_GAP,
+        range_multipart=True,
+        range_concurrency=8,
+        cd_cache_ttl=0,
+        index_workers=None,
+        stream_extract=True,
+        extract_workers=None,
+        segment_size=DEFAULT_SEGMENT_SIZE,
+        segment_connections=DEFAULT_SEGMENT_CONNECTIONS,
+        network_jobs=DEFAULT_NETWORK_JOBS,
+        cpu_jobs=None,
+        disk_jobs=DEFAULT_DISK_JOBS,
+        object_store=False,
+        object_store_link="auto",
+        object_store_limit=DEFAULT_OBJECT_STORE_LIMIT,
+        hedge_delay=None,
+        adaptive_connections=True,
+        bandwidth_limit=0,
+        sources=None,
+        cache_server=None,
+    ) -> None:
         self._frontend = frontend
         self._tcp_connections = tcp_connections
+        self._range_gap = range_gap
+        self._range_multipart = range_multipart
+        self._range_concurrency = range_concurrency
+        self._cd_cache_ttl = cd_cache_ttl
+        self._index_workers = index_workers
+        self._stream_extract = stream_extract
+        self._extract_workers = extract_workers
+        self._segment_size = segment_size
+        self._segment_connections = segment_connections
+        self._limits = ResourceLimits(network_jobs, cpu_jobs if cpu_jobs else (os.cpu_count() or 1), disk_jobs)
         self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._tcp_connections), timeout=aiohttp.ClientTimeout(total=timeout))
+        self._mirrors = Mirrors(self._session, hedge_delay=hedge_delay)
+        # archive requests start with a few connections and grow up to tcp_connections while throughput does
+        self._throttle = Throttle(tcp_connections if adaptive_connections else None, bandwidth_limit)
+        self._sources = {}
+        self._content_sources = [LocalFileSource(), *(DirectorySource(d) for d in sources or ()), *([CacheServerSource(cache_server)] if cache_server else [])]
+        self._fetch_urls = {}
         self._selected_branch = ""
         self._selected_branch_data = {}
         self._db = FileDB()
+        self._store = ObjectStore(self._db, link=object_store_link, limit=object_store_limit, workers=index_workers) if object_store else None
         self._manifest = None
         self._unchanged = False
-        self._deletable_files = []
+        self._deletable_files = set()
+        self._tracked = {}
         if os.path.exists(OLD_UPDATER_FILENAME): os.unlink(OLD_UPDATER_FILENAME)
 
     def __del__(self):
@@ -62,186 +138,615 @@ class InstallerBackend:
         if not self._session.closed:
             await self._session.close()
 
-    def _unzip(self, filename, layer):
-        logger.info("Extracting %s from layer %s", filename, layer)
-        with ZipFile(filename) as zf:
-            justfiles = [f for f in zf.filelist if not f.is_dir()]
-            with self._frontend.progress(f"Extracting {filename}", total=len(justfiles), unit="file", leave=False) as p:
-                for f in justfiles:
-                    p.update()
-                    zf.extract(f)
-                self._db.track_files([(f.filename, f.CRC, os.path.getmtime(f.filename), layer) for f in justfiles])
-        logger.debug("Removing source archive %s", filename)
-        os.unlink(filename)
+    def _unzip(self, source, filename, names=None):
+        '''
+        Extract all files (or only the given names) of a local archive, a path or the archive bytes, in parallel.
+        '''
+        with ZipFile(io.BytesIO(source) if isinstance(source, bytes) else source) as zf:
+            justfiles = [f for f in zf.filelist if not f.is_dir() and (names is None or f.filename in names)]
+        with self._frontend.progress(f"Extracting {filename}", total=len(justfiles), unit="file", leave=False) as p, \
+                tracing.span("extract", "cpu", files=len(justfiles), bytes=sum(f.file_size for f in justfiles)):
+            extract_members(source, justfiles, workers=self._extract_workers, progress=p)
+        return justfiles
+
+    def _known_files(self, filenames):
+        self._deletable_files.difference_update(filenames)
+
+    def _mirror_urls(self, url):
+        return self._sources.get(url, [url])
+
+    def _archive_urls(self, layer_data):
+        '''
+        The archive URLs of a layer. A mirror set is known by its first URL, the others are remembered as its mirrors.
+        '''
+        urls = []
+        for entry in layer_data["url"]:
+            if isinstance(entry, list):
+                self._sources[entry[0]] = entry
+                entry = entry[0]
+            urls.append(entry)
+        return urls
+
+    def _candidates(self, url):
+        '''
+        URLs to fetch an archive from: content sources serving it unless they failed, then its mirrors from best to worst.
+        '''
+        sources = [u for u in self._fetch_urls.get(url, ()) if self._mirrors.host(u).failures == 0]
+        return sources + self._mirrors.order(self._mirror_urls(url))
+
+    def _plan_sources(self, jobs):
+        for job in jobs:
+            self._fetch_urls[job.url] = [u for source in self._content_sources if (u := source.fetch_url(job.url, job.directory)) is not None]
+
+    async def _local_copy(self, job):
+        '''
+        Path of a local copy of the archive of a job that matches its central directory, None if there is none.
+        '''
+        for url in self._mirror_urls(job.url):
+            for source in self._content_sources:
+                path = source.local_path(url)
+                if path is None or not os.path.isfile(path):
+                    continue
+                if path == file_url_path(url):
+                    return path # the archive itself, not a copy
+                if job.directory is None:
+                    continue
+                try:
+                    if (await read_local_central_directory(path, url)).same_archive(job.directory):
+                        return path
+                except (OSError, ValueError) as e:
+                    logger.debug("Can't read %s: %s", path, str(e))
+                    continue
+                logger.debug("%s is a different version of %s", path, url)
+        return None
+
+    async def _extract_local_copy(self, job, path, names):
+        filename = job.url.rpartition("/")[-1]
+        logger.info("Extracting %s from %s", filename, path)
+        async with self._limits.use("cpu", "disk"):
+            return await asyncio.to_thread(self._unzip, path, filename, names)
+
+    async def _probe_mirrors(self, jobs):
+        mirrored = [u for job in jobs if len(self._mirror_urls(job.url)) > 1 for u in self._mirror_urls(job.url) if file_url_path(u) is None]
+        if mirrored:
+            await self._mirrors.probe(mirrored)
+
+    async def _resume_offset(self, url, mirror, filename):
+        '''
+        Returns (offset, validator) to continue a partial download of url from mirror into filename, or (0, None).
+        Data downloaded from another mirror of url has no validator for this mirror.
+        '''
+        journal = await asyncio.to_thread(self._db.get_download, filename)
+        if journal is None or journal[4] or journal[1] not in self._mirror_urls(url) + self._fetch_urls.get(url, []) or journal[2] is None or not os.path.exists(filename):
+            return 0, None
+        return min(os.path.getsize(filename), journal[3]), journal[2] if journal[1] == mirror else None
 
-    def _known_file(self, filename):
+    def _download(self, url, offset=0, validator=None, size=None):
+        return Download(self._session, url, offset, validator, self._segment_size, self._segment_connections, size=size, throttle=self._throttle)
+
+    async def _download_file(self, url, filename, title=None, size=None):
+        mirror = self._candidates(url)[0]
+        offset, validator = await self._resume_offset(url, mirror, filename)
         try:
-            self._deletable_files.remove(filename)
-        except ValueError: pass # new file
-
-    async def _download_file(self, url, filename, title=None):
-        async with self._session.get(url) as response:
-            size = int(response.headers.get("content-length", 0)) or None
-            with self._frontend.progress(title if title else f"Downloading {filename}", \
-                                         total=((size // 1024) if size else None), unit="KiB", leave=False) as p:
-                with open(filename, mode="wb") as f, p:
-                    async for chunk in response.content.iter_chunked(65536):
+            async with self._limits.use("network", "disk"), self._download(mirror, offset, validator, size) as download:
+                await self._write_download(download, mirror, filename, offset, title)
+        except aiohttp.ClientResponseError as e:
+            if e.status == 416:
+                # the partial file can't be continued, start over
+                self._db.delete_download(filename)
+            self._mirrors.failed(mirror)
+            raise
+        except Exception:
+            self._mirrors.failed(mirror)
+            raise
+        self._db.delete_download(filename)
+
+    async def _write_download(self, download, url, filename, offset, title=None):
+        if offset > 0 and download.offset != offset:
+            logger.debug("Server didn't resume %s at byte %i, downloading it from the start", filename, offset)
+        elif offset > 0:
+            logger.info("Resuming download of %s at %i KiB", filename, offset // 1024)
+        offset, validator, size = download.offset, download.validator, download.size
+        if validator is not None:
+            self._db.set_download(filename, url, validator, offset)
+        else:
+            self._db.delete_download(filename)
+        with self._frontend.progress(title if title else f"Downloading {filename}", \
+                                     total=size, unit="B", leave=False) as p:
+            with open(filename, mode="r+b" if offset > 0 else "wb") as f, p:
+                f.seek(offset)
+                f.truncate()
+                if size is not None and hasattr(os, "posix_fallocate"):
+                    try:
+                        os.posix_fallocate(f.fileno(), offset, size - offset)
+                    except OSError:
+                        pass # not supported by the file system, just write
+                p.update(offset)
+                written, journaled = offset, offset
+                try:
+                    async for chunk in download.iter_chunks():
                         f.write(chunk)
-                        p.update(len(chunk) // 1024)
+                        written += len(chunk)
+                        tracing.current().add("bytes", len(chunk))
+                        p.update(len(chunk))
+                        if validator is not None and written - journaled >= DOWNLOAD_JOURNAL_INTERVAL:
+                            f.flush()
+                            self._db.set_download_written(filename, written)
+                            journaled = written
+                finally:
+                    if validator is not None:
+                        f.flush()
+                        self._db.set_download_written(filename, written)
+        if size is not None and written != size:
+            raise aiohttp.ClientPayloadError("Download of %s ended after %i of %i bytes" % (filename, written, size))
 
-    async def _download_file_with_retries(self, url, filename, title=None, retries=5):
+    @tracing.traced("download", "network")
+    async def _download_file_with_retries(self, url, filename, title=None, retries=5, size=None):
         ee = None
         for r in range(retries, 0, -1):
             try:
-                return await self._download_file(url, filename, title)
+                return await self._download_file(url, filename, title, size)
             except Exception as e:
                 ee = e
+                tracing.current().add("retries")
                 if logger.level == logging.DEBUG: traceback.print_exc()
                 logger.warning("Failed to download URL %s: %s. %i retries left.", url, str(e), r-1)
-                os.unlink(filename)
+                if await asyncio.to_thread(self._db.get_download, filename) is None and os.path.exists(filename):
+                    os.unlink(filename) # nothing to resume from
         await self._frontend.fatal("Failed to download file %s after %i retries. Last error was: %s. " \
                                     "Please try again later or contact support." % 
                                    (url, retries, str(ee)))
 
-    async def _download_and_unzip(self, url, layer):
+    async def _stream_journal(self, url, filename):
+        '''
+        Returns (StreamState, validator, mirror) of a streamed extraction of url that an earlier run didn't finish.
+        '''
+        journal = await asyncio.to_thread(self._db.get_download, filename)
+        if journal is None or not journal[4]:
+            return StreamState(), None, None
+        if journal[1] not in self._mirror_urls(url) + self._fetch_urls.get(url, []):
+            self._db.delete_download(filename)
+            return StreamState(), None, None
+        return StreamState(journal[3], await asyncio.to_thread(self._db.get_extracted, filename)), journal[2], journal[1]
+
+    async def _journal_stream(self, chunks, filename, mirror, validator, state):
+        '''
+        Pass the chunks on, recording the offset of the first member that wasn't extracted yet and the members
+        extracted before it every DOWNLOAD_JOURNAL_INTERVAL bytes, so the next run continues there.
+        '''
+        journaled, received = len(state.completed), 0
+        self._db.set_download(filename, mirror, validator, state.offset, streamed=True)
+        async for chunk in chunks:
+            yield chunk
+            received += len(chunk)
+            if received >= DOWNLOAD_JOURNAL_INTERVAL:
+                # the members before the offset are complete once it is read
+                offset, completed = state.offset, len(state.completed)
+                self._db.add_extracted(filename, state.completed[journaled:completed])
+                self._db.set_download_written(filename, offset)
+                journaled, received = completed, 0
+
+    @tracing.traced("download and extract", "network")
+    async def _download_and_unzip_streaming(self, url, filename, names=None, retries=5, size=None):
+        '''
+        Extract the archive (or only the given names) while downloading it, or from memory if it is small.
+        Returns the extracted members, or None if the archive has to be downloaded to disk first.
+        After a failure, also in a later run, the download continues from the best remaining mirror
+        at the first member that wasn't extracted.
+        '''
+        ee = None
+        state, validator, mirror = await self._stream_journal(url, filename)
+        data = None
+        for r in range(retries, 0, -1):
+            previous, mirror = mirror, self._candidates(url)[0]
+            if mirror != previous:
+                validator = None # the size of the archive tells whether the new mirror serves the same one
+            try:
+                async with self._limits.use("network"), self._download(mirror, state.offset, validator, size) as download:
+                    if download.offset != state.offset:
+                        state = StreamState()
+                        self._db.delete_download(filename)
+                    elif state.offset > 0:
+                        logger.info("Resuming download of %s at %i KiB", filename, state.offset // 1024)
+                    validator, size = download.validator, download.size
+                    with self._frontend.progress(f"Downloading {filename}", \
+                                                 total=size, unit="B", leave=False) as p:
+                        p.update(state.offset)
+                        if size is not None and size <= IN_MEMORY_ARCHIVE_LIMIT and state.offset == 0:
+                            data = io.BytesIO()
+                            async for chunk in download.iter_chunks():
+                                data.write(chunk)
+                                tracing.current().add("bytes", len(chunk))
+                                p.update(len(chunk))
+                            break
+                        chunks = download.iter_chunks()
+                        if validator is not None or size is not None:
+                            chunks = self._journal_stream(chunks, filename, mirror, validator, state)
+                        async with self._limits.use("cpu", "disk"):
+                            members = await download_and_extract(chunks, p, state, names)
+                        self._db.delete_download(filename)
+                        return members
+            except StreamingNotSupported as e:
+                logger.debug("Can't extract %s while downloading it: %s", filename, str(e))
+                return None
+            except Exception as e:
+                ee = e
+                self._mirrors.failed(mirror)
+                tracing.current().add("retries")
+                if logger.level == logging.DEBUG: traceback.print_exc()
+                logger.warning("Failed to download URL %s: %s. %i retries left.", mirror, str(e), r-1)
+        else:
+            await self._frontend.fatal("Failed to download file %s after %i retries. Last error was: %s. " \
+                                        "Please try again later or contact support." % 
+                                       (url, retries, str(ee)))
+        async with self._limits.use("cpu", "disk"):
+            return await asyncio.to_thread(self._unzip, data.getvalue(), filename, names) # type: ignore
+
+    async def _download_and_unzip(self, job):
+        url, layer = job.url, job.layer
         logger.debug("Downloading layer content archive %s fully since this is a clean install", url)
         filename = url.rpartition("/")[-1]
-        logger.info("Downloading %s", filename)
-        await self._download_file_with_retries(url, filename)
-        await asyncio.to_thread(self._unzip, filename, layer)
+        names = {f.filename for f in job.changed} if job.changed is not None else None
+        size = job.directory.size if job.directory is not None else None # type: ignore
+        if names is not None and len(names) == 0:
+            logger.debug("Nothing to download from %s, its files are overridden by later layers or available locally", filename)
+        elif (local := await self._local_copy(job)) is not None:
+            members = await self._extract_local_copy(job, local, names)
+            self._track_members(layer, [f for f in members if not f.is_dir() and (names is None or f.filename in names)])
+        else:
+            logger.info("Downloading %s", filename)
+            members = await self._download_and_unzip_streaming(url, filename, names, size=size) if self._stream_extract else None
+            if members is None:
+                await self._download_file_with_retries(url, filename, size=size)
+                logger.info("Extracting %s from layer %s", filename, layer)
+                async with self._limits.use("cpu", "disk"):
+                    members = await asyncio.to_thread(self._unzip, filename, filename, names)
+                logger.debug("Removing source archive %s", filename)
+                os.unlink(filename)
+            self._track_members(layer, [f for f in members if not f.is_dir() and (names is None or f.filename in names)])
+        await self._restore_members(job)
 
-    async def _selective_check(self, url, retries=5):
-        logger.debug("Checking layer content archive %s for new or modified files", url)
-        filename = url.rpartition("/")[-1]
+    def _track_members(self, layer, members):
+        with tracing.span("track files", "disk", files=len(members)):
+            self._db.track_files([(f.filename, f.CRC, layer, *file_fingerprint(f.filename)) for f in members])
+        self._tracked.update((f.filename, (f.CRC, layer)) for f in members)
+
+    async def _restore_members(self, job):
+        '''
+        Restore the members of a job that are available locally, downloading those whose source doesn't match.
+        '''
+        if not job.restored:
+            return
+        # sources written during this update have to be complete first
+        await asyncio.gather(*{source_job.task for _, _, source_job in job.restored if source_job is not None and source_job is not job})
+        filename = job.url.rpartition("/")[-1]
+        logger.info("Restoring %i files of %s from local copies", len(job.restored), filename)
+        async with self._limits.use("disk"), tracing.span("restore", "disk", files=len(job.restored)):
+            failed = set(await self._store.restore((source, f.filename, f.CRC, f.file_size) for f, source, _ in job.restored)) # type: ignore
+        self._track_members(job.layer, [f for f, _, _ in job.restored if f.filename not in failed])
+        missing = [f for f, _, _ in job.restored if f.filename in failed]
+        if missing:
+            logger.debug("%i files of %s couldn't be restored locally, downloading them", len(missing), filename)
+            await self._fetch_members(job, missing)
+
+    def _read_central_directory(self, url, cached):
+        path = file_url_path(url)
+        if path is not None:
+            return read_local_central_directory(path, url)
+        return read_central_directory(self._session, url, cached=cached)
+
+    async def _load_central_directory(self, url, updated, trusted=False):
+        row = await asyncio.to_thread(self._db.get_archive, url)
+        cached = CentralDirectory.from_row(row) if row else None
+        # the directory of a checkpointed archive was read for the current layer version, no need to check it again
+        if cached is not None and cached.checked >= updated and (trusted or time.time() - cached.checked < self._cd_cache_ttl):
+            logger.debug("Using central directory of %s cached at %s", url, time.ctime(cached.checked))
+            return cached
+        async with self._limits.use("network"):
+            directory = await self._mirrors.hedged(self._mirror_urls(url), lambda mirror: self._read_central_directory(mirror, cached))
+        directory.url = url
+        if directory is cached:
+            self._db.set_archive_checked(url, directory.checked)
+        else:
+            self._db.set_archive(directory.to_row())
+        return directory
+
+    def _diff_members(self, members):
+        '''
+        Split archive members into new and modified files using the in-memory snapshot of tracked files.
+        '''
+        tracked = self._tracked
+        new = []
+        overwrite = []
+        for f in members:
+            file_info = tracked.get(f.filename)
+            if file_info is None:
+                if not f.is_dir():
+                    # new file, add to tracking list
+                    new.append(f)
+            elif f.CRC != file_info[0]:
+                # overwrite updated or removed file
+                overwrite.append(f)
+        return new, overwrite
+
+    @tracing.traced("check archive", "network")
+    async def _check_archive(self, job, clean_install, retries=5):
+        '''
+        Load the central directory of the archive of a job.
+        On clean installs the archive is downloaded anyway, so a failure only means its members are unknown.
+        '''
+        logger.debug("Checking layer content archive %s for new or modified files", job.url)
+        filename = job.url.rpartition("/")[-1]
         logger.debug("Loading archive %s", filename)
+        updated = self._manifest["layers"][job.layer]["updated"] # type: ignore
         ee = None
-        for r in range(retries, 0, -1):
+        for r in range(retries if not clean_install else 1, 0, -1):
             try:
-                with RemoteZip(url, proxies={"http": "", "https": ""}, support_suffix_range=False, allow_redirects=True) as zf:
-                    new = []
-                    overwrite = []
-                    for f in zf.filelist:
-                        if not f.is_dir():
-                            file_info = self._db.get_file(f.filename)
-                            if not file_info:
-                                # new file, add to tracking list
-                                new.append(f)
-                                continue
-                            _, dcrc, _, _ = file_info
-                            if f.CRC != dcrc:
-                                # overwrite updated file
-                                overwrite.append(f)
-                                continue
-                    return zf.filelist.copy(), new, overwrite
+                job.directory = await self._load_central_directory(job.url, updated, trusted=job.checkpointed)
+                self._known_files(f.filename for f in job.directory.members)
+                return
+            except RangeNotSupported as e:
+                # asking again won't help, the whole archive has to be downloaded anyway
+                if not clean_install:
+                    job.directory = await self._download_central_directory(job, e.headers)
+                    self._known_files(f.filename for f in job.directory.members)
+                return
             except Exception as e:
                 ee = e
+                tracing.current().add("retries")
                 if logger.level == logging.DEBUG: traceback.print_exc()
                 logger.debug("Failed to load file information of archive %s: %s. %i retries left.", filename, str(e), r-1)
-        await self._frontend.fatal("Failed to load file information of archive %s after %i retries. Last error was: %s. " \
-                                "Please try again later or contact support." % 
-                            (filename, retries, str(ee)))
-        return [], [], []
+        if not clean_install:
+            await self._frontend.fatal("Failed to load file information of archive %s after %i retries. Last error was: %s. " \
+                                    "Please try again later or contact support." % 
+                                (filename, retries, str(ee)))
 
-    async def _download_and_unzip_selective(self, url, layer):
-        logger.debug("Downloading layer content archive %s and extracting updated files", url)
-        filename = url.rpartition("/")[-1]
-        total, new, overwrite = await self._selective_check(url)
-        for f in total: self._known_file(f.filename)
-        if (len(new) + len(overwrite)) == 0:
-            logger.debug("Archive %s is unchanged", filename)
+    async def _download_central_directory(self, job, headers):
+        '''
+        Read the central directory of an archive whose server ignores range requests from a full download.
+        The job's changed members are extracted from the download later.
+        '''
+        filename = job.url.rpartition("/")[-1]
+        logger.info("The server of %s doesn't support range requests, downloading the whole archive", filename)
+        await self._download_file_with_retries(job.url, filename)
+        directory = await read_local_central_directory(filename, job.url)
+        directory.etag, directory.last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        self._db.set_archive(directory.to_row())
+        job.archive = filename
+        return directory
+
+    def _discard_archive(self, job):
+        if job.archive is not None:
+            logger.debug("Removing source archive %s", job.archive)
+            os.unlink(job.archive)
+            job.archive = None
+
+    def _plan_changes(self, job, clean_install):
+        if job.directory is None:
             return
-        logger.info("Downloading %s", filename)
-        await self._download_file_with_retries(url, filename)
-        logger.info("Extracting %s", filename)
-        with ZipFile(filename) as zf:
-            to_extract = (new + overwrite)
-            with self._frontend.progress(f"Extracting {filename}", total=len(to_extract), unit="file", leave=False) as p:
-                for f in to_extract:
-                    p.update()
-                    self._known_file(f.filename)
-                    if not os.path.islink(f.filename):
-                        zf.extract(f)
-            self._db.track_files([(f.filename, f.CRC, os.path.getmtime(f.filename), layer) for f in new])
-            self._db.update_tracked_files([(f.CRC, os.path.getmtime(f.filename), layer, f.filename) for f in overwrite])
-        logger.debug("Removing source archive %s", filename)
-        os.unlink(filename)
-
-    ''' wip (currently very slow) '''
-    async def _selective_download(self, url, layer, retries_for_archive=5, retries_per_file=15):
-        logger.debug("Downloading layer content archive %s selectively", url)
+        members = [f for f in job.directory.members if job.owns(f.filename)]
+        if clean_install and not job.checkpointed:
+            job.changed = [f for f in members if not f.is_dir()]
+        else:
+            new, overwrite = self._diff_members(members)
+            job.changed = new + overwrite
+
+    def _resume_clean_install(self, jobs):
+        '''
+        Keep tracking the files of archives an interrupted clean install completed, forget all others.
+        '''
+        kept = {f.filename for job in jobs if job.checkpointed for f in job.directory.members if not f.is_dir() and job.owns(f.filename)} # type: ignore
+        stale = [path for path in self._tracked if path not in kept]
+        self._db.delete_tracked_files([(path,) for path in stale])
+        for path in stale: del self._tracked[path]
+        logger.info("Resuming interrupted installation, %i of %i archives are complete", sum(job.checkpointed for job in jobs), len(jobs))
+
+    def _plan_restores(self, jobs, contents):
+        '''
+        Find changed members whose contents are already available locally: in an installed file that stays,
+        in the object store, or in a file written by an earlier job of this update. Each content is downloaded once.
+        '''
+        rewritten = {f.filename for job in jobs if job.changed for f in job.changed}
+        claimed = {}
+        for job in jobs:
+            if not job.changed:
+                continue
+            download = []
+            for f in job.changed:
+                key = (f.CRC, f.file_size)
+                source = contents.get(key)
+                if f.file_size == 0:
+                    download.append(f)
+                elif source is not None and source not in rewritten:
+                    job.restored.append((f, source, None))
+                elif (source := self._store.get(*key)) is not None: # type: ignore
+                    job.restored.append((f, source, None))
+                elif key in claimed:
+                    job.restored.append((f, claimed[key][1], claimed[key][0]))
+                else:
+                    claimed[key] = (job, f.filename)
+                    download.append(f)
+            job.changed = download
+        restored = sum(len(job.restored) for job in jobs)
+        if restored > 0:
+            logger.debug("%i changed files are available locally", restored)
+
+    async def _download_and_unzip_selective(self, job):
+        logger.debug("Downloading layer content archive %s and extracting updated files", job.url)
+        filename = job.url.rpartition("/")[-1]
+        if job.changed:
+            changed = await self._apply_patches(job, job.changed)
+            if changed:
+                await self._fetch_members(job, changed)
+        elif not job.restored:
+            logger.debug("Archive %s is unchanged", filename)
+        await self._restore_members(job)
+
+    async def _patch_file(self, member, patch):
+        try:
+            async with self._limits.use("network"), tracing.span("download patch", "network") as s:
+                async with self._session.get(patch["url"]) as response:
+                    response.raise_for_status()
+                    data = await response.read()
+                s.add("bytes", len(data))
+            async with self._limits.use("cpu", "disk"), tracing.span("apply patch", "cpu", files=1):
+                patched = await asyncio.to_thread(apply_patch, member.filename, data, member.CRC, member.file_size, patch.get("format", "zstd"))
+        except Exception as e:
+            if logger.level == logging.DEBUG: traceback.print_exc()
+            logger.warning("Failed to apply patch %s to %s: %s", patch["url"], member.filename, str(e))
+            return False
+        if not patched:
+            logger.warning("Patch %s didn't produce the expected version of %s", patch["url"], member.filename)
+        return patched
+
+    async def _apply_patches(self, job, changed):
+        '''
+        Update installed files for which the layer has a delta patch from their current version.
+        Returns the members that still have to be downloaded.
+        '''
+        patches = {(p["path"], p["from"], p["to"]): p for p in self._manifest["layers"][job.layer].get("patches", ())} # type: ignore
+        if len(patches) == 0:
+            return changed
+        candidates = []
+        for f in changed:
+            current = self._tracked.get(f.filename)
+            patch = patches.get((f.filename, current[0], f.CRC)) if current is not None else None
+            if patch is not None and not os.path.islink(f.filename):
+                candidates.append((f, patch))
+        if len(candidates) == 0:
+            return changed
+        logger.info("Patching %i files from %s", len(candidates), job.url.rpartition("/")[-1])
+        results = await asyncio.gather(*(self._patch_file(f, patch) for f, patch in candidates))
+        patched = {f.filename for (f, _), ok in zip(candidates, results) if ok}
+        self._track_members(job.layer, [f for f in changed if f.filename in patched])
+        return [f for f in changed if f.filename not in patched]
+
+    async def _fetch_members(self, job, changed):
+        url = job.url
         filename = url.rpartition("/")[-1]
-        logger.debug("Loading archive %s", filename)
-        eea = None
-        for ra in range(retries_for_archive, 0, -1):
+        if (local := job.archive or await self._local_copy(job)) is not None:
+            await self._extract_local_copy(job, local, {f.filename for f in changed if not os.path.islink(f.filename)})
+        elif not await self._selective_download(url, job.directory, changed):
+            logger.info("Downloading %s", filename)
+            await self._download_file_with_retries(url, filename, size=job.directory.size) # type: ignore
+            logger.info("Extracting %s", filename)
+            names = {f.filename for f in changed if not os.path.islink(f.filename)}
+            async with self._limits.use("cpu", "disk"):
+                await asyncio.to_thread(self._unzip, filename, filename, names)
+            logger.debug("Removing source archive %s", filename)
+            os.unlink(filename)
+        self._track_members(job.layer, changed)
+
+    async def _selective_download(self, url, directory, changed):
+        '''
+        Fetch only the changed members with coalesced range requests.
+        Returns False if the whole archive should be downloaded instead.
+        '''
+        filename = url.rpartition("/")[-1]
+        fetcher = RangedMemberFetcher(self._session, url, gap=self._range_gap, multipart=self._range_multipart, concurrency=self._range_concurrency)
+        spans = fetcher.plan(directory.members, [f for f in changed if not os.path.islink(f.filename)], directory.cd_offset)
+        size = sum(len(s) for s in spans)
+        if size > directory.size * SELECTIVE_DOWNLOAD_MAX_RATIO:
+            logger.debug("Changed members of %s span %i of %i bytes, downloading the whole archive", filename, size, directory.size)
+            return False
+        logger.info("Downloading %i changed files from %s", len(changed), filename)
+        logger.debug("Fetching %i bytes in %i ranges from %s", size, len(spans), filename)
+        ee = None
+        for mirror in self._candidates(url):
+            fetcher = RangedMemberFetcher(self._session, mirror, gap=self._range_gap, multipart=self._range_multipart, concurrency=self._range_concurrency, throttle=self._throttle)
             try:
-                with RemoteZip(url, proxies={"http": "", "https": ""}, support_suffix_range=False, allow_redirects=True) as zf:
-                    new = []
-                    overwrite = []
-                    for f in zf.filelist:
-                        if not f.is_dir():
-                            file_info = self._db.get_file(f.filename)
-                            if not file_info:
-                                # new file, add to tracking list
-                                new.append(f)
-                                continue
-                            self._known_file(f.filename)
-                            _, dcrc, _, _ = file_info
-                            if f.CRC != dcrc:
-                                # overwrite updated file
-                                overwrite.append(f)
-                                continue
-                    to_download = (new + overwrite)
-                    with self._frontend.progress(f"Downloading {filename}", total=len(to_download), unit="file", leave=False) as p:
-                        for f in to_download:
-                            p.update()
-                            eef = None
-                            for rf in range(retries_per_file, 0, -1):
-                                try:
-                                    zf.extract(f)
-                                    break
-                                except Exception as e:
-                                    eef = e
-                                    if rf == 0:
-                                        await self._frontend.fatal("Failed to selectively download file %s after %i retries. Last error was: %s. " \
-                                                                    "Please try again later or contact support." % 
-                                                                (url, retries_per_file, str(eef)))
-                                    if logger.level == logging.DEBUG: traceback.print_exc()
-                                    logger.debug("Failed to selectively download file %s: %s. %i retries left.", f.filename, str(e), rf-1)
-                    self._db.track_files([(f.filename, f.CRC, os.path.getmtime(f.filename), layer) for f in new])
-                    self._db.update_tracked_files([(f.CRC, os.path.getmtime(f.filename), layer, f.filename) for f in overwrite])
-                return
+                async with self._limits.use("network", "disk"):
+                    with self._frontend.progress(f"Downloading {filename}", total=size, unit="B", leave=False) as p, \
+                            tracing.span("fetch ranges", "network", files=len(changed), ranges=len(spans)):
+                        await fetcher.fetch(spans, p)
+                return True
+            except RangeNotSupported as e:
+                ee = e
+                logger.debug("%s doesn't support range requests", mirror)
             except Exception as e:
-                eea = e
+                ee = e
+                self._mirrors.failed(mirror)
                 if logger.level == logging.DEBUG: traceback.print_exc()
-                logger.debug("Failed to load file information of archive %s: %s. %i retries left.", filename, str(e), ra-1)
-        await self._frontend.fatal("Failed to load file information of archive %s after %i retries. Last error was: %s. " \
-                                "Please try again later or contact support." % 
-                            (filename, retries_for_archive, str(eea)))
+                logger.warning("Failed to selectively download %s: %s", mirror, str(e))
+        if isinstance(ee, RangeNotSupported):
+            logger.debug("Server doesn't support range requests for %s, downloading the whole archive", filename)
+            return False
+        await self._frontend.fatal("Failed to selectively download archive %s. Last error was: %s. " \
+                                    "Please try again later or contact support." % 
+                                   (url, str(ee)))
+        return True
 
+    async def _fetch_manifest_delta(self, cached):
+        '''
+        Fetch the changes since the cached manifest. Returns the cached manifest if nothing changed,
+        the new manifest, or None if the full manifest has to be downloaded instead.
+        '''
+        url = delta_url(cached)
+        try:
+            async with self._session.get(url) as response:
+                if response.status == 304:
+                    return cached
+                response.raise_for_status()
+                body = await response.read()
+                tracing.current().add("bytes", len(body))
+                delta = decode_manifest(body)
+        except Exception as e:
+            if logger.level == logging.DEBUG: traceback.print_exc()
+            logger.debug("Failed to load manifest changes from %s: %s", url, str(e))
+            return None
+        if "delta_from" not in delta:
+            return delta # the publisher sent the full manifest
+        if delta.get("version") == cached.get("version"):
+            return cached
+        return apply_manifest_delta(cached, delta)
+
+    @tracing.traced("load manifest", "network")
     async def load_manifest_from_url(self, url, force=False):
-        MANIFEST_ETAG_CACHED_KEY = "manifest:cached"
-        MANIFEST_ETAG_META_KEY = "manifest:cached:etag"
-        etag = self._db.get_meta(MANIFEST_ETAG_META_KEY)
-        use_etag = False # etag is not None and not force # disabled for now, will rework later
-        if use_etag:
-            logger.debug("Found Etag for previous manifest download, will skip update if it hasn't changed")
+        cached = None
+        if not force and await asyncio.to_thread(self._db.get_meta, MANIFEST_URL_META_KEY) == url:
+            value = await asyncio.to_thread(self._db.get_meta, MANIFEST_CACHED_KEY)
+            cached = load_cached_manifest(value) if value is not None else None
         logger.info("Loading update manifest")
-        async with await self._session.get(url, headers={
-            "If-None-Match": etag if use_etag else ""
-        }) as data: # type: ignore
-            data.raise_for_status()
-            if data.status == 304 and not force:
-                logger.debug("Manifest is unchanged from a known state, nothing changed")
-                self._unchanged = True
-                self._manifest = json.loads(self._db.get_meta(MANIFEST_ETAG_CACHED_KEY, "{}")) # type: ignore
-            else:
-                if "Etag" in data.headers:
-                    logger.debug("Saving manifest with Etag %s for later comparison", data.headers["Etag"])
-                    self._db.set_meta(MANIFEST_ETAG_META_KEY, data.headers["Etag"])
-                self._manifest = await data.json(content_type=None)
-                self._db.set_meta(MANIFEST_ETAG_CACHED_KEY, json.dumps(self._manifest))
+        manifest = None
+        validators = {}
+        if cached is not None and delta_url(cached) is not None:
+            manifest = await self._fetch_manifest_delta(cached)
+        if manifest is None:
+            headers = {}
+            if cached is not None:
+                etag = await asyncio.to_thread(self._db.get_meta, MANIFEST_ETAG_META_KEY)
+                last_modified = await asyncio.to_thread(self._db.get_meta, MANIFEST_LAST_MODIFIED_META_KEY)
+                if etag is not None:
+                    logger.debug("Found Etag for previous manifest download, will skip update if it hasn't changed")
+                    headers["If-None-Match"] = etag
+                if last_modified is not None:
+                    headers["If-Modified-Since"] = last_modified
+            async with self._session.get(url, headers=headers) as data:
+                data.raise_for_status()
+                if data.status == 304 and cached is not None:
+                    manifest = cached
+                else:
+                    body = await data.read()
+                    tracing.current().add("bytes", len(body))
+                    manifest = decode_manifest(body)
+                    validators = {MANIFEST_ETAG_META_KEY: data.headers.get("ETag"), MANIFEST_LAST_MODIFIED_META_KEY: data.headers.get("Last-Modified")}
+        if manifest is cached:
+            # validated when it was cached
+            logger.debug("Manifest is unchanged from a known state, nothing changed")
+            self._unchanged = True
+        else:
+            with tracing.span("validate manifest", "cpu"):
+                import jsonschema # slow to import, only needed for new manifests
+                jsonschema.validate(manifest, MANIFEST_SCHEMA)
+            if validators.get(MANIFEST_ETAG_META_KEY) is not None:
+                logger.debug("Saving manifest with Etag %s for later comparison", validators[MANIFEST_ETAG_META_KEY])
+            self._db.set_meta(MANIFEST_CACHED_KEY, dump_cached_manifest(manifest))
+            self._db.set_meta(MANIFEST_URL_META_KEY, url)
+            # a manifest updated from a delta has no validators of its own
+            self._db.set_meta(MANIFEST_ETAG_META_KEY, validators.get(MANIFEST_ETAG_META_KEY))
+            self._db.set_meta(MANIFEST_LAST_MODIFIED_META_KEY, validators.get(MANIFEST_LAST_MODIFIED_META_KEY))
+        self._manifest = manifest
         assert self._manifest is not None
-        jsonschema.validate(self._manifest, MANIFEST_SCHEMA)
         self._frontend.set_branding(self._manifest["brand"])
         logger.info("Updating %s", self._manifest["brand"]["name"])
 
@@ -254,14 +759,78 @@ class InstallerBackend:
         self._selected_branch = branch
         self._selected_branch_data = self._manifest["branches"][branch]
 
+    @tracing.traced("verify")
+    async def verify(self, repair=False):
+        '''
+        Check every file of the selected branch against the CRC of its archive member. With repair,
+        corrupted and missing files are fetched again and intact files that aren't tracked are tracked.
+        '''
+        if self._manifest is None:
+            self._frontend.fatal("Manifest is not loaded.")
+            return
+        jobs = []
+        for order, layer in enumerate(self._selected_branch_data["layers"]):
+            if layer not in self._manifest["layers"]:
+                self._frontend.fatal("Layer " + layer + " was not found in the manifest.")
+                return
+            jobs.extend(ArchiveJob(layer, order, url) for url in self._archive_urls(self._manifest["layers"][layer]))
+        await self._probe_mirrors(jobs)
+        with self._frontend.progress("Checking layers", total=len(jobs), leave=False) as p:
+            async def check(job):
+                await self._check_archive(job, False)
+                p.update()
+            await asyncio.gather(*(check(job) for job in jobs))
+        if not repair:
+            for job in jobs: self._discard_archive(job)
+        self._plan_sources(jobs)
+        resolve_owners(jobs)
+        # symlinked paths are left alone like during updates
+        expected = {f.filename: (job, f) for job in jobs for f in job.directory.members # type: ignore
+                    if not f.is_dir() and job.owns(f.filename) and not os.path.islink(f.filename)}
+        logger.info("Verifying %i files", len(expected))
+        with self._frontend.progress("Verifying files", total=len(expected), unit="file") as p, \
+                tracing.span("verify files", "disk", files=len(expected)):
+            crcs = await asyncio.to_thread(crc_files, list(expected), self._index_workers, p)
+        tracked = {f[0]: f for f in await asyncio.to_thread(self._db.get_tracked_files)}
+        broken, untracked = {}, {} # job -> members to fetch, layer -> intact members to track
+        missing = corrupted = 0
+        for path, (job, member) in expected.items():
+            crc = crcs[path]
+            if crc == member.CRC:
+                row = tracked.get(path)
+                if row is None or row[1] != member.CRC or row[3] != job.layer:
+                    untracked.setdefault(job.layer, []).append(member)
+                continue
+            if crc is None: missing += 1
+            else: corrupted += 1
+            broken.setdefault(job, []).append(member)
+        unrecorded = sum(len(m) for m in untracked.values())
+        logger.info("%i files are corrupted, %i missing and %i intact but not tracked", corrupted, missing, unrecorded)
+        if not repair:
+            if broken or untracked:
+                self._frontend.notify("Verification found %i corrupted, %i missing and %i untracked files. Run with --repair to fix them." % (corrupted, missing, unrecorded))
+            else:
+                self._frontend.notify("All files are intact.")
+            return
+        for layer, members in untracked.items():
+            self._track_members(layer, members)
+        with self._frontend.progress("Repairing files", total=len(broken), leave=False) as p:
+            async def fetch(job):
+                await self._fetch_members(job, broken[job])
+                p.update()
+            await asyncio.gather(*(fetch(job) for job in broken))
+        for job in jobs: self._discard_archive(job)
+        await self._db.flush()
+        self._frontend.notify("Repaired %i files and tracked %i intact files." % (corrupted + missing, unrecorded))
+
+    @tracing.traced("update")
     async def update(self, force=False, ignore_self_update=False):
-        CLEAN_INSTALL_COMPLETE = "clean-install:complete"
         if self._manifest is None:
             self._frontend.fatal("Manifest is not loaded.")
             return
         if not ignore_self_update and getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"):
             platform = "windows" if sys.platform == "win32" else ("linux" if sys.platform.startswith("linux") else "unknown")
-            uhash = sha256sum(sys.executable)
+            uhash = await asyncio.to_thread(cached_sha256sum, self._db, sys.executable)
             if platform in self._manifest["self"]:
                 selfupdate_info = self._manifest["self"][platform]
                 if uhash != selfupdate_info["sha256"]:
@@ -269,49 +838,102 @@ class InstallerBackend:
                     self._frontend.fatal("An update is available, please download it from " + selfupdate_info["url"])
                     return
         logger.info("Indexing existing files")
-        total, modified, removed = self._db.index_files()
+        with tracing.span("index files", "disk") as s:
+            total, modified, removed = await asyncio.to_thread(self._db.index_files, workers=self._index_workers)
+            s.set(files=len(total), modified=len(modified), removed=len(removed))
         logger.debug("Total %i tracked files: %i modified, %i removed", len(total), len(modified), len(removed))
+        self._tracked = {f[0]: (f[1], f[3]) for f in total}
+        removed = set(removed)
+        for f in removed: self._tracked[f] = (None, self._tracked[f][1])
         layers = self._selected_branch_data["layers"]
-        clean_install = (len(total) == 0 or not int(self._db.get_meta(CLEAN_INSTALL_COMPLETE, "0"))) # type: ignore
+        clean_install = (len(total) == 0 or not int(await asyncio.to_thread(self._db.get_meta, CLEAN_INSTALL_COMPLETE, "0"))) # type: ignore
+        # archives completed by an interrupted update, (layer, url) -> layer version
+        checkpoints = {} if force else await asyncio.to_thread(self._db.get_checkpoints)
         if not clean_install:
             # populate deletable files list for later deletion
-            self._deletable_files = [f[0] for f in total.copy()] # add all files, they will be removed during file download later
-            if self._unchanged:
+            self._deletable_files = set(self._tracked) # add all files, the ones still present in the selected layers are removed from it later
+            if self._unchanged and await asyncio.to_thread(self._db.get_meta, UPDATE_COMPLETE_BRANCH) == self._selected_branch:
                 logger.info("No update required")
                 return
-        else: self._db.clear_tracked_files()
-        with self._frontend.progress("Loading layers", total=len(layers), leave=False) as p:
-            for layer in layers:
+        elif not checkpoints: self._db.clear_tracked_files()
+        # an unchanged manifest can only be trusted once this update has finished
+        self._db.set_meta(UPDATE_COMPLETE_BRANCH, "")
+        await self._db.flush()
+        tracked_by_layer = {}
+        for path, (_, layer) in self._tracked.items():
+            tracked_by_layer.setdefault(layer, []).append(path)
+        jobs = []
+        kept = {} # files of unchanged layers, path -> layer order
+        for order, layer in enumerate(layers):
+            if layer not in self._manifest["layers"]:
+                self._frontend.fatal("Layer " + layer + " was not found in the manifest.")
+                return
+            meta_key = f"manifest:layer:{layer}:updated"
+            layer_data = self._manifest["layers"][layer]
+            recorded_updated_value = int(await asyncio.to_thread(self._db.get_meta, meta_key, "0")) # type: ignore
+            if recorded_updated_value >= layer_data["updated"] and not force and not clean_install:
+                logger.debug("Layer " + layer + " was not changed since last update check")
+                self._known_files(tracked_by_layer.get(layer, ()))
+                kept.update((path, order) for path in tracked_by_layer.get(layer, ()))
+                continue
+            if len(layer_data["url"]) == 0:
+                self._frontend.fatal("Layer " + layer + " does not have any content URLs")
+                return
+            jobs.extend(ArchiveJob(layer, order, url) for url in self._archive_urls(layer_data))
+        for job in jobs:
+            job.checkpointed = checkpoints.get((job.layer, job.url)) == self._manifest["layers"][job.layer]["updated"]
+        await self._probe_mirrors(jobs)
+        with self._frontend.progress("Checking layers", total=len(jobs), leave=False) as p:
+            async def check(job):
+                await self._check_archive(job, clean_install)
                 p.update()
-                if layer not in self._manifest["layers"]:
-                    self._frontend.fatal("Layer " + layer + " was not found in the manifest.")
-                    break
-                meta_key = f"manifest:layer:{layer}:updated"
-                layer_data = self._manifest["layers"][layer]
-                recorded_updated_value = int(self._db.get_meta(meta_key, "0")) # type: ignore
-                if recorded_updated_value >= layer_data["updated"] and not force and not clean_install:
-                    logger.debug("Layer " + layer + " was not changed since last update check")
-                    for f in self._db.get_files_by_layer(layer): self._known_file(f[0])
-                    continue
-                if len(layer_data["url"]) == 0:
-                    self._frontend.fatal("Layer " + layer + " does not have any content URLs")
-                    break
-                with self._frontend.progress("Loading layer " + layer, total=len(layer_data["url"]), leave=False) as lp:
-                    tasks = []
-                    for url in layer_data["url"]:
-                        lp.update(1)
-                        if clean_install:
-                            # no point in selective download, just download and unzip all at once
-                            tasks.append(asyncio.ensure_future(self._download_and_unzip(url, layer)))
-                        else:
-                            tasks.append(asyncio.ensure_future(self._download_and_unzip_selective(url, layer)))
-                    await asyncio.gather(*tasks)
-                self._db.set_meta(meta_key, str(layer_data["updated"]))
+            await asyncio.gather(*(check(job) for job in jobs))
+        for job in jobs:
+            # without its members a clean install can't tell which files a checkpointed archive left
+            if clean_install and job.directory is None: job.checkpointed = False
+        self._plan_sources(jobs)
+        resolve_owners(jobs, kept)
+        if clean_install and checkpoints:
+            self._resume_clean_install(jobs)
+        for job in jobs:
+            self._plan_changes(job, clean_install)
+        if self._store is not None:
+            self._plan_restores(jobs, {(f[1], f[4]): f[0] for f in total if f[1] is not None and f[0] not in removed})
+        remaining = collections.Counter(job.layer for job in jobs)
+        with self._frontend.progress("Loading layers", total=len(remaining), leave=False) as p:
+            async def run(job):
+                if clean_install and not job.checkpointed:
+                    # no point in selective download, just download and unzip all at once
+                    await self._download_and_unzip(job)
+                else:
+                    await self._download_and_unzip_selective(job)
+                self._discard_archive(job)
+                updated = self._manifest["layers"][job.layer]["updated"] # type: ignore
+                self._db.set_checkpoint(job.layer, job.url, updated)
+                remaining[job.layer] -= 1
+                if remaining[job.layer] == 0:
+                    self._db.set_meta(f"manifest:layer:{job.layer}:updated", str(updated))
+                    p.update()
+                # the files of an archive are committed together with its checkpoint, or before it
+                await self._db.flush()
+            await run_jobs(jobs, run)
         if len(self._deletable_files) > 0:
-            for f in self._deletable_files:
-                try:
-                    os.unlink(f)
-                except FileNotFoundError: pass
-            self._db.delete_tracked_files([(f,) for f in self._deletable_files])
+            logger.info("Removing %i obsolete files", len(self._deletable_files))
+            deletable, deleted = self._deletable_files, []
+            with tracing.span("delete files", "disk", files=len(deletable)):
+                if self._store is not None:
+                    deleted = await self._store.retire([(f, self._tracked[f][0]) for f in deletable if self._tracked[f][0] is not None])
+                    deletable = deletable.difference(deleted)
+                deleted += await asyncio.to_thread(delete_files, deletable)
+                pruned = await asyncio.to_thread(prune_empty_dirs, deleted)
+            logger.debug("Removed %i files and %i empty directories", len(deleted), pruned)
+            self._db.delete_tracked_files([(f,) for f in deleted])
+            for f in deleted: del self._tracked[f]
+        for layer in tracked_by_layer.keys() - set(layers):
+            # files of layers outside the selected branch are gone, install them again when they are selected later
+            self._db.set_meta(f"manifest:layer:{layer}:updated", "0")
+        self._db.clear_checkpoints()
         if clean_install: self._db.set_meta(CLEAN_INSTALL_COMPLETE, "1")
+        self._db.set_meta(UPDATE_COMPLETE_BRANCH, self._selected_branch)
+        await self._db.flush()
         self._frontend.notify("Update complete.")
\ No newline at end of file
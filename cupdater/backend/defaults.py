@@ -0,0 +1,5 @@
+# Download tunables exposed on the command line. They live apart from the modules using them,
+# which import aiohttp, so the launcher can build its arguments without loading the network stack.
+DEFAULT_RANGE_GAP = 256 * 1024
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_SEGMENT_CONNECTIONS = 4
@@ -0,0 +1,58 @@
+import io
+import logging
+import os
+import zlib
+
+import zstandard
+
+
+logger = logging.getLogger(__name__)
+
+PATCH_FORMATS = ("zstd",)
+# zstd --patch-from refuses files larger than this as well
+MAX_WINDOW_LOG = 31
+MIN_WINDOW_LOG = 20
+PATCH_CHUNK_SIZE = 1024 * 1024
+PATCH_TEMP_SUFFIX = ".cupd-patch"
+
+def _raw_content_dict(data):
+    return zstandard.ZstdCompressionDict(data, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+def create_patch(source, target, level=19):
+    '''
+    Create a zstd patch turning the bytes of source into target, like zstd --patch-from=source target.
+    '''
+    window_log = min(MAX_WINDOW_LOG, max(MIN_WINDOW_LOG, max(len(source), len(target)).bit_length() + 1))
+    params = zstandard.ZstdCompressionParameters.from_level(level, window_log=window_log, enable_ldm=True)
+    return zstandard.ZstdCompressor(compression_params=params, dict_data=_raw_content_dict(source)).compress(target)
+
+def apply_patch(path, patch, crc, size, fmt="zstd"):
+    '''
+    Apply a patch to the file at path. The result is written next to it and only replaces the file
+    if it matches the expected CRC-32 and size. Returns whether the file was patched.
+    '''
+    if fmt not in PATCH_FORMATS:
+        logger.debug("Unknown patch format %s", fmt)
+        return False
+    with open(path, "rb") as f:
+        source = f.read()
+    decompressor = zstandard.ZstdDecompressor(dict_data=_raw_content_dict(source), max_window_size=1 << MAX_WINDOW_LOG)
+    temppath = path + PATCH_TEMP_SUFFIX
+    try:
+        actual_crc, actual_size = 0, 0
+        with decompressor.stream_reader(io.BytesIO(patch)) as reader, open(temppath, "wb") as target:
+            while chunk := reader.read(PATCH_CHUNK_SIZE):
+                target.write(chunk)
+                actual_crc = zlib.crc32(chunk, actual_crc)
+                actual_size += len(chunk)
+        if actual_crc != crc or actual_size != size:
+            logger.debug("Patched %s has CRC %08x and size %i instead of %08x and %i", path, actual_crc, actual_size, crc, size)
+            os.unlink(temppath)
+            return False
+    except zstandard.ZstdError as e:
+        logger.debug("Failed to apply patch to %s: %s", path, str(e))
+        os.unlink(temppath)
+        return False
+    # replacing instead of writing in place also keeps hardlinked copies intact
+    os.replace(temppath, path)
+    return True
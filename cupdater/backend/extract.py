@@ -0,0 +1,69 @@
+import heapq
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import tracing
+from .rangefetch import extract_member_at
+
+
+logger = logging.getLogger(__name__)
+
+def balance_members(members, workers):
+    '''
+    Split members into at most workers batches of similar total compressed size
+    (largest first into the least loaded batch). Each batch is sorted by archive offset.
+    '''
+    workers = max(1, min(workers, len(members)))
+    heap = [(0, i) for i in range(workers)]
+    batches = [[] for _ in range(workers)]
+    for m in sorted(members, key=lambda m: m.compress_size, reverse=True):
+        load, i = heapq.heappop(heap)
+        batches[i].append(m)
+        heapq.heappush(heap, (load + m.compress_size + 1, i))
+    for batch in batches:
+        batch.sort(key=lambda m: m.header_offset)
+    return [b for b in batches if b]
+
+def _open_source(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source) # shares the buffer with the bytes object until written to
+    return open(source, "rb")
+
+class _ProgressCounter:
+    '''
+    Serializes progress updates coming from several worker threads.
+    '''
+    def __init__(self, progress) -> None:
+        self._progress = progress
+        self._lock = threading.Lock()
+
+    def update(self, count=1):
+        if self._progress is None:
+            return
+        with self._lock:
+            self._progress.update(count)
+
+def _extract_batch(source, members, progress):
+    with tracing.span("extract batch", "cpu", files=len(members)), _open_source(source) as fileobj:
+        for m in members:
+            extract_member_at(fileobj, 0, m)
+            progress.update()
+    return len(members)
+
+def extract_members(source, members, workers=None, progress=None):
+    '''
+    Extract the given members of a local archive (a path or the archive bytes) on a thread pool.
+    Every worker reads the archive through its own file object.
+    '''
+    members = [m for m in members if not m.is_dir()]
+    if len(members) == 0:
+        return 0
+    workers = workers if workers else (os.cpu_count() or 1)
+    batches = balance_members(members, workers)
+    counter = _ProgressCounter(progress)
+    logger.debug("Extracting %i members with %i workers", len(members), len(batches))
+    with ThreadPoolExecutor(max_workers=len(batches)) as pool:
+        return sum(pool.map(_extract_batch, [source] * len(batches), batches, [counter] * len(batches)))
@@ -0,0 +1,65 @@
+import logging
+import sys
+import urllib.error
+import urllib.request
+
+from .filedb import FileDB, cached_sha256sum, CLEAN_INSTALL_COMPLETE, UPDATE_COMPLETE_BRANCH
+from .manifestio import delta_url, load_cached_manifest, \
+    MANIFEST_CACHED_KEY, MANIFEST_URL_META_KEY, MANIFEST_ETAG_META_KEY, MANIFEST_LAST_MODIFIED_META_KEY
+
+
+logger = logging.getLogger(__name__)
+
+# a slow answer falls back to the regular update, which asks again with the full timeout
+FAST_START_TIMEOUT = 5
+
+def _not_modified(url, headers, timeout):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+            return response.status == 304
+    except urllib.error.HTTPError as e:
+        # urllib treats every status other than 2xx as an error
+        return e.code == 304
+
+def check_up_to_date(url, branch, check_self=True, timeout=FAST_START_TIMEOUT):
+    '''
+    Confirm that the last update of branch finished and the manifest at url is still the cached one,
+    with a single conditional request and without loading the update machinery.
+    Returns the cached manifest if nothing has to be done, None if the full update has to run.
+    '''
+    db = FileDB()
+    try:
+        if db.get_meta(CLEAN_INSTALL_COMPLETE, "0") != "1" or db.get_meta(UPDATE_COMPLETE_BRANCH) != branch:
+            return None
+        if db.get_meta(MANIFEST_URL_META_KEY) != url or not db.has_tracked_files():
+            return None
+        value = db.get_meta(MANIFEST_CACHED_KEY)
+        if value is None:
+            return None
+        manifest = load_cached_manifest(value)
+        if manifest is None or branch not in manifest["branches"]:
+            return None
+        if check_self and getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"):
+            platform = "windows" if sys.platform == "win32" else ("linux" if sys.platform.startswith("linux") else "unknown")
+            if platform in manifest["self"] and cached_sha256sum(db, sys.executable) != manifest["self"][platform]["sha256"]:
+                return None # the full update tells about the new version
+        changes = delta_url(manifest)
+        if changes is not None:
+            unchanged = _not_modified(changes, {}, timeout)
+        else:
+            headers = {}
+            etag = db.get_meta(MANIFEST_ETAG_META_KEY)
+            last_modified = db.get_meta(MANIFEST_LAST_MODIFIED_META_KEY)
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+            if not headers:
+                return None
+            unchanged = _not_modified(url, headers, timeout)
+        return manifest if unchanged else None
+    except Exception as e:
+        logger.debug("Quick update check failed: %s", str(e))
+        return None
+    finally:
+        db.close()
@@ -1,95 +1,358 @@
-import pathlib
+import asyncio
+import atexit
+import hashlib
 import os
+import queue
 import sqlite3
+import threading
+import time
 import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
 
 UPDATE_DATA_DB_FILENAME = "updatedata.db"
+# meta keys of the installation state
+CLEAN_INSTALL_COMPLETE = "clean-install:complete"
+UPDATE_COMPLETE_BRANCH = "update:complete:branch"
 TABLES_SCHEMA="""
 CREATE TABLE IF NOT EXISTS meta(key TEXT, value BLOB);
 CREATE UNIQUE INDEX IF NOT EXISTS meta_key ON meta (key);
 
-CREATE TABLE IF NOT EXISTS files(path TEXT, crc INTEGER, updated INTEGER, layer TEXT);
+CREATE TABLE IF NOT EXISTS files(path TEXT, crc INTEGER, updated INTEGER, layer TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER);
 CREATE UNIQUE INDEX IF NOT EXISTS files_path ON files (path);
 CREATE INDEX IF NOT EXISTS files_layer ON files (layer);
+
+CREATE TABLE IF NOT EXISTS archives(url TEXT, etag TEXT, last_modified TEXT, size INTEGER, cd_offset INTEGER, cd_size INTEGER, checked REAL, members BLOB);
+CREATE UNIQUE INDEX IF NOT EXISTS archives_url ON archives (url);
+
+CREATE TABLE IF NOT EXISTS downloads(path TEXT, url TEXT, validator TEXT, written INTEGER, streamed INTEGER);
+CREATE UNIQUE INDEX IF NOT EXISTS downloads_path ON downloads (path);
+CREATE TABLE IF NOT EXISTS extracted(path TEXT, filename TEXT, crc INTEGER);
+CREATE INDEX IF NOT EXISTS extracted_path ON extracted (path);
+
+CREATE TABLE IF NOT EXISTS objects(crc INTEGER, size INTEGER, added REAL);
+CREATE UNIQUE INDEX IF NOT EXISTS objects_key ON objects (crc, size);
+
+CREATE TABLE IF NOT EXISTS checkpoints(layer TEXT, url TEXT, updated INTEGER);
+CREATE UNIQUE INDEX IF NOT EXISTS checkpoints_key ON checkpoints (layer, url);
 """
+# columns added to existing databases after their creation
+FILES_COLUMNS_MIGRATION = {"size": "INTEGER", "mtime_ns": "INTEGER", "inode": "INTEGER"}
+DOWNLOADS_COLUMNS_MIGRATION = {"streamed": "INTEGER"}
+FILES_COLUMNS = "path, crc, updated, layer, size, mtime_ns, inode"
+
+CRC_BUFFER_SIZE = 1024 * 1024
+# WAL lets readers continue while the writer thread commits, synchronous=NORMAL only loses the
+# last commits on power failure, never consistency
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16384",
+    "PRAGMA busy_timeout=5000",
+)
+# queued writes are committed at least this often, e.g. the download journal
+COMMIT_INTERVAL = 1.0
 
 def fcrc32(fpath):
-    """With for loop and buffer."""
+    """With for loop and buffer. zlib releases the GIL for large buffers, so this scales across threads."""
     crc = 0
-    with open(fpath, 'rb', 65536) as ins:
-        for x in range(int((os.stat(fpath).st_size / 65536)) + 1):
-            crc = zlib.crc32(ins.read(65536), crc)
+    with open(fpath, 'rb', buffering=0) as ins:
+        while chunk := ins.read(CRC_BUFFER_SIZE):
+            crc = zlib.crc32(chunk, crc)
     return (crc & 0xFFFFFFFF)
 
+def sha256sum(filename):
+    with open(filename, 'rb', buffering=0) as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def cached_sha256sum(db, filename):
+    '''
+    sha256sum of a file that is only recomputed when its size or modification time changed,
+    hashing the whole updater executable on every launch takes longer than the rest of the startup.
+    '''
+    st = os.stat(filename)
+    key = f"sha256:{os.path.abspath(filename)}"
+    stamp = f"{st.st_size}:{st.st_mtime_ns}"
+    cached = db.get_meta(key)
+    if cached is not None:
+        cached_stamp, _, digest = cached.partition("=")
+        if cached_stamp == stamp:
+            return digest
+    digest = sha256sum(filename)
+    db.set_meta(key, f"{stamp}={digest}")
+    return digest
+
+def stat_fingerprint(st, inode=None):
+    '''
+    Tracking fingerprint of a stat result: (updated, size, mtime_ns, inode).
+    '''
+    return (st.st_mtime, st.st_size, st.st_mtime_ns, st.st_ino if inode is None else inode)
+
+def file_fingerprint(path):
+    return stat_fingerprint(os.stat(path))
+
+def _scan_directory(directory, names):
+    found = {}
+    try:
+        with os.scandir(directory if directory else os.curdir) as it:
+            for entry in it:
+                path = names.get(entry.name)
+                if path is not None and entry.is_file():
+                    # DirEntry.stat() doesn't fill st_ino on Windows, inode() does
+                    found[path] = stat_fingerprint(entry.stat(), entry.inode())
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return found
+
+def scan_files(paths, workers=None):
+    '''
+    Fingerprint many tracked files with one os.scandir per directory instead of stat calls per path,
+    scanning directories in parallel. Returns a dict of path -> fingerprint for files that exist.
+    '''
+    by_dir = {}
+    for path in paths:
+        directory, _, name = path.rpartition("/")
+        by_dir.setdefault(directory, {})[name] = path
+    found = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(_scan_directory, by_dir.keys(), by_dir.values()):
+            found.update(result)
+    return found
+
+def _crc_or_none(path):
+    try:
+        return fcrc32(path)
+    except OSError:
+        return None
+
+def crc_files(paths, workers=None, progress=None):
+    '''
+    CRC32 of many files in parallel. Returns a dict of path -> crc, None for files that can't be read.
+    '''
+    crcs = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, crc in zip(paths, pool.map(_crc_or_none, paths)):
+            crcs[path] = crc
+            if progress is not None:
+                progress.update()
+    return crcs
+
 class FileDB:
+    '''
+    Bookkeeping database of the installation. Writes are queued and executed by a writer thread, which
+    groups them into one transaction until flush() is awaited or COMMIT_INTERVAL passed. Reads wait
+    until all earlier writes were executed, so they see them even before they are committed. Async code
+    calls them with asyncio.to_thread, that wait must not block the event loop.
+    '''
     _conn: sqlite3.Connection
+    _lock: threading.Lock # serializes use of the connection between the writer thread and readers
+    _queue: queue.Queue[tuple[str, Any]] # (kind, payload): "write" with (sql, params, many), "flush" or "stop" with a callback
+    _writer: threading.Thread
+    _executed: threading.Condition
+    _queued_count: int
+    _executed_count: int
+    _error: Exception | None
+    _closed: bool
     def __init__(self) -> None:
-        self._conn = sqlite3.connect(UPDATE_DATA_DB_FILENAME)
+        self._conn = sqlite3.connect(UPDATE_DATA_DB_FILENAME, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            self._conn.execute(pragma).close()
         self._populate_tables()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._executed = threading.Condition()
+        self._queued_count = 0
+        self._executed_count = 0
+        self._error = None
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, name="filedb-writer", daemon=True)
+        self._writer.start()
+        # queued writes must not be lost when the updater exits after a fatal error
+        atexit.register(self.close)
     def _populate_tables(self):
         self._conn.executescript(TABLES_SCHEMA)
+        for table, migration in (("files", FILES_COLUMNS_MIGRATION), ("downloads", DOWNLOADS_COLUMNS_MIGRATION)):
+            columns = [c[1] for c in self._conn.execute(f"PRAGMA table_info({table})").fetchall()]
+            for column, ctype in migration.items():
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ctype}").close()
+        self._conn.commit()
+    def _write_loop(self):
+        dirty, last_commit = False, time.monotonic()
+        payload: Any # depends on the kind of the queued item
+        while True:
+            try:
+                kind, payload = self._queue.get(timeout=max(0.0, last_commit + COMMIT_INTERVAL - time.monotonic()) if dirty else None)
+            except queue.Empty:
+                kind, payload = "commit", None
+            if kind == "write":
+                sql, params, many = payload
+                with self._lock:
+                    try:
+                        (self._conn.executemany if many else self._conn.execute)(sql, params).close()
+                    except Exception as e:
+                        # not only sqlite3.Error, binding a parameter can raise OverflowError or TypeError,
+                        # and the thread has to live on until close() or waiting readers hang
+                        self._error = e
+                dirty = True
+                with self._executed:
+                    self._executed_count += 1
+                    self._executed.notify_all()
+                if time.monotonic() - last_commit < COMMIT_INTERVAL:
+                    continue
+            if dirty:
+                with self._lock:
+                    try:
+                        self._conn.commit()
+                    except Exception as e:
+                        self._error = e
+                dirty, last_commit = False, time.monotonic()
+            if kind in ("flush", "stop"):
+                try:
+                    payload()
+                except Exception as e:
+                    self._error = e
+                if kind == "stop":
+                    return
+    def _write(self, sql, params=(), many=False):
+        if self._closed:
+            raise sqlite3.ProgrammingError("Cannot write to a closed database")
+        with self._executed:
+            self._queued_count += 1
+        self._queue.put(("write", (sql, list(params) if many else params, many)))
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+    def _read(self, sql, params=()):
+        with self._executed:
+            queued = self._queued_count
+            self._executed.wait_for(lambda: self._executed_count >= queued)
+        self._raise_error()
+        with self._lock:
+            cur = self._conn.execute(sql, params)
+            result = cur.fetchall()
+            cur.close()
+        return result
+    async def flush(self):
+        '''
+        Commit all writes queued so far without blocking the event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        def notify():
+            try:
+                loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+            except RuntimeError:
+                pass # the loop was closed, nobody waits anymore
+        self._queue.put(("flush", notify))
+        await done
+        self._raise_error()
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        stopped = threading.Event()
+        self._queue.put(("stop", stopped.set))
+        stopped.wait()
+        self._conn.close()
+        self._raise_error()
     def get_meta(self, key, default=None):
-        cur = self._conn.execute("SELECT value FROM meta WHERE key = ? LIMIT 1", (key,))
-        result = cur.fetchall()
-        cur.close()
+        result = self._read("SELECT value FROM meta WHERE key = ? LIMIT 1", (key,))
         if len(result) == 0:
             return default
         return result[0][0]
     def set_meta(self, key, value):
-        self._conn.execute("INSERT INTO meta VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value,)).close()
-        self._conn.commit()
+        self._write("INSERT INTO meta VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value,))
     def get_file(self, path):
-        cur = self._conn.execute("SELECT * FROM files WHERE path = ? LIMIT 1", (path,))
-        result = cur.fetchall()
-        cur.close()
+        result = self._read(f"SELECT {FILES_COLUMNS} FROM files WHERE path = ? LIMIT 1", (path,))
         if len(result) == 0:
             return None
         return result[0]
+    def has_tracked_files(self):
+        return len(self._read("SELECT 1 FROM files LIMIT 1")) > 0
     def get_tracked_files(self):
-        cur = self._conn.execute("SELECT * FROM files")
-        files = cur.fetchall()
-        cur.close()
-        return files
-    def index_files(self):
+        return self._read(f"SELECT {FILES_COLUMNS} FROM files")
+    def index_files(self, workers=None):
         files = self.get_tracked_files()
-        modified, removed = [], []
-        cur = self._conn.cursor()
-        root = pathlib.Path(os.curdir)
+        modified, removed, changed, refreshed = [], [], [], []
+        found = scan_files([f[0] for f in files], workers)
         for f in files:
-            spath, crc, updated, layer = f
-            path = root / spath
-            if not path.exists():
-                removed.append(path)
+            spath, crc, updated, layer, size, mtime_ns, inode = f
+            fingerprint = found.get(spath)
+            if fingerprint is None:
+                removed.append(spath)
                 continue
-            pmtime = os.path.getmtime(path)
-            if pmtime == float(updated):
-                # last modification date not changed, assuming file contents weren't either
+            if mtime_ns is None:
+                # tracked before fingerprints were recorded, fall back to the old mtime check once
+                if fingerprint[0] == float(updated):
+                    refreshed.append((crc, *fingerprint, spath))
+                    continue
+            elif fingerprint[1:] == (size, mtime_ns, inode):
+                # size, modification date and inode not changed, assuming file contents weren't either
                 continue
-            ncrc = fcrc32(path)
-            if ncrc != crc:
-                modified.append(path)
-                cur.execute("UPDATE files SET crc = ?, updated = ? WHERE path = ?", (ncrc, pmtime, spath))
-                continue
-        cur.close()
+            changed.append((spath, crc, fingerprint))
+        if len(changed) > 0:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                crcs = list(pool.map(fcrc32, [spath for spath, _, _ in changed]))
+            for (spath, crc, fingerprint), ncrc in zip(changed, crcs):
+                if ncrc != crc:
+                    modified.append(spath)
+                # record the new fingerprint for unmodified files too so they aren't rehashed next time
+                refreshed.append((ncrc, *fingerprint, spath))
+        if len(refreshed) > 0:
+            self._write("UPDATE files SET crc = ?, updated = ?, size = ?, mtime_ns = ?, inode = ? WHERE path = ?", refreshed, many=True)
+            # return the rows as they are stored now
+            rows = {r[-1]: r for r in refreshed}
+            files = [f if f[0] not in rows else (f[0], rows[f[0]][0], rows[f[0]][1], f[3], *rows[f[0]][2:5]) for f in files]
         return files, modified, removed
     def track_files(self, files):
-        cur = self._conn.executemany("INSERT INTO files VALUES(?, ?, ?, ?)", files)
-        self._conn.commit()
-        cur.close()
-    def update_tracked_files(self, files):
-        cur = self._conn.executemany("UPDATE files SET crc = ?, updated = ?, layer = ? WHERE path = ?", files)
-        self._conn.commit()
-        cur.close()
+        self._write("INSERT OR REPLACE INTO files(path, crc, layer, updated, size, mtime_ns, inode) VALUES(?, ?, ?, ?, ?, ?, ?)", files, many=True)
     def clear_tracked_files(self):
-        cur = self._conn.execute("DELETE FROM files")
-        self._conn.commit()
-        cur.close()
+        self._write("DELETE FROM files")
     def delete_tracked_files(self, files):
-        cur = self._conn.executemany("DELETE FROM files WHERE path = ?", files)
-        self._conn.commit()
-        cur.close()
-    def get_files_by_layer(self, layer):
-        cur = self._conn.execute("SELECT * FROM files WHERE layer = ?", (layer,))
-        files = cur.fetchall()
-        cur.close()
-        return files
\ No newline at end of file
+        self._write("DELETE FROM files WHERE path = ?", files, many=True)
+    def get_archive(self, url):
+        result = self._read("SELECT url, etag, last_modified, size, cd_offset, cd_size, checked, members FROM archives WHERE url = ? LIMIT 1", (url,))
+        if len(result) == 0:
+            return None
+        return result[0]
+    def set_archive(self, archive):
+        self._write("INSERT INTO archives VALUES(?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(url) DO UPDATE SET " \
+                    "etag=excluded.etag, last_modified=excluded.last_modified, size=excluded.size, cd_offset=excluded.cd_offset, " \
+                    "cd_size=excluded.cd_size, checked=excluded.checked, members=excluded.members", archive)
+    def set_archive_checked(self, url, checked):
+        self._write("UPDATE archives SET checked = ? WHERE url = ?", (checked, url))
+    def get_download(self, path):
+        result = self._read("SELECT path, url, validator, written, streamed FROM downloads WHERE path = ? LIMIT 1", (path,))
+        if len(result) == 0:
+            return None
+        return result[0]
+    def set_download(self, path, url, validator, written, streamed=False):
+        if not streamed:
+            self._write("DELETE FROM extracted WHERE path = ?", (path,))
+        self._write("INSERT INTO downloads VALUES(?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET " \
+                    "url=excluded.url, validator=excluded.validator, written=excluded.written, streamed=excluded.streamed", (path, url, validator, written, int(streamed)))
+    def set_download_written(self, path, written):
+        self._write("UPDATE downloads SET written = ? WHERE path = ?", (written, path))
+    def delete_download(self, path):
+        self._write("DELETE FROM downloads WHERE path = ?", (path,))
+        self._write("DELETE FROM extracted WHERE path = ?", (path,))
+    def get_extracted(self, path):
+        return {filename: crc for filename, crc in self._read("SELECT filename, crc FROM extracted WHERE path = ?", (path,))}
+    def add_extracted(self, path, members):
+        self._write("INSERT INTO extracted(path, filename, crc) VALUES(?, ?, ?)", [(path, filename, crc) for filename, crc in members], many=True)
+    def get_objects(self):
+        return self._read("SELECT crc, size, added FROM objects")
+    def add_objects(self, objects):
+        self._write("INSERT OR REPLACE INTO objects(crc, size, added) VALUES(?, ?, ?)", objects, many=True)
+    def delete_objects(self, objects):
+        self._write("DELETE FROM objects WHERE crc = ? AND size = ?", objects, many=True)
+    def get_checkpoints(self):
+        return {(layer, url): updated for layer, url, updated in self._read("SELECT layer, url, updated FROM checkpoints")}
+    def set_checkpoint(self, layer, url, updated):
+        self._write("INSERT OR REPLACE INTO checkpoints(layer, url, updated) VALUES(?, ?, ?)", (layer, url, updated))
+    def clear_checkpoints(self):
+        self._write("DELETE FROM checkpoints")
@@ -0,0 +1,53 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+DELETE_BATCH_SIZE = 256
+
+def _unlink_batch(paths):
+    deleted = []
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Failed to delete %s: %s", path, str(e))
+            continue
+        deleted.append(path)
+    return deleted
+
+def delete_files(paths, workers=None, batch_size=DELETE_BATCH_SIZE):
+    '''
+    Unlink files in batches on a thread pool. Returns the paths that no longer exist.
+    '''
+    paths = list(paths)
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    deleted = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(_unlink_batch, batches):
+            deleted.extend(result)
+    return deleted
+
+def prune_empty_dirs(paths):
+    '''
+    Remove directories left empty after deleting the given files, deepest first.
+    Never removes the current directory itself.
+    '''
+    directories = set()
+    for path in paths:
+        directory = os.path.dirname(os.path.normpath(path))
+        while directory and directory not in directories:
+            directories.add(directory)
+            directory = os.path.dirname(directory)
+    removed = 0
+    for directory in sorted(directories, key=lambda d: d.count(os.path.sep), reverse=True):
+        try:
+            os.rmdir(directory)
+            removed += 1
+        except OSError:
+            pass # not empty or already gone
+    return removed
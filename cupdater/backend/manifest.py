@@ -54,6 +54,14 @@ MANIFEST_SCHEMA={
       "additionalProperties": {
         "$ref": "#/definitions/LayerConfig"
       }
+    },
+    "version": {
+      "description": "Version of the manifest, increased on every change. Required for delta_url.",
+      "type": "integer"
+    },
+    "delta_url": {
+      "description": "URL returning the changes since the manifest version in place of {version}: {\"delta_from\": version, \"version\": new version, \"patch\": JSON merge patch}. A full manifest or 304 Not Modified are accepted as well.",
+      "type": "string"
     }
   },
   "definitions": {
@@ -94,8 +102,56 @@ MANIFEST_SCHEMA={
           "description": "The link(s) to layer content",
           "type": "array",
           "items": {
-            "type": "string"
+            "oneOf": [
+              {
+                "description": "URL of a content archive",
+                "type": "string"
+              },
+              {
+                "description": "URLs of mirrors serving the same content archive, the first one identifies it",
+                "type": "array",
+                "minItems": 1,
+                "items": {
+                  "type": "string"
+                }
+              }
+            ]
           }
+        },
+        "patches": {
+          "description": "Delta patches that update installed files of the layer without downloading them again",
+          "type": "array",
+          "items": {
+            "$ref": "#/definitions/PatchInfo"
+          }
+        }
+      }
+    },
+    "PatchInfo": {
+      "description": "A delta patch between two versions of a file",
+      "type": "object",
+      "required": ["path", "from", "to", "url"],
+      "properties": {
+        "path": {
+          "description": "Path of the file in the layer content archive",
+          "type": "string"
+        },
+        "from": {
+          "description": "CRC-32 of the installed version the patch applies to",
+          "type": "integer"
+        },
+        "to": {
+          "description": "CRC-32 of the patched file, as listed in the layer content archive",
+          "type": "integer"
+        },
+        "url": {
+          "description": "URL to the patch",
+          "type": "string"
+        },
+        "format": {
+          "description": "Patch format. zstd patches are created with zstd --patch-from=<old file> <new file>",
+          "type": "string",
+          "enum": ["zstd"]
         }
       }
     },
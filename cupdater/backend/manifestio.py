@@ -0,0 +1,73 @@
+import copy
+import gzip
+import json
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+DELTA_VERSION_PLACEHOLDER = "{version}"
+# meta keys of the cached manifest in the FileDB
+MANIFEST_CACHED_KEY = "manifest:cached"
+MANIFEST_URL_META_KEY = "manifest:cached:url"
+MANIFEST_ETAG_META_KEY = "manifest:cached:etag"
+MANIFEST_LAST_MODIFIED_META_KEY = "manifest:cached:last-modified"
+
+def decode_manifest(data):
+    '''
+    Parse a manifest body that may be a gzip or zstd file, or a response whose
+    Content-Encoding the HTTP client didn't decode.
+    '''
+    if data[:2] == GZIP_MAGIC:
+        data = gzip.decompress(data)
+    elif data[:4] == ZSTD_MAGIC:
+        import zstandard
+        data = zstandard.ZstdDecompressor().stream_reader(data).read() # works without a content size in the frame header
+    return json.loads(data)
+
+def dump_cached_manifest(manifest):
+    # compact, nothing but load_cached_manifest reads it
+    return json.dumps(manifest, separators=(",", ":"))
+
+def load_cached_manifest(value):
+    '''
+    The manifest cached by dump_cached_manifest, or None if it has to be fetched again.
+    '''
+    if not isinstance(value, str):
+        return None # pickled by earlier builds, the database can be written by others so it's never unpickled
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+def delta_url(manifest):
+    '''
+    Returns the URL of the changes since the given manifest, or None if its publisher doesn't provide them.
+    '''
+    if "delta_url" not in manifest or "version" not in manifest:
+        return None
+    return manifest["delta_url"].replace(DELTA_VERSION_PLACEHOLDER, str(manifest["version"]))
+
+def merge_patch(target, patch):
+    '''
+    Apply a JSON merge patch (RFC 7386) to target in place: objects are merged recursively,
+    null removes a key and any other value replaces it.
+    '''
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+def apply_manifest_delta(manifest, delta):
+    '''
+    Apply a manifest delta {"delta_from": version, "version": new version, "patch": merge patch}.
+    Returns the new manifest, or None if the delta doesn't start at the version of manifest.
+    '''
+    if delta.get("delta_from") != manifest.get("version"):
+        return None
+    updated = merge_patch(copy.deepcopy(manifest), delta.get("patch", {}))
+    updated["version"] = delta["version"]
+    return updated
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import math
+import time
+import urllib.parse
+
+import aiohttp
+
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+# bytes requested from every host to measure it
+PROBE_SIZE = 64 * 1024
+PROBE_TIMEOUT = 5.0
+# transfer size hosts are compared at, so both latency and throughput count
+SCORE_SIZE = 1024 * 1024
+
+def origin(url):
+    parts = urllib.parse.urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+class HostStats:
+    '''
+    What is known about a host serving archives during this update.
+    '''
+    origin: str
+    rtt: float | None # seconds until the response headers arrived
+    throughput: float | None # bytes per second
+    failures: int
+
+    def __init__(self, origin) -> None:
+        self.origin = origin
+        self.rtt = None
+        self.throughput = None
+        self.failures = 0
+
+    @property
+    def score(self):
+        '''
+        Estimated seconds to fetch SCORE_SIZE bytes, infinite if the host wasn't probed.
+        '''
+        if self.rtt is None:
+            return math.inf
+        return self.rtt + (SCORE_SIZE / self.throughput if self.throughput else 0)
+
+class Mirrors:
+    '''
+    Chooses between mirrors serving the same archive. Hosts are probed once per update for round-trip time
+    and throughput, mirrors are tried by fewest failures and then best score, so a failing host is
+    skipped by all later requests. Optionally small requests are hedged: if the best mirror doesn't answer
+    within hedge_delay seconds, the request is sent to the next one as well and the first answer wins.
+    '''
+    _session: aiohttp.ClientSession
+    _hosts: dict[str, HostStats]
+    _probes: dict[str, asyncio.Future]
+    hedge_delay: float | None
+
+    def __init__(self, session, hedge_delay=None) -> None:
+        self._session = session
+        self._hosts = {}
+        self._probes = {}
+        self.hedge_delay = hedge_delay
+
+    def host(self, url):
+        key = origin(url)
+        stats = self._hosts.get(key)
+        if stats is None:
+            stats = self._hosts[key] = HostStats(key)
+        return stats
+
+    def order(self, urls):
+        '''
+        The mirror URLs from best to worst, in their given order while nothing is known about them.
+        '''
+        return sorted(urls, key=lambda url: (self.host(url).failures, self.host(url).score))
+
+    def failed(self, url):
+        self.host(url).failures += 1
+
+    async def probe(self, urls):
+        '''
+        Measure the hosts of the given URLs that weren't measured yet with one small range request each.
+        '''
+        for url in urls:
+            key = origin(url)
+            if key not in self._probes:
+                self._probes[key] = asyncio.ensure_future(self._probe(url))
+        await asyncio.gather(*(self._probes[origin(url)] for url in urls))
+
+    async def _probe(self, url):
+        stats = self.host(url)
+        start = time.perf_counter()
+        try:
+            async with tracing.span("probe mirror", "network", host=stats.origin) as s, \
+                    self._session.get(url, headers={"Range": f"bytes=0-{PROBE_SIZE - 1}"}, timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as response:
+                response.raise_for_status()
+                stats.rtt = time.perf_counter() - start
+                # a server ignoring the range sends the whole archive, only read what was asked for
+                data = await response.content.read(PROBE_SIZE)
+                s.add("bytes", len(data))
+                elapsed = time.perf_counter() - start - stats.rtt
+                stats.throughput = len(data) / elapsed if elapsed > 0 and len(data) > 0 else None
+            logger.debug("Mirror %s: %.0f ms round trip, %s", stats.origin, stats.rtt * 1000,
+                         "%.1f MiB/s" % (stats.throughput / 1024 / 1024) if stats.throughput else "unknown throughput")
+        except Exception as e:
+            stats.failures += 1
+            logger.debug("Failed to probe mirror %s: %s", stats.origin, str(e) or type(e).__name__)
+
+    async def _attempt(self, url, fetch):
+        try:
+            return await fetch(url)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failed(url)
+            raise
+
+    async def hedged(self, urls, fetch):
+        '''
+        Await fetch(url) for the best mirror. With hedging, the next mirror is tried as well once the
+        hedge delay passed or an attempt failed. Returns the first result and cancels the other attempts.
+        '''
+        order = self.order(urls)
+        if self.hedge_delay is None or len(order) == 1:
+            return await self._attempt(order[0], fetch)
+        pending, started, ee = set(), 0, None
+        try:
+            while True:
+                if started < len(order):
+                    if started > 0:
+                        logger.debug("Hedging request to %s", order[started])
+                        tracing.current().add("hedged")
+                    pending.add(asyncio.ensure_future(self._attempt(order[started], fetch)))
+                    started += 1
+                if not pending:
+                    raise ee # type: ignore
+                done, pending = await asyncio.wait(pending, timeout=self.hedge_delay if started < len(order) else None,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    ee = task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
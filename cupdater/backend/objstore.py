@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+from .filedb import fcrc32
+
+
+logger = logging.getLogger(__name__)
+
+OBJECT_STORE_DIRNAME = ".cupd.objects"
+DEFAULT_OBJECT_STORE_LIMIT = 4 * 1024 * 1024 * 1024
+LINK_MODES = ("auto", "hardlink", "reflink", "copy")
+FICLONE = 0x40049409 # linux/fs.h
+
+def _reflink(source, target):
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def link_file(source, target, mode="auto"):
+    '''
+    Make target a file with the contents of source: a hardlink, a copy-on-write clone or a plain copy.
+    "auto" prefers a clone and never hardlinks. Returns the method that was used.
+    '''
+    try:
+        os.unlink(target)
+    except FileNotFoundError:
+        pass
+    upperdirs = os.path.dirname(target)
+    if upperdirs:
+        os.makedirs(upperdirs, exist_ok=True)
+    if mode == "hardlink":
+        try:
+            os.link(source, target)
+            return "hardlink"
+        except OSError:
+            pass
+    if mode in ("auto", "reflink"):
+        try:
+            _reflink(source, target)
+            return "reflink"
+        except OSError:
+            pass
+    shutil.copyfile(source, target)
+    return "copy"
+
+class ObjectStore:
+    '''
+    Keeps the contents of files removed from the installation, keyed by CRC-32 and size, so they
+    can be restored by link or copy instead of being downloaded again, e.g. after switching branches.
+    Every source is verified against its key before it is used.
+    '''
+    _db: object
+    _root: str
+    _link: str
+    _limit: int
+    _workers: int | None
+    _objects: dict[tuple[int, int], float] # (crc, size) -> time the object was added
+
+    def __init__(self, db, root=OBJECT_STORE_DIRNAME, link="auto", limit=DEFAULT_OBJECT_STORE_LIMIT, workers=None) -> None:
+        self._db = db
+        self._root = root
+        self._link = link
+        self._limit = limit
+        self._workers = workers
+        self._objects = {(crc, size): added for crc, size, added in db.get_objects()}
+
+    def path(self, crc, size):
+        return os.path.join(self._root, "%08x-%i" % (crc, size))
+
+    def get(self, crc, size):
+        '''
+        Returns the path of the object with the given key, or None if it isn't stored.
+        '''
+        return self.path(crc, size) if (crc, size) in self._objects else None
+
+    def _restore_one(self, source, target, crc, size):
+        try:
+            if os.path.getsize(source) != size or fcrc32(source) != crc:
+                logger.debug("%s doesn't match the expected contents of %s", source, target)
+                return False
+            link_file(source, target, self._link)
+            return True
+        except OSError as e:
+            logger.debug("Failed to restore %s from %s: %s", target, source, str(e))
+            return False
+
+    async def restore(self, items):
+        '''
+        Materialize (source, target, crc, size) items. Sources are store objects or other local files.
+        Returns the targets that couldn't be restored.
+        '''
+        items = list(items)
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            results = await asyncio.gather(*(asyncio.wrap_future(pool.submit(self._restore_one, *item)) for item in items))
+        failed = [item for item, ok in zip(items, results) if not ok]
+        corrupt = [(crc, size) for source, _, crc, size in failed if source == self.get(crc, size)]
+        if corrupt:
+            await asyncio.to_thread(self._unlink_objects, corrupt)
+            self._forget(corrupt)
+        return [target for _, target, _, _ in failed]
+
+    def _retire_all(self, files):
+        os.makedirs(self._root, exist_ok=True)
+        gone, added = [], {}
+        for path, crc in files:
+            try:
+                size = os.stat(path).st_size
+                if (crc, size) in self._objects or (crc, size) in added or size == 0:
+                    os.unlink(path)
+                else:
+                    os.replace(path, self.path(crc, size))
+                    added[(crc, size)] = time.time()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Failed to remove %s: %s", path, str(e))
+                continue
+            gone.append(path)
+        return gone, added
+
+    async def retire(self, files):
+        '''
+        Move removed files, given as (path, crc), into the store instead of deleting them.
+        Returns the paths that no longer exist.
+        '''
+        gone, added = await asyncio.to_thread(self._retire_all, files)
+        if added:
+            self._objects.update(added)
+            self._db.add_objects([(crc, size, when) for (crc, size), when in added.items()]) # type: ignore
+            logger.debug("Kept %i removed files in the object store", len(added))
+        await self.prune()
+        return gone
+
+    def _unlink_objects(self, keys):
+        for crc, size in keys:
+            try:
+                os.unlink(self.path(crc, size))
+            except FileNotFoundError:
+                pass
+
+    def _forget(self, keys):
+        for key in keys:
+            self._objects.pop(key, None)
+        self._db.delete_objects(keys) # type: ignore
+
+    async def prune(self):
+        '''
+        Remove the oldest objects while the store is larger than its limit.
+        '''
+        total = sum(size for _, size in self._objects)
+        expired = []
+        for key, _ in sorted(self._objects.items(), key=lambda o: o[1]):
+            if total <= self._limit:
+                break
+            expired.append(key)
+            total -= key[1]
+        if expired:
+            logger.debug("Removing %i objects from the object store", len(expired))
+            await asyncio.to_thread(self._unlink_objects, expired)
+            self._forget(expired)
+        return len(expired)
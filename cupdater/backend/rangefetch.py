@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+
+import aiohttp
+
+from .defaults import DEFAULT_RANGE_GAP
+from .throttle import Throttle, UNLIMITED
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+LOCAL_FILE_HEADER = struct.Struct("<4sHHHHHIIIHH")
+LOCAL_FILE_HEADER_SIGNATURE = b"PK\x03\x04"
+
+DEFAULT_MAX_RANGES = 16
+SPOOL_MEMORY_LIMIT = 8 * 1024 * 1024
+
+class RangeNotSupported(Exception):
+    '''
+    The server answered a range request with the whole file. headers are its response headers, if known.
+    '''
+    headers: dict
+
+    def __init__(self, message, headers=None) -> None:
+        super().__init__(message)
+        self.headers = dict(headers) if headers is not None else {}
+
+class MemberSpan:
+    '''
+    A contiguous byte range of the archive covering one or more wanted members.
+    '''
+    start: int
+    end: int # inclusive
+    members: list
+
+    def __init__(self, start, end, members) -> None:
+        self.start = start
+        self.end = end
+        self.members = members
+
+    def __len__(self):
+        return self.end - self.start + 1
+
+def parse_content_range(header):
+    # "bytes 100-199/1000" or "bytes 100-199/*"
+    unit, _, spec = header.strip().partition(" ")
+    if unit != "bytes":
+        raise ValueError("Unsupported Content-Range unit " + unit)
+    span, _, _ = spec.partition("/")
+    start, _, end = span.partition("-")
+    return int(start), int(end)
+
+def resume_validator(headers):
+    '''
+    Pick the validator to send in If-Range when resuming: a strong ETag, or else Last-Modified.
+    '''
+    etag = headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+def member_path(filename, root=os.curdir):
+    '''
+    Sanitize the archive member name the same way ZipFile.extract does.
+    '''
+    arcname = filename.replace("/", os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    invalid_path_parts = ("", os.path.curdir, os.path.pardir)
+    arcname = os.path.sep.join(x for x in arcname.split(os.path.sep) if x not in invalid_path_parts)
+    if os.path.sep == "\\":
+        arcname = zipfile.ZipFile._sanitize_windows_name(arcname, os.path.sep) # type: ignore
+    return os.path.normpath(os.path.join(root, arcname))
+
+def create_target(targetpath):
+    '''
+    Open a file for extracted data. An existing file is unlinked rather than truncated,
+    it may share its inode with an object store entry or another installed file.
+    '''
+    try:
+        os.unlink(targetpath)
+    except FileNotFoundError:
+        pass
+    return open(targetpath, "wb")
+
+def extract_member_at(fileobj, base, info, root=os.curdir):
+    '''
+    Extract a member whose local file header starts at archive offset info.header_offset
+    from a file object holding the archive bytes starting at offset base.
+    '''
+    fileobj.seek(info.header_offset - base)
+    header = fileobj.read(LOCAL_FILE_HEADER.size)
+    if len(header) != LOCAL_FILE_HEADER.size:
+        raise zipfile.BadZipFile("Truncated local file header for " + info.filename)
+    fields = LOCAL_FILE_HEADER.unpack(header)
+    if fields[0] != LOCAL_FILE_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile("Bad local file header magic for " + info.filename)
+    fileobj.seek(fields[9] + fields[10], os.SEEK_CUR)
+    targetpath = member_path(info.filename, root)
+    upperdirs = os.path.dirname(targetpath)
+    if upperdirs:
+        os.makedirs(upperdirs, exist_ok=True)
+    with zipfile.ZipExtFile(fileobj, "r", info) as source, create_target(targetpath) as target:
+        shutil.copyfileobj(source, target)
+    return targetpath
+
+class RangedMemberFetcher:
+    '''
+    Fetches selected members of a remote ZIP archive using coalesced HTTP Range requests.
+    '''
+    _session: aiohttp.ClientSession
+    _url: str
+    _gap: int
+    _multipart: bool
+    _max_ranges: int
+    _concurrency: int
+    _retries: int
+    _throttle: Throttle
+
+    def __init__(self, session, url, gap=DEFAULT_RANGE_GAP, multipart=True, max_ranges=DEFAULT_MAX_RANGES, concurrency=8, retries=5, throttle=None) -> None:
+        self._session = session
+        self._url = url
+        self._gap = gap
+        self._multipart = multipart
+        self._max_ranges = max(1, max_ranges)
+        self._concurrency = max(1, concurrency)
+        self._retries = retries
+        self._throttle = throttle if throttle is not None else UNLIMITED
+
+    def plan(self, members, wanted, end_offset):
+        '''
+        Build the list of byte spans covering the wanted members. Each member occupies the bytes from its
+        header offset up to the next member's header offset (or the central directory for the last one).
+        Neighbouring spans separated by no more than the gap threshold are merged.
+        '''
+        offsets = sorted({m.header_offset for m in members} | {end_offset})
+        next_offset = {a: b for a, b in zip(offsets, offsets[1:])}
+        spans: list[MemberSpan] = []
+        for m in sorted(wanted, key=lambda m: m.header_offset):
+            start, end = m.header_offset, next_offset[m.header_offset] - 1
+            if spans and start - spans[-1].end - 1 <= self._gap:
+                spans[-1].end = max(spans[-1].end, end)
+                spans[-1].members.append(m)
+            else:
+                spans.append(MemberSpan(start, end, [m]))
+        return spans
+
+    def _group(self, spans):
+        if not self._multipart:
+            return [[s] for s in spans]
+        per_request = max(1, min(self._max_ranges, -(-len(spans) // self._concurrency)))
+        return [spans[i:i + per_request] for i in range(0, len(spans), per_request)]
+
+    async def _spool(self, read_chunk, progress):
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT)
+        while chunk := await read_chunk():
+            spool.write(chunk)
+            await self._throttle.received(len(chunk))
+            tracing.current().add("bytes", len(chunk))
+            if progress: progress.update(len(chunk))
+        return spool
+
+    async def _request(self, spans, progress):
+        '''
+        Request the given spans and return the received parts as (start, end, spool) tuples.
+        '''
+        headers = {"Range": "bytes=" + ",".join(f"{s.start}-{s.end}" for s in spans)}
+        parts = []
+        async with self._throttle.request(), tracing.span("range request", "network", ranges=len(spans)), \
+                self._session.get(self._url, headers=headers) as response:
+            response.raise_for_status()
+            if response.status != 206:
+                raise RangeNotSupported("The server doesn't support range requests")
+            try:
+                if response.headers.get("Content-Type", "").startswith("multipart/byteranges"):
+                    reader = aiohttp.MultipartReader.from_response(response)
+                    while (part := await reader.next()) is not None:
+                        start, end = parse_content_range(part.headers["Content-Range"]) # type: ignore
+                        parts.append((start, end, await self._spool(lambda: part.read_chunk(65536), progress))) # type: ignore
+                else:
+                    start, end = parse_content_range(response.headers["Content-Range"])
+                    parts.append((start, end, await self._spool(lambda: response.content.read(65536), progress)))
+            except BaseException:
+                for _, _, spool in parts: spool.close()
+                raise
+        return parts
+
+    def _extract(self, parts, spans):
+        '''
+        Extract the members of every span covered by a received part. Returns the spans that weren't covered.
+        '''
+        missing = []
+        for span in spans:
+            part = next((p for p in parts if p[0] <= span.start and p[1] >= span.end), None)
+            if part is None:
+                missing.append(span)
+                continue
+            for m in span.members:
+                extract_member_at(part[2], part[0], m)
+        return missing
+
+    async def _fetch_group(self, spans, semaphore, progress):
+        ee = None
+        for r in range(self._retries, 0, -1):
+            try:
+                async with semaphore:
+                    parts = await self._request(spans, progress)
+                try:
+                    with tracing.span("extract ranges", "cpu", files=sum(len(s.members) for s in spans)):
+                        missing = await asyncio.to_thread(self._extract, parts, spans)
+                finally:
+                    for _, _, spool in parts: spool.close()
+                break
+            except RangeNotSupported:
+                raise
+            except Exception as e:
+                ee = e
+                tracing.current().add("retries")
+                logger.debug("Failed to fetch %i ranges of %s: %s. %i retries left.", len(spans), self._url, str(e), r-1)
+        else:
+            raise RuntimeError("Failed to fetch ranges of %s after %i retries. Last error was: %s" % (self._url, self._retries, str(ee)))
+        if missing:
+            # server answered a multi-range request with fewer parts, fetch the rest one by one
+            logger.debug("Server returned %i of %i requested ranges, disabling multipart ranges", len(spans) - len(missing), len(spans))
+            self._multipart = False
+            await asyncio.gather(*(self._fetch_group([s], semaphore, progress) for s in missing))
+
+    async def fetch(self, spans, progress=None):
+        '''
+        Download the planned spans concurrently and extract their members into the current directory.
+        '''
+        semaphore = asyncio.Semaphore(self._concurrency)
+        await asyncio.gather(*(self._fetch_group(group, semaphore, progress) for group in self._group(spans)))
@@ -0,0 +1,110 @@
+import asyncio
+import contextlib
+import logging
+
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NETWORK_JOBS = 8
+DEFAULT_DISK_JOBS = 4
+
+class ResourceLimits:
+    '''
+    Caps how many update jobs use the network, decompress archives or write to disk at the same time.
+    Resources are always acquired in the same order, so jobs holding several of them can't deadlock.
+    '''
+    ORDER = ("network", "cpu", "disk")
+    _semaphores: dict[str, asyncio.Semaphore]
+
+    def __init__(self, network=DEFAULT_NETWORK_JOBS, cpu=1, disk=DEFAULT_DISK_JOBS) -> None:
+        self._semaphores = {
+            "network": asyncio.Semaphore(network),
+            "cpu": asyncio.Semaphore(cpu),
+            "disk": asyncio.Semaphore(disk),
+        }
+
+    @contextlib.asynccontextmanager
+    async def use(self, *resources):
+        async with contextlib.AsyncExitStack() as stack:
+            with tracing.span("wait for " + "+".join(r for r in self.ORDER if r in resources), "wait"):
+                for name in self.ORDER:
+                    if name in resources:
+                        await stack.enter_async_context(self._semaphores[name])
+            yield
+
+class ArchiveJob:
+    '''
+    Check, download, extract and track steps for one content archive of a layer.
+    '''
+    layer: str
+    order: int # position of the layer in the branch, later layers override earlier ones
+    url: str
+    directory: object | None # CentralDirectory of the archive, None if it couldn't be read
+    owned: set[str] | None # paths this job extracts, None if unknown
+    after: list["ArchiveJob"] # jobs that have to be finished before this one starts
+    changed: list | None # members to download and extract, None if unknown
+    restored: list[tuple] # (member, local source path, job writing the source or None), restored instead of downloaded
+    checkpointed: bool # completed for the current layer version by an earlier, interrupted update
+    archive: str | None # whole archive downloaded to read its directory, extracted from instead of fetching members
+    task: asyncio.Future | None
+
+    def __init__(self, layer, order, url) -> None:
+        self.layer = layer
+        self.order = order
+        self.url = url
+        self.directory = None
+        self.owned = None
+        self.after = []
+        self.changed = None
+        self.restored = []
+        self.checkpointed = False
+        self.archive = None
+        self.task = None
+
+    def owns(self, path):
+        return self.owned is None or path in self.owned
+
+def resolve_owners(jobs, kept=None):
+    '''
+    Give every path to the job of the last layer containing it, so overlapping archives don't
+    extract the same file twice. kept maps paths of layers that aren't updated to their layer order,
+    such layers keep their files if they come later. Jobs whose members are unknown extract everything
+    and are ordered against all jobs of other layers instead.
+    '''
+    owners = {path: (order, None) for path, order in (kept or {}).items()}
+    for job in sorted(jobs, key=lambda j: j.order):
+        if job.directory is None:
+            continue
+        job.owned = set()
+        for m in job.directory.members: # type: ignore
+            if m.is_dir():
+                continue
+            current = owners.get(m.filename)
+            if current is None or current[0] <= job.order:
+                owners[m.filename] = (job.order, job)
+    for path, (_, job) in owners.items():
+        if job is not None:
+            job.owned.add(path)
+    for job in jobs:
+        job.after = [other for other in jobs if other.order < job.order and (job.owned is None or other.owned is None)]
+
+async def run_jobs(jobs, run):
+    '''
+    Run all jobs concurrently, each one as soon as the jobs it depends on are finished.
+    '''
+    async def start(job):
+        if job.after:
+            await asyncio.gather(*(other.task for other in job.after))
+        await run(job)
+    for job in jobs:
+        job.task = asyncio.ensure_future(start(job))
+    tasks = [job.task for job in jobs]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+
+import aiohttp
+
+from .defaults import DEFAULT_SEGMENT_SIZE, DEFAULT_SEGMENT_CONNECTIONS
+from .rangefetch import parse_content_range, resume_validator
+from .throttle import Throttle, UNLIMITED
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+YIELD_CHUNK_SIZE = 1024 * 1024
+
+class Download:
+    '''
+    A download of a whole file, optionally continuing at offset, that yields its bytes in order.
+    The first request asks for a single segment. If the server honours it, the rest of the file is
+    fetched as further segments over up to connections parallel requests and reassembled in order.
+    Otherwise the response to the first request is used as a plain stream.
+    If the expected size is known, a partial download can be continued without a validator, e.g.
+    from another mirror, and a response for a file of a different size is rejected.
+    '''
+    _session: aiohttp.ClientSession
+    _url: str
+    _segment_size: int
+    _connections: int
+    _retries: int
+    _response: aiohttp.ClientResponse | None
+    _tasks: list[asyncio.Task]
+    _end: int # end of the data covered by the first response, exclusive
+    _expected_size: int | None
+    _throttle: Throttle
+    _holding: bool # whether the first (or rest) response holds a request slot of the throttle
+    size: int | None
+    offset: int # where the yielded data starts
+    validator: str | None
+
+    def __init__(self, session, url, offset=0, validator=None, segment_size=DEFAULT_SEGMENT_SIZE, connections=DEFAULT_SEGMENT_CONNECTIONS, retries=5, size=None, throttle=None) -> None:
+        self._session = session
+        self._url = url
+        self._segment_size = segment_size
+        self._connections = connections
+        self._retries = retries
+        self._response = None
+        self._tasks = []
+        self._end = 0
+        self._expected_size = size
+        self._throttle = throttle if throttle is not None else UNLIMITED
+        self._holding = False
+        self.size = None
+        self.offset = offset
+        self.validator = validator
+
+    @property
+    def segmented(self):
+        return self._connections > 1
+
+    async def __aenter__(self):
+        if self.offset > 0 and self.validator is None and self._expected_size is None:
+            # can't make sure the partial data belongs to the same file
+            self.offset = 0
+        headers = {}
+        if self.segmented:
+            headers["Range"] = f"bytes={self.offset}-{self.offset + self._segment_size - 1}"
+        elif self.offset > 0:
+            headers["Range"] = f"bytes={self.offset}-"
+        if self.offset > 0 and self.validator is not None:
+            headers["If-Range"] = self.validator
+        await self._hold()
+        try:
+            self._response = response = await self._session.get(self._url, headers=headers)
+        except BaseException as e:
+            self._release(e)
+            raise
+        try:
+            response.raise_for_status()
+            self.validator = resume_validator(response.headers)
+            if response.status == 206:
+                start, end = parse_content_range(response.headers["Content-Range"])
+                total = response.headers["Content-Range"].rpartition("/")[-1]
+                self.size = int(total) if total != "*" else None
+                if start != self.offset:
+                    raise aiohttp.ClientPayloadError("Server returned range starting at %i instead of %i" % (start, self.offset))
+                self.offset = start
+                self._end = end + 1
+            else:
+                self.offset = 0
+                self.size = int(response.headers.get("content-length", 0)) or None
+                self._end = self.size if self.size is not None else 0
+            if self._expected_size is not None and self.size is not None and self.size != self._expected_size:
+                raise aiohttp.ClientPayloadError("%s has %i bytes instead of %i" % (self._url, self.size, self._expected_size))
+        except BaseException as e:
+            response.release()
+            self._release(e)
+            raise
+        return self
+
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        tasks = [t for t in self._tasks if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._response is not None:
+            self._response.release()
+        self._release(exception_value)
+
+    async def _hold(self):
+        await self._throttle.acquire()
+        self._holding = True
+
+    def _release(self, exception=None):
+        if self._holding:
+            self._holding = False
+            self._throttle.release(isinstance(exception, (aiohttp.ClientError, asyncio.TimeoutError)))
+
+    async def _fetch_segment(self, start, end, semaphore):
+        ee = None
+        for r in range(self._retries, 0, -1):
+            try:
+                async with semaphore, self._throttle.request(), tracing.span("segment", "network") as s, \
+                        self._session.get(self._url, headers={"Range": f"bytes={start}-{end}", "If-Range": self.validator}) as response: # type: ignore
+                    response.raise_for_status()
+                    if response.status != 206 or parse_content_range(response.headers["Content-Range"]) != (start, end):
+                        raise ValueError("File changed while downloading it")
+                    data = bytearray()
+                    async for chunk in response.content.iter_chunked(65536):
+                        data += chunk
+                        await self._throttle.received(len(chunk))
+                    data = bytes(data)
+                    s.add("bytes", len(data))
+                    if len(data) != end - start + 1:
+                        raise aiohttp.ClientPayloadError("Segment ended after %i of %i bytes" % (len(data), end - start + 1))
+                    return data
+            except ValueError:
+                raise
+            except Exception as e:
+                ee = e
+                tracing.current().add("retries")
+                logger.debug("Failed to download bytes %i-%i of %s: %s. %i retries left.", start, end, self._url, str(e), r-1)
+        raise ee # type: ignore
+
+    async def iter_chunks(self):
+        assert self._response is not None
+        segments = []
+        rest = self._response.status == 206 and self.size is not None and self._end < self.size
+        if rest and self.validator is not None:
+            segments = [(s, min(s + self._segment_size, self.size) - 1) for s in range(self._end, self.size, self._segment_size)] # type: ignore
+            rest = False
+        ahead = max(1, self._connections - 1)
+        semaphore = asyncio.Semaphore(ahead)
+        # prefetch while the first response is being streamed
+        self._tasks = [asyncio.ensure_future(self._fetch_segment(s, e, semaphore)) for s, e in segments[:ahead]]
+        async for chunk in self._response.content.iter_chunked(65536):
+            await self._throttle.received(len(chunk))
+            yield chunk
+        self._release()
+        if rest:
+            logger.debug("%s has no validator, downloading the rest over one connection", self._url)
+            self._response.release()
+            await self._hold()
+            self._response = await self._session.get(self._url, headers={"Range": f"bytes={self._end}-"})
+            self._response.raise_for_status()
+            skip = 0
+            if self._response.status != 206 or parse_content_range(self._response.headers["Content-Range"])[0] != self._end:
+                # the body isn't the rest of the file, get all of it and drop what was already yielded
+                logger.debug("%s didn't return the rest of the file, downloading it over a single stream", self._url)
+                self._response.release()
+                self._response = await self._session.get(self._url)
+                self._response.raise_for_status()
+                if self._response.content_length is not None and self._response.content_length != self.size:
+                    raise aiohttp.ClientPayloadError("%s has %i bytes instead of %i" % (self._url, self._response.content_length, self.size))
+                skip = self._end
+            async for chunk in self._response.content.iter_chunked(65536):
+                await self._throttle.received(len(chunk))
+                if skip > 0:
+                    dropped = min(skip, len(chunk))
+                    chunk, skip = chunk[dropped:], skip - dropped
+                    if not chunk:
+                        continue
+                yield chunk
+            self._release()
+        for i in range(len(segments)):
+            if i + ahead < len(segments):
+                s, e = segments[i + ahead]
+                self._tasks.append(asyncio.ensure_future(self._fetch_segment(s, e, semaphore)))
+            data = await self._tasks[i]
+            self._tasks[i] = None # type: ignore # let the segment be freed once yielded
+            for pos in range(0, len(data), YIELD_CHUNK_SIZE):
+                yield data[pos:pos + YIELD_CHUNK_SIZE]
@@ -0,0 +1,67 @@
+import os
+import urllib.parse
+import urllib.request
+
+
+def file_url_path(url):
+    '''
+    Local path of a file:// URL, None for other URLs.
+    '''
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme != "file":
+        return None
+    return urllib.request.url2pathname(parts.path)
+
+class ContentSource:
+    '''
+    A place to get layer archives from before asking their origin, like a network share or a LAN cache.
+    Either method returns None for archives the source doesn't have.
+    '''
+    def local_path(self, url) -> str | None:
+        '''
+        Path of a local copy of the archive at url, used if it matches the archive's central directory.
+        '''
+        return None
+
+    def fetch_url(self, url, directory) -> str | None:
+        '''
+        URL serving the archive at url, tried before the archive's mirrors. directory is its CentralDirectory, if known.
+        '''
+        return None
+
+class LocalFileSource(ContentSource):
+    '''
+    Archives listed with file:// URLs in the manifest.
+    '''
+    def local_path(self, url):
+        return file_url_path(url)
+
+class DirectorySource(ContentSource):
+    '''
+    A directory or mounted share holding copies of archives under the file names of their URLs.
+    '''
+    root: str
+
+    def __init__(self, root) -> None:
+        self.root = root
+
+    def local_path(self, url):
+        name = urllib.parse.unquote(urllib.parse.urlsplit(url).path.rpartition("/")[-1])
+        return os.path.join(self.root, name) if name else None
+
+class CacheServerSource(ContentSource):
+    '''
+    A cache server (python -m cupdater.cacheserver) on the LAN, which serves archives it has stored
+    and passes other requests through to their origin while storing the archive.
+    '''
+    base_url: str
+
+    def __init__(self, base_url) -> None:
+        self.base_url = base_url.rstrip("/")
+
+    def fetch_url(self, url, directory):
+        query = {"url": url}
+        if directory is not None and directory.etag is not None:
+            # lets the cache skip asking the origin whether its copy is current
+            query["etag"] = directory.etag
+        return f"{self.base_url}/archive?{urllib.parse.urlencode(query)}"
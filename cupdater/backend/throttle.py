@@ -0,0 +1,184 @@
+import asyncio
+import contextlib
+import logging
+import time
+
+import aiohttp
+
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+# the controller looks at throughput and errors of this many seconds at a time
+ADJUST_INTERVAL = 0.5
+INITIAL_REQUESTS = 4
+# multiplicative decrease on errors or collapsing throughput
+DECREASE_FACTOR = 0.5
+# share of failed requests in an interval that counts as congestion, fewer are taken as noise
+MAX_ERROR_RATE = 0.1
+# throughput may vary by this share between intervals without counting as congestion
+THROUGHPUT_TOLERANCE = 0.3
+# bytes that may be received at once after the bandwidth wasn't used for a while, in seconds of the rate
+BURST_SECONDS = 0.25
+MIN_BURST = 64 * 1024
+
+class TokenBucket:
+    '''
+    Paces bytes received by all downloads together to a rate in bytes per second.
+    '''
+    rate: float
+    burst: float
+    _tokens: float
+    _updated: float
+    _lock: asyncio.Lock
+
+    def __init__(self, rate, burst=None) -> None:
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate * BURST_SECONDS, MIN_BURST)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def consume(self, count):
+        # waiting under the lock makes later streams queue behind this one instead of all sleeping at once
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= count
+            if self._tokens < 0:
+                with tracing.span("wait for bandwidth", "wait"):
+                    await asyncio.sleep(-self._tokens / self.rate)
+
+class AdaptiveConcurrency:
+    '''
+    Limits the number of requests in flight and adjusts the limit AIMD-style. Every interval in which
+    too many requests failed, or throughput dropped while all slots were used, halves the limit. Otherwise an
+    interval using all slots raises it, doubling at first like TCP slow start and by one after the first decrease.
+    '''
+    limit: int
+    minimum: int
+    maximum: int
+    _in_flight: int
+    _waiters: list[asyncio.Future]
+    _window_start: float
+    _bytes: int
+    _failures: int
+    _completed: int
+    _saturated: bool
+    _previous: float | None # throughput of the previous interval that used all slots
+    _slow_start: bool
+
+    def __init__(self, maximum, initial=INITIAL_REQUESTS, minimum=1) -> None:
+        self.maximum = max(1, maximum)
+        self.minimum = min(max(1, minimum), self.maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self._in_flight = 0
+        self._waiters = []
+        self._window_start = time.monotonic()
+        self._bytes = 0
+        self._failures = 0
+        self._completed = 0
+        self._saturated = False
+        self._previous = None
+        self._slow_start = True
+
+    async def acquire(self):
+        self._adjust()
+        if self._in_flight >= self.limit:
+            with tracing.span("wait for connection", "wait"):
+                while self._in_flight >= self.limit:
+                    waiter = asyncio.get_running_loop().create_future()
+                    self._waiters.append(waiter)
+                    try:
+                        await waiter
+                    except BaseException:
+                        self._waiters.remove(waiter)
+                        self._wake() # a slot handed to this task would be lost otherwise
+                        raise
+                    self._waiters.remove(waiter)
+        self._in_flight += 1
+        if self._in_flight >= self.limit:
+            self._saturated = True
+
+    def release(self, failed=False):
+        self._in_flight -= 1
+        self._completed += 1
+        if failed:
+            self._failures += 1
+        self._adjust()
+        self._wake()
+
+    def _wake(self):
+        for waiter in self._waiters[:max(0, self.limit - self._in_flight)]:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def received(self, count):
+        self._bytes += count
+
+    def _adjust(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < ADJUST_INTERVAL:
+            return
+        throughput = self._bytes / elapsed
+        limit = self.limit
+        if self._failures > self._completed * MAX_ERROR_RATE or (self._saturated and self._previous is not None and throughput < self._previous * (1 - THROUGHPUT_TOLERANCE)):
+            self.limit = max(self.minimum, int(self.limit * DECREASE_FACTOR))
+            self._slow_start = False
+            self._previous = None
+        elif self._saturated:
+            self.limit = min(self.maximum, self.limit * 2 if self._slow_start else self.limit + 1)
+            self._previous = throughput
+        if self.limit != limit:
+            logger.debug("Concurrent requests %i -> %i at %.1f MiB/s with %i of %i requests failed", limit, self.limit, throughput / 1024 / 1024, self._failures, self._completed)
+        self._window_start = now
+        self._bytes = 0
+        self._failures = 0
+        self._completed = 0
+        self._saturated = self._in_flight >= self.limit
+
+class Throttle:
+    '''
+    Shared by all archive downloads: every request takes a slot of the adaptive concurrency limit and
+    received bytes are paced by the bandwidth limit. Without limits it does nothing.
+    '''
+    concurrency: AdaptiveConcurrency | None
+    bandwidth: TokenBucket | None
+
+    def __init__(self, max_requests=None, bandwidth=0) -> None:
+        self.concurrency = AdaptiveConcurrency(max_requests) if max_requests else None
+        self.bandwidth = TokenBucket(bandwidth) if bandwidth else None
+
+    async def acquire(self):
+        if self.concurrency is not None:
+            await self.concurrency.acquire()
+
+    def release(self, failed=False):
+        if self.concurrency is not None:
+            self.concurrency.release(failed)
+
+    @contextlib.asynccontextmanager
+    async def request(self):
+        '''
+        Hold a request slot, an error from the server or the connection counts as a sign of congestion.
+        '''
+        await self.acquire()
+        failed = False
+        try:
+            yield
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            failed = True
+            raise
+        finally:
+            self.release(failed)
+
+    async def received(self, count):
+        if self.concurrency is not None:
+            self.concurrency.received(count)
+        if self.bandwidth is not None:
+            await self.bandwidth.consume(count)
+
+UNLIMITED = Throttle()
@@ -0,0 +1,234 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import weakref
+
+
+# what a span mostly waits for, "wait" is time spent queueing for a resource limit
+CATEGORIES = ("network", "disk", "cpu", "wait", "other")
+# span arguments summed up in the summary
+SUMMARY_COUNTERS = ("bytes", "files", "retries")
+
+class Span:
+    '''
+    A timed section of an update with counters like bytes or files. Also usable as a context manager.
+    '''
+    __slots__ = ("name", "category", "track", "start", "end", "args", "_tracer", "_token")
+    name: str
+    category: str
+    track: int
+    start: int # nanoseconds since the tracer started
+    end: int | None
+    args: dict
+
+    def __init__(self, tracer, name, category, track, args) -> None:
+        self.name = name
+        self.category = category
+        self.track = track
+        self.start = 0
+        self.end = None
+        self.args = args
+        self._tracer = tracer
+        self._token = None
+
+    def add(self, key, value=1):
+        self.args[key] = self.args.get(key, 0) + value
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = self._tracer.now()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.end = self._tracer.now()
+        _current.reset(self._token) # type: ignore
+        if exception_type is not None:
+            self.args["error"] = exception_type.__name__
+        self._tracer.record(self)
+
+    # usable next to async context managers in the same async with
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        return self.__exit__(exception_type, exception_value, exception_traceback)
+
+    @property
+    def duration(self):
+        return (self.end - self.start) if self.end is not None else 0
+
+class _NullSpan:
+    '''
+    Stands in for spans while tracing is off, so instrumented code doesn't have to check.
+    '''
+    def add(self, key, value=1):
+        pass
+    def set(self, **args):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        pass
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        pass
+
+NULL_SPAN = _NullSpan()
+_current: contextvars.ContextVar[Span | _NullSpan] = contextvars.ContextVar("cupdater_span", default=NULL_SPAN)
+
+def _busy_time(spans):
+    '''
+    Nanoseconds in which at least one of the spans was running.
+    '''
+    busy, until = 0, None
+    for start, end in sorted((s.start, s.end) for s in spans):
+        if until is None or start > until:
+            busy += end - start
+            until = end
+        elif end > until:
+            busy += end - until
+            until = end
+    return busy
+
+class Tracer:
+    '''
+    Collects the spans of an update. Spans on the event loop are put on a track per asyncio task,
+    spans on worker threads on a track per thread, so every track nests properly in trace viewers.
+    '''
+    spans: list[Span]
+    _origin: int
+    _lock: threading.Lock
+    _tracks: dict[object, int]
+    _task_tracks: weakref.WeakKeyDictionary
+    _track_names: dict[int, str]
+
+    def __init__(self) -> None:
+        self.spans = []
+        self._origin = time.perf_counter_ns()
+        self._lock = threading.Lock()
+        self._tracks = {}
+        self._task_tracks = weakref.WeakKeyDictionary()
+        self._track_names = {}
+
+    def now(self):
+        return time.perf_counter_ns() - self._origin
+
+    def _new_track(self, name):
+        track = len(self._track_names) + 1
+        self._track_names[track] = name
+        return track
+
+    def _track(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError: # no event loop in this thread
+            task = None
+        with self._lock:
+            if task is not None:
+                track = self._task_tracks.get(task)
+                if track is None:
+                    track = self._task_tracks[task] = self._new_track(task.get_name())
+                return track
+            thread = threading.get_ident()
+            track = self._tracks.get(thread)
+            if track is None:
+                track = self._tracks[thread] = self._new_track(threading.current_thread().name)
+            return track
+
+    def span(self, name, category="other", **args):
+        return Span(self, name, category, self._track(), args)
+
+    def record(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def chrome_trace(self):
+        '''
+        The spans in the Chrome trace event format, which Perfetto and chrome://tracing open.
+        '''
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": track, "args": {"name": name}} for track, name in self._track_names.items()]
+        for s in self.spans:
+            events.append({"name": s.name, "cat": s.category, "ph": "X", "pid": pid, "tid": s.track,
+                           "ts": s.start / 1000, "dur": s.duration / 1000, "args": s.args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self):
+        '''
+        Lines of a table with the count, time and counters of every span name, followed by how long
+        network, disk and CPU work was running during the traced time.
+        '''
+        rows = {}
+        for s in self.spans:
+            row = rows.setdefault((s.category, s.name), {"count": 0, "time": 0, **{c: 0 for c in SUMMARY_COUNTERS}})
+            row["count"] += 1
+            row["time"] += s.duration
+            for c in SUMMARY_COUNTERS:
+                value = s.args.get(c, 0)
+                row[c] += value if isinstance(value, (int, float)) else 0
+        lines = ["%-8s %-28s %7s %10s %12s %8s %8s" % ("category", "span", "count", "time (s)", "bytes", "files", "retries")]
+        for (category, name), row in sorted(rows.items(), key=lambda r: (CATEGORIES.index(r[0][0]) if r[0][0] in CATEGORIES else len(CATEGORIES), -r[1]["time"])):
+            lines.append("%-8s %-28s %7i %10.3f %12i %8i %8i" % (category, name, row["count"], row["time"] / 1e9, row["bytes"], row["files"], row["retries"]))
+        wall = max((s.end for s in self.spans if s.end is not None), default=0)
+        if wall > 0:
+            busy = {c: _busy_time([s for s in self.spans if s.category == c and s.end is not None]) for c in CATEGORIES[:4]}
+            lines.append("Busy during %.3f s: " % (wall / 1e9) + ", ".join("%s %.3f s (%i%%)" % (c, t / 1e9, 100 * t // wall) for c, t in busy.items()))
+            bound = max(CATEGORIES[:3], key=lambda c: busy[c])
+            if busy[bound] > 0:
+                lines.append(f"Mostly {bound}-bound")
+        return lines
+
+_active: Tracer | None = None
+
+def enable():
+    '''
+    Start tracing spans of this process. Returns the tracer.
+    '''
+    global _active
+    _active = Tracer()
+    return _active
+
+def span(name, category="other", **args):
+    '''
+    A span to be used as a context manager, or a no-op if tracing isn't enabled.
+    '''
+    if _active is None:
+        return NULL_SPAN
+    return _active.span(name, category, **args)
+
+def current():
+    '''
+    The innermost running span of this task or thread, to add counters to.
+    '''
+    return _current.get()
+
+def traced(name, category="other"):
+    '''
+    Decorator running every call of a function or coroutine function in a span.
+    '''
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, category):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
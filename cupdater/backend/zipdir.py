@@ -0,0 +1,311 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from typing import NamedTuple
+
+import aiohttp
+
+from .rangefetch import RangeNotSupported, parse_content_range
+
+
+logger = logging.getLogger(__name__)
+
+# layouts follow zipfile's structEndArchive, structEndArchive64Locator, structEndArchive64 and structCentralDir
+END_OF_CENTRAL_DIR = struct.Struct("<4s4H2LH")
+END_OF_CENTRAL_DIR_SIGNATURE = b"PK\x05\x06"
+ZIP64_END_OF_CENTRAL_DIR_LOCATOR = struct.Struct("<4sLQL")
+ZIP64_END_OF_CENTRAL_DIR_LOCATOR_SIGNATURE = b"PK\x06\x07"
+ZIP64_END_OF_CENTRAL_DIR = struct.Struct("<4sQ2H2L4Q")
+ZIP64_END_OF_CENTRAL_DIR_SIGNATURE = b"PK\x06\x06"
+CENTRAL_DIR_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+CENTRAL_DIR_HEADER_SIGNATURE = b"PK\x01\x02"
+
+ZIP64_EXTRA_TAG = 0x0001
+UTF8_FLAG = 0x800
+MAX_COMMENT_SIZE = 0xFFFF
+DEFAULT_TAIL_SIZE = 64 * 1024
+
+class ZipMember(NamedTuple):
+    '''
+    Central directory entry of an archive member. Field names match zipfile.ZipInfo
+    so members can be passed to zipfile.ZipExtFile directly.
+    '''
+    filename: str
+    CRC: int
+    compress_size: int
+    file_size: int
+    header_offset: int
+    compress_type: int
+    flag_bits: int
+
+    def is_dir(self):
+        return self.filename.endswith("/")
+
+class CentralDirectory:
+    url: str
+    size: int
+    cd_offset: int # absolute offset of the central directory in the archive
+    cd_size: int
+    members: list[ZipMember]
+    etag: str | None
+    last_modified: str | None
+    checked: float # when the directory was last known to match the remote archive
+
+    def __init__(self, url, size, cd_offset, cd_size, members, etag=None, last_modified=None, checked=None) -> None:
+        self.url = url
+        self.size = size
+        self.cd_offset = cd_offset
+        self.cd_size = cd_size
+        self.members = members
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked = checked if checked is not None else time.time()
+
+    def same_archive(self, other):
+        '''
+        Whether other describes the same archive, e.g. a copy of it in another place.
+        '''
+        return self.size == other.size and self.cd_offset == other.cd_offset and self.members == other.members
+
+    def has_validator(self):
+        return self.etag is not None or self.last_modified is not None
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag is not None: headers["If-None-Match"] = self.etag
+        if self.last_modified is not None: headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_row(self):
+        members = zlib.compress(json.dumps([list(m) for m in self.members], separators=(",", ":")).encode("utf-8"))
+        return (self.url, self.etag, self.last_modified, self.size, self.cd_offset, self.cd_size, self.checked, members)
+
+    @classmethod
+    def from_row(cls, row):
+        url, etag, last_modified, size, cd_offset, cd_size, checked, members = row
+        members = [ZipMember(*m) for m in json.loads(zlib.decompress(members))]
+        return cls(url, size, cd_offset, cd_size, members, etag, last_modified, checked)
+
+def parse_zip64_extra(extra, file_size, compress_size, header_offset):
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, length = struct.unpack_from("<HH", extra, pos)
+        if tag == ZIP64_EXTRA_TAG:
+            values = iter(struct.unpack_from("<%iQ" % (length // 8), extra, pos + 4))
+            if file_size == 0xFFFFFFFF: file_size = next(values)
+            if compress_size == 0xFFFFFFFF: compress_size = next(values)
+            if header_offset == 0xFFFFFFFF: header_offset = next(values)
+            break
+        pos += 4 + length
+    return file_size, compress_size, header_offset
+
+def parse_central_directory(data, count, concat=0):
+    '''
+    Parse raw central directory records into ZipMember tuples. If count is None,
+    records are parsed until the data doesn't start with another central directory header.
+    concat is the size of any data prepended to the archive, added to every header offset.
+    '''
+    members = []
+    pos = 0
+    while len(members) != count:
+        if count is None and data[pos:pos + 4] != CENTRAL_DIR_HEADER_SIGNATURE:
+            break
+        fields = CENTRAL_DIR_HEADER.unpack_from(data, pos)
+        if fields[0] != CENTRAL_DIR_HEADER_SIGNATURE:
+            raise ValueError("Bad magic number for central directory")
+        flag_bits, compress_type = fields[5], fields[6]
+        crc, compress_size, file_size = fields[9], fields[10], fields[11]
+        name_length, extra_length, comment_length = fields[12], fields[13], fields[14]
+        header_offset = fields[18]
+        pos += CENTRAL_DIR_HEADER.size
+        name = data[pos:pos + name_length]
+        filename = name.decode("utf-8") if flag_bits & UTF8_FLAG else name.decode("cp437")
+        pos += name_length
+        if 0xFFFFFFFF in (file_size, compress_size, header_offset):
+            file_size, compress_size, header_offset = parse_zip64_extra(data[pos:pos + extra_length], file_size, compress_size, header_offset)
+        pos += extra_length + comment_length
+        members.append(ZipMember(filename, crc, compress_size, file_size, header_offset + concat, compress_type, flag_bits))
+    return members
+
+def _find_end_record(tail):
+    pos = len(tail)
+    while (pos := tail.rfind(END_OF_CENTRAL_DIR_SIGNATURE, max(0, len(tail) - MAX_COMMENT_SIZE - END_OF_CENTRAL_DIR.size), pos)) != -1:
+        if pos + END_OF_CENTRAL_DIR.size <= len(tail):
+            comment_length = END_OF_CENTRAL_DIR.unpack_from(tail, pos)[7]
+            if pos + END_OF_CENTRAL_DIR.size + comment_length == len(tail):
+                return pos
+    raise ValueError("File is not a zip file")
+
+class _RangeReader:
+    '''
+    Issues range requests against a single URL and remembers the validators of the first response.
+    '''
+    _session: aiohttp.ClientSession
+    _url: str
+    _headers: dict
+    size: int | None
+    etag: str | None
+    last_modified: str | None
+    requests: int
+
+    def __init__(self, session, url, headers=None) -> None:
+        self._session = session
+        self._url = url
+        self._headers = headers if headers else {}
+        self.size = None
+        self.etag = None
+        self.last_modified = None
+        self.requests = 0
+
+    def _remember(self, response):
+        if self.etag is None: self.etag = response.headers.get("ETag")
+        if self.last_modified is None: self.last_modified = response.headers.get("Last-Modified")
+
+    async def _head_size(self):
+        self.requests += 1
+        async with self._session.head(self._url, headers=self._headers, allow_redirects=True) as response:
+            response.raise_for_status()
+            self._remember(response)
+            return int(response.headers["Content-Length"])
+
+    async def tail(self, length, conditional=None):
+        '''
+        Fetch the last length bytes of the file. Returns (absolute offset, data),
+        or None if the conditional headers matched and the server replied 304 Not Modified.
+        '''
+        self.requests += 1
+        async with self._session.get(self._url, headers={**self._headers, **(conditional or {}), "Range": f"bytes=-{length}"}) as response:
+            if response.status == 304:
+                return None
+            if response.status != 416:
+                response.raise_for_status()
+            self._remember(response)
+            if response.status == 206:
+                start, _ = parse_content_range(response.headers["Content-Range"])
+                self.size = int(response.headers["Content-Range"].rpartition("/")[-1])
+                return start, await response.read()
+            content_length = response.headers.get("Content-Length")
+            if response.status == 200:
+                if content_length is not None and int(content_length) <= length:
+                    data = await response.read()
+                    self.size = len(data)
+                    return 0, data
+                # the server ignores ranges, don't download the whole archive by accident
+                response.close()
+                raise RangeNotSupported("The server doesn't support range requests", response.headers)
+            # suffix ranges aren't supported
+            response.close()
+            self.size = await self._head_size()
+        start = max(0, self.size - length)
+        return start, await self.range(start, self.size - 1)
+
+    async def range(self, start, end):
+        self.requests += 1
+        async with self._session.get(self._url, headers={**self._headers, "Range": f"bytes={start}-{end}"}) as response:
+            response.raise_for_status()
+            self._remember(response)
+            if response.status != 206:
+                response.close()
+                raise RangeNotSupported("The server doesn't support range requests", response.headers)
+            rstart, rend = parse_content_range(response.headers["Content-Range"])
+            data = await response.read()
+            if rstart != start or rend != end or len(data) != end - start + 1:
+                raise ValueError("The server returned an unexpected range")
+            return data
+
+class _FileReader:
+    '''
+    Reads parts of a local archive, e.g. on a network share, with the interface of _RangeReader.
+    '''
+    _path: str
+    size: int
+    etag: None
+    last_modified: None
+    requests: int
+
+    def __init__(self, path) -> None:
+        self._path = path
+        self.size = os.path.getsize(path)
+        self.etag = None
+        self.last_modified = None
+        self.requests = 0
+
+    def _read(self, start, length):
+        with open(self._path, "rb") as f:
+            f.seek(start)
+            return f.read(length)
+
+    async def tail(self, length, conditional=None):
+        self.requests += 1
+        start = max(0, self.size - length)
+        return start, await asyncio.to_thread(self._read, start, self.size - start)
+
+    async def range(self, start, end):
+        self.requests += 1
+        data = await asyncio.to_thread(self._read, start, end - start + 1)
+        if len(data) != end - start + 1:
+            raise ValueError("The file ended unexpectedly")
+        return data
+
+async def read_central_directory(session, url, tail_size=DEFAULT_TAIL_SIZE, cached=None):
+    '''
+    Read the central directory of a remote archive using as few range requests as possible:
+    a speculative suffix request for the end of the file, and one more request only if the
+    central directory (or the Zip64 end record) doesn't fit into it.
+    If a cached CentralDirectory with validators is given, the suffix request is made conditional
+    and the cached directory is returned as-is when the archive wasn't modified.
+    '''
+    return await _read_central_directory(_RangeReader(session, url), url, tail_size, cached)
+
+async def read_local_central_directory(path, url, tail_size=DEFAULT_TAIL_SIZE):
+    '''
+    Read the central directory of a local archive that is a copy of the archive at url.
+    '''
+    return await _read_central_directory(_FileReader(path), url, tail_size)
+
+async def _read_central_directory(reader, url, tail_size=DEFAULT_TAIL_SIZE, cached=None):
+    conditional = None
+    if cached is not None and cached.has_validator():
+        conditional = cached.conditional_headers()
+        # the directory rarely changes size much, so try to get all of it in one go
+        tail_size = max(tail_size, cached.size - cached.cd_offset + 1024)
+    tail = await reader.tail(tail_size, conditional)
+    if tail is None:
+        logger.debug("Cached central directory of %s is still valid", url)
+        assert cached is not None
+        cached.checked = time.time()
+        return cached
+    data_start, data = tail
+    size = reader.size
+    assert size is not None
+    eocd_pos = _find_end_record(data)
+    _, disk, _, _, count, cd_size, cd_offset, _ = END_OF_CENTRAL_DIR.unpack_from(data, eocd_pos)
+    end_record_start = data_start + eocd_pos
+    locator_pos = eocd_pos - ZIP64_END_OF_CENTRAL_DIR_LOCATOR.size
+    if locator_pos >= 0 and data[locator_pos:locator_pos + 4] == ZIP64_END_OF_CENTRAL_DIR_LOCATOR_SIGNATURE:
+        _, _, zip64_offset, _ = ZIP64_END_OF_CENTRAL_DIR_LOCATOR.unpack_from(data, locator_pos)
+        zip64_start = data_start + locator_pos - ZIP64_END_OF_CENTRAL_DIR.size
+        if zip64_start < data_start:
+            data = await reader.range(zip64_start, data_start - 1) + data
+            data_start = zip64_start
+        fields = ZIP64_END_OF_CENTRAL_DIR.unpack_from(data, zip64_start - data_start)
+        if fields[0] != ZIP64_END_OF_CENTRAL_DIR_SIGNATURE:
+            raise ValueError("Corrupt Zip64 end of central directory record")
+        count, cd_size, cd_offset = fields[7], fields[8], fields[9]
+        end_record_start = zip64_start
+    elif disk != 0:
+        raise ValueError("Multi-disk archives are not supported")
+    cd_start = end_record_start - cd_size
+    if cd_start < 0:
+        raise ValueError("Bad offset for central directory")
+    if cd_start < data_start:
+        logger.debug("Central directory of %s doesn't fit into the first %i bytes, fetching %i more", url, tail_size, data_start - cd_start)
+        data = await reader.range(cd_start, data_start - 1) + data
+        data_start = cd_start
+    members = parse_central_directory(data[cd_start - data_start:cd_start - data_start + cd_size], count, concat=cd_start - cd_offset)
+    logger.debug("Read %i members of %s in %i requests", len(members), url, reader.requests)
+    return CentralDirectory(url, size, cd_start, cd_size, members, reader.etag, reader.last_modified)
@@ -0,0 +1,284 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import struct
+import threading
+import zipfile
+import zlib
+
+from . import tracing
+from .rangefetch import LOCAL_FILE_HEADER, LOCAL_FILE_HEADER_SIGNATURE, create_target, member_path
+from .zipdir import CENTRAL_DIR_HEADER_SIGNATURE, UTF8_FLAG, ZIP64_EXTRA_TAG, parse_central_directory, parse_zip64_extra
+
+
+logger = logging.getLogger(__name__)
+
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+ENCRYPTED_FLAG = 0x01
+DATA_DESCRIPTOR_FLAG = 0x08
+STREAM_BUFFER_LIMIT = 16 * 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+
+class StreamingNotSupported(Exception):
+    pass
+
+class StreamState:
+    '''
+    Progress of a streamed extraction, kept across attempts so a failed download can be
+    continued with a range request starting at the first member that wasn't extracted completely.
+    completed lists the same members as extracted in the order they were extracted and is only
+    appended to, so it can be read while the extraction runs, e.g. to journal the progress.
+    '''
+    offset: int
+    extracted: dict[str, int] # filename -> CRC
+    completed: list[tuple[str, int]]
+
+    def __init__(self, offset=0, extracted=None) -> None:
+        self.offset = offset
+        self.extracted = dict(extracted) if extracted else {}
+        self.completed = list(self.extracted.items())
+
+class StreamBuffer:
+    '''
+    Hands chunks received on the event loop to a blocking reader running on a worker thread.
+    feed() waits once more than limit bytes are queued.
+    '''
+    _loop: asyncio.AbstractEventLoop
+    _limit: int
+    _chunks: collections.deque
+    _queued: int
+    _cond: threading.Condition
+    _space: asyncio.Event
+    _eof: bool
+    _error: Exception | None
+    _detached: bool
+    _pending: bytearray
+    position: int # number of bytes consumed by the reader
+
+    def __init__(self, limit=STREAM_BUFFER_LIMIT) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._limit = limit
+        self._chunks = collections.deque()
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._space = asyncio.Event()
+        self._eof = False
+        self._error = None
+        self._detached = False
+        self._pending = bytearray()
+        self.position = 0
+
+    async def feed(self, chunk):
+        '''
+        Queue a chunk for the reader. Returns False if the reader has stopped consuming.
+        '''
+        while True:
+            with self._cond:
+                if self._detached:
+                    return False
+                if self._queued < self._limit:
+                    self._chunks.append(chunk)
+                    self._queued += len(chunk)
+                    self._cond.notify()
+                    return True
+                self._space.clear()
+            await self._space.wait()
+
+    def close(self, error=None):
+        with self._cond:
+            self._eof = True
+            self._error = error
+            self._cond.notify()
+
+    def detach(self):
+        with self._cond:
+            self._detached = True
+        self._loop.call_soon_threadsafe(self._space.set)
+
+    def _take(self):
+        with self._cond:
+            while not self._chunks and not self._eof:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            if not self._chunks:
+                return False
+            chunk = self._chunks.popleft()
+            self._queued -= len(chunk)
+        self._loop.call_soon_threadsafe(self._space.set)
+        self._pending += chunk
+        return True
+
+    def _consume(self, n):
+        data = bytes(self._pending[:n])
+        del self._pending[:n]
+        self.position += len(data)
+        return data
+
+    def read(self, n=-1):
+        '''
+        Read n bytes, or everything up to the end of the stream if n is negative. Blocks.
+        '''
+        while (n < 0 or len(self._pending) < n) and self._take():
+            pass
+        return self._consume(len(self._pending) if n < 0 else n)
+
+    def read_some(self, n):
+        '''
+        Read at most n bytes, returning less if that is all that is buffered. Returns b"" at the end.
+        '''
+        if not self._pending:
+            self._take()
+        return self._consume(n)
+
+    def unread(self, data):
+        self._pending[:0] = data
+        self.position -= len(data)
+
+def _read_exact(stream, n):
+    data = stream.read(n)
+    if len(data) != n:
+        raise zipfile.BadZipFile("Unexpected end of archive")
+    return data
+
+def _has_zip64_extra(extra):
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, length = struct.unpack_from("<HH", extra, pos)
+        if tag == ZIP64_EXTRA_TAG:
+            return True
+        pos += 4 + length
+    return False
+
+def _copy_member(stream, target, compress_type, compress_size):
+    decompressor = zipfile._get_decompressor(compress_type) # type: ignore
+    crc, size, left = 0, 0, compress_size
+    while left > 0:
+        chunk = stream.read_some(min(left, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise zipfile.BadZipFile("Unexpected end of archive")
+        left -= len(chunk)
+        data = decompressor.decompress(chunk) if decompressor else chunk
+        target.write(data)
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+    flush = getattr(decompressor, "flush", None)
+    if flush is not None:
+        data = flush()
+        target.write(data)
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+    return crc, size
+
+def _inflate_member(stream, target):
+    # sizes are only known after the data, but deflate streams mark their own end
+    decompressor = zlib.decompressobj(-15)
+    crc, size = 0, 0
+    while not decompressor.eof:
+        chunk = stream.read_some(COPY_CHUNK_SIZE)
+        if not chunk:
+            raise zipfile.BadZipFile("Unexpected end of archive")
+        data = decompressor.decompress(chunk)
+        target.write(data)
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+    stream.unread(decompressor.unused_data)
+    return crc, size
+
+class _Discard:
+    def write(self, data):
+        pass
+
+def _extract_local_member(stream, state, names=None):
+    fields = LOCAL_FILE_HEADER.unpack(LOCAL_FILE_HEADER_SIGNATURE + _read_exact(stream, LOCAL_FILE_HEADER.size - 4))
+    _, _, flag_bits, compress_type, _, _, crc, compress_size, file_size, name_length, extra_length = fields
+    name = _read_exact(stream, name_length)
+    extra = _read_exact(stream, extra_length)
+    filename = name.decode("utf-8") if flag_bits & UTF8_FLAG else name.decode("cp437")
+    if flag_bits & ENCRYPTED_FLAG:
+        raise StreamingNotSupported("Member %s is encrypted" % filename)
+    zip64 = _has_zip64_extra(extra)
+    if zip64:
+        file_size, compress_size, _ = parse_zip64_extra(extra, file_size, compress_size, 0)
+    descriptor = flag_bits & DATA_DESCRIPTOR_FLAG
+    if descriptor and compress_type != zipfile.ZIP_DEFLATED:
+        raise StreamingNotSupported("Size of member %s is only known after its data" % filename)
+    targetpath = member_path(filename)
+    if filename.endswith("/"):
+        os.makedirs(targetpath, exist_ok=True)
+        _read_exact(stream, compress_size)
+        return
+    skip = names is not None and filename not in names
+    upperdirs = os.path.dirname(targetpath)
+    if upperdirs and not skip:
+        os.makedirs(upperdirs, exist_ok=True)
+    # skipped members are still decompressed, their CRC is checked and deflate streams have to be followed to their end
+    with (contextlib.nullcontext(_Discard()) if skip else create_target(targetpath)) as target:
+        if descriptor:
+            actual_crc, actual_size = _inflate_member(stream, target)
+            signature = _read_exact(stream, 4)
+            if signature != DATA_DESCRIPTOR_SIGNATURE:
+                stream.unread(signature) # the signature is optional
+            crc, _, file_size = struct.unpack("<LQQ", _read_exact(stream, 20)) if zip64 else struct.unpack("<3L", _read_exact(stream, 12))
+        else:
+            actual_crc, actual_size = _copy_member(stream, target, compress_type, compress_size)
+    if actual_crc != crc or actual_size != file_size:
+        raise zipfile.BadZipFile("Bad CRC-32 or size for file %r" % filename)
+    state.extracted[filename] = crc
+    state.completed.append((filename, crc))
+
+def extract_stream(stream, state=None, names=None):
+    '''
+    Extract a ZIP archive (or only the given names) from a forward-only stream by following its local file headers.
+    The central directory at the end is only used to verify that every member was extracted intact.
+    Returns the central directory members.
+    '''
+    state = state if state is not None else StreamState()
+    while True:
+        state.offset = stream.position
+        signature = stream.read(4)
+        if signature == LOCAL_FILE_HEADER_SIGNATURE:
+            _extract_local_member(stream, state, names)
+        elif signature == CENTRAL_DIR_HEADER_SIGNATURE:
+            members = parse_central_directory(signature + stream.read(), None)
+            break
+        else:
+            raise zipfile.BadZipFile("Unexpected data at offset %i" % (stream.position - len(signature)))
+    for m in members:
+        if not m.is_dir() and state.extracted.get(m.filename) != m.CRC:
+            raise zipfile.BadZipFile("Member %s is missing or differs from the central directory" % m.filename)
+    return members
+
+def _extract_stream_and_detach(stream, state, names):
+    try:
+        with tracing.span("extract stream", "cpu") as s:
+            members = extract_stream(stream, state, names)
+            s.set(files=len(members))
+            return members
+    finally:
+        stream.detach()
+
+async def download_and_extract(chunks, progress=None, state=None, names=None):
+    '''
+    Extract an archive while it is being downloaded from an async iterator of chunks.
+    Decompression and writes run on a worker thread.
+    When continuing with a StreamState, the chunks must start at state.offset.
+    '''
+    state = state if state is not None else StreamState()
+    stream = StreamBuffer()
+    stream.position = state.offset
+    worker = asyncio.ensure_future(asyncio.to_thread(_extract_stream_and_detach, stream, state, names))
+    try:
+        async for chunk in chunks:
+            if not await stream.feed(chunk):
+                break
+            tracing.current().add("bytes", len(chunk))
+            if progress: progress.update(len(chunk))
+        stream.close()
+    except BaseException:
+        stream.close(zipfile.BadZipFile("Download was interrupted"))
+        await asyncio.gather(worker, return_exceptions=True)
+        raise
+    return await worker
@@ -0,0 +1,44 @@
+MULTIPART_BOUNDARY = "CUPDBYTERANGES"
+
+def parse_ranges(header, size):
+    '''
+    Parse a Range header into inclusive (start, end) tuples. Returns None if it isn't a satisfiable bytes range.
+    '''
+    unit, _, specs = header.partition("=")
+    if unit.strip() != "bytes":
+        return None
+    ranges = []
+    try:
+        for spec in specs.split(","):
+            first, _, last = spec.strip().partition("-")
+            if first == "":
+                if not last:
+                    return None
+                start, end = max(0, size - int(last)), size - 1
+            else:
+                start, end = int(first), min(int(last), size - 1) if last else size - 1
+            if start > end or start >= size:
+                continue
+            ranges.append((start, end))
+    except ValueError:
+        return None
+    return ranges or None
+
+def range_response(ranges, size, content_type):
+    '''
+    Layout of the response to a request for the given ranges of a file, the whole file if ranges is None. Returns
+    (status, headers, parts, trailer) where parts are the inclusive (start, end) of the file, each written after
+    its multipart header, and the trailer follows the last one. The headers are Content-Type, -Length and -Range.
+    '''
+    if ranges is None:
+        return 200, {"Content-Type": content_type, "Content-Length": str(size)}, [(0, size - 1, b"")], b""
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers = {"Content-Type": content_type, "Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)}
+        return 206, headers, [(start, end, b"")], b""
+    parts = [(start, end, (b"\r\n" if i > 0 else b"") + f"--{MULTIPART_BOUNDARY}\r\nContent-Type: {content_type}\r\n" \
+                                                          f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n".encode()) for i, (start, end) in enumerate(ranges)]
+    trailer = f"\r\n--{MULTIPART_BOUNDARY}--\r\n".encode()
+    headers = {"Content-Type": f"multipart/byteranges; boundary={MULTIPART_BOUNDARY}",
+               "Content-Length": str(sum(len(header) + end - start + 1 for start, end, header in parts) + len(trailer))}
+    return 206, headers, parts, trailer
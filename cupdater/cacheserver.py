@@ -0,0 +1,427 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+import aiohttp
+from aiohttp import web
+
+from .byteranges import parse_ranges, range_response
+
+
+logger = logging.getLogger(__name__)
+
+STREAM_CHUNK_SIZE = 256 * 1024
+# without an ETag hint from the client, a stored archive is trusted for this many seconds before asking its origin again
+REVALIDATE_INTERVAL = 60.0
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024 * 1024
+# response headers of the origin passed on to clients of archives too large to store
+FORWARDED_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "Content-Encoding", "Accept-Ranges", "ETag", "Last-Modified")
+
+def is_allowed(url, prefixes):
+    '''
+    Whether url is below one of the URL prefixes. Scheme and host have to match exactly, so a prefix can't be continued
+    into another host, and paths climbing out of the prefix with .. are refused.
+    '''
+    parts = urllib.parse.urlsplit(url)
+    if ".." in urllib.parse.unquote(parts.path).split("/"):
+        return False
+    for prefix in prefixes:
+        allowed = urllib.parse.urlsplit(prefix)
+        if (parts.scheme, parts.netloc.lower()) == (allowed.scheme, allowed.netloc.lower()) and parts.path.startswith(allowed.path):
+            return True
+    return False
+
+def _write_flushed(f, data):
+    f.write(data)
+    f.flush()
+
+class ArchiveTooLarge(Exception):
+    pass
+
+class CacheEntry:
+    '''
+    A stored archive and the origin's validators for it.
+    '''
+    url: str
+    etag: str | None
+    last_modified: str | None
+    size: int
+    validated: float # when the origin last confirmed this copy is current
+
+    def __init__(self, url, etag, last_modified, size, validated) -> None:
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = size
+        self.validated = validated
+
+    def matches(self, headers):
+        '''
+        Whether the origin's response headers describe this copy.
+        '''
+        if self.etag is not None or headers.get("ETag") is not None:
+            return self.etag == headers.get("ETag")
+        return self.last_modified is not None and self.last_modified == headers.get("Last-Modified")
+
+    def validator(self):
+        return self.etag if self.etag is not None else self.last_modified
+
+class Fill:
+    '''
+    A download of an archive from its origin into the cache. Every client asking for the archive meanwhile
+    is served from the stored part, waiting for the bytes it needs that haven't arrived yet.
+    '''
+    url: str
+    entry: CacheEntry | None # once the size is known, from the Content-Length or at the end
+    received: int
+    done: bool
+    error: BaseException | None
+    task: asyncio.Task | None
+    _changed: asyncio.Event
+
+    def __init__(self, url) -> None:
+        self.url = url
+        self.entry = None
+        self.received = 0
+        self.done = False
+        self.error = None
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _wait(self, predicate):
+        while not predicate():
+            await self._changed.wait()
+
+    def start(self, entry):
+        self.entry = entry
+        self._notify()
+
+    def advance(self, count):
+        self.received += count
+        self._notify()
+
+    def finish(self, entry=None, error=None):
+        self.entry = self.entry or entry
+        self.error = error
+        self.done = True
+        self._notify()
+
+    async def ready(self):
+        '''
+        The entry of the archive once its size is known. Raises the error the fill failed with before.
+        '''
+        await self._wait(lambda: self.entry is not None or self.done)
+        if self.error is not None:
+            raise self.error
+        return self.entry
+
+    async def available(self, end):
+        '''
+        Wait until the archive was stored up to end.
+        '''
+        await self._wait(lambda: self.received >= end or self.done)
+        if self.error is not None:
+            raise RuntimeError(f"Failed to store {self.url}") from self.error
+
+class CacheServer:
+    '''
+    Serves layer archives to updaters on the LAN from a directory, keyed by archive URL. Only archives below the
+    allowed URL prefixes are fetched. Stored archives are answered locally including range requests, so selective
+    updates work as well. The first request for another archive starts storing it, that one download from the origin
+    serves all clients asking for the archive meanwhile, ranges as soon as their bytes arrived.
+    '''
+    root: str
+    allowed: list[str]
+    max_size: int
+    _session: aiohttp.ClientSession | None
+    _fills: dict[str, Fill]
+
+    def __init__(self, root, allowed, max_size=DEFAULT_MAX_SIZE) -> None:
+        self.root = root
+        self.allowed = list(allowed)
+        self.max_size = max_size
+        self._session = None
+        self._fills = {}
+
+    def application(self):
+        app = web.Application()
+        app.router.add_route("*", "/archive", self._handle_archive)
+        app.on_startup.append(self._start)
+        app.on_cleanup.append(self._stop)
+        return app
+
+    async def _start(self, app):
+        os.makedirs(self.root, exist_ok=True)
+        self._session = aiohttp.ClientSession(auto_decompress=False, timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60))
+
+    async def _stop(self, app):
+        tasks = [fill.task for fill in self._fills.values() if fill.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._session.close() # type: ignore
+
+    def _path(self, url, suffix):
+        return os.path.join(self.root, hashlib.sha256(url.encode()).hexdigest() + suffix)
+
+    def _load(self, url):
+        try:
+            with open(self._path(url, ".json")) as f:
+                entry = CacheEntry(**json.load(f))
+            if os.path.getsize(self._path(url, ".zip")) != entry.size:
+                return None
+            return entry
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _save(self, entry):
+        path = self._path(entry.url, ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(vars(entry), f)
+        os.replace(path + ".tmp", path)
+
+    def _remove(self, url):
+        # the entry goes first, an archive without one is incomplete
+        for suffix in (".json", ".zip"):
+            try:
+                os.unlink(self._path(url, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, filling, reserve=0):
+        '''
+        Remove least recently served archives until the stored ones and reserve more bytes fit into the maximum size.
+        Archives being stored, those of the URLs in filling, count but aren't removed.
+        '''
+        filling = {os.path.basename(self._path(url, ".zip")) for url in filling}
+        archives, total = [], reserve
+        for name in os.listdir(self.root):
+            if name.endswith(".zip"):
+                try:
+                    st = os.stat(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    continue # removed meanwhile
+                total += st.st_size
+                if name not in filling:
+                    archives.append((st.st_mtime, st.st_size, name))
+        for _, size, name in sorted(archives):
+            if total <= self.max_size:
+                break
+            logger.info("Evicting %s", name)
+            stem = os.path.join(self.root, name[:-len(".zip")])
+            for path in (stem + ".json", stem + ".zip"):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    async def _fresh_entry(self, url, etag):
+        '''
+        The stored archive for url if it is current, asking the origin unless the client's ETag hint or a
+        recent check confirms it. Returns None if it has to be fetched from the origin.
+        '''
+        entry = await asyncio.to_thread(self._load, url)
+        if entry is None:
+            return None
+        if etag is not None and etag == entry.etag:
+            return entry
+        if etag is None and time.time() - entry.validated < REVALIDATE_INTERVAL:
+            return entry
+        try:
+            # redirects aren't followed, they could lead outside the allowed prefixes
+            async with self._session.head(url, allow_redirects=False) as response: # type: ignore
+                response.raise_for_status()
+                current = entry.matches(response.headers)
+        except Exception as e:
+            logger.warning("Failed to revalidate %s: %s", url, str(e) or type(e).__name__)
+            return None
+        if not current:
+            logger.info("%s changed at the origin", url)
+            return None
+        if url in self._fills:
+            return None # stored again meanwhile
+        entry.validated = time.time()
+        await asyncio.to_thread(self._save, entry)
+        return entry
+
+    def _fill(self, url):
+        '''
+        The running fill of url, starting one if there is none.
+        '''
+        fill = self._fills.get(url)
+        if fill is None:
+            fill = self._fills[url] = Fill(url)
+            fill.task = asyncio.ensure_future(self._store(fill))
+        return fill
+
+    async def _store(self, fill):
+        '''
+        Download the whole archive into the cache, replacing a stored copy.
+        '''
+        url = fill.url
+        entry, error = None, None
+        try:
+            entry = await self._download(fill)
+            logger.info("Stored %s (%i bytes)", url, entry.size)
+        except BaseException as e:
+            error = e
+            try:
+                await asyncio.to_thread(self._remove, url)
+            except OSError as cleanup:
+                logger.warning("Failed to remove the incomplete copy of %s: %s", url, str(cleanup))
+            if not isinstance(e, Exception):
+                raise
+            logger.warning("Failed to store %s: %s", url, str(e) or type(e).__name__)
+        finally:
+            # whatever stopped the download, the clients waiting for it must not wait any longer
+            fill.finish(entry, error=error if entry is None else None)
+            if self._fills.get(url) is fill:
+                del self._fills[url]
+        if entry is not None:
+            try:
+                await asyncio.to_thread(self._evict, set(self._fills))
+            except OSError as e:
+                logger.warning("Failed to evict archives: %s", str(e))
+
+    async def _download(self, fill):
+        url = fill.url
+        path = self._path(url, ".zip")
+        # a new file, clients still reading the old copy keep it
+        await asyncio.to_thread(self._remove, url)
+        async with self._session.get(url, allow_redirects=False) as response: # type: ignore
+            response.raise_for_status()
+            if response.status != 200:
+                raise RuntimeError(f"Unexpected status {response.status}")
+            size = response.content_length
+            if size is not None and size > self.max_size:
+                raise ArchiveTooLarge(f"{size} bytes exceed the cache size")
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+            await asyncio.to_thread(self._evict, set(self._fills), size or 0)
+            f = await asyncio.to_thread(open, path, "wb")
+            try:
+                if size is not None:
+                    fill.start(CacheEntry(url, etag, last_modified, size, time.time()))
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    if fill.received + len(chunk) > self.max_size:
+                        raise ArchiveTooLarge(f"More than {self.max_size} bytes")
+                    # flushed to be readable by the clients waiting for it
+                    await asyncio.to_thread(_write_flushed, f, chunk)
+                    fill.advance(len(chunk))
+            finally:
+                await asyncio.to_thread(f.close)
+            if size is not None and fill.received != size:
+                raise RuntimeError(f"Received {fill.received} of {size} bytes")
+        entry = fill.entry or CacheEntry(url, etag, last_modified, fill.received, time.time())
+        await asyncio.to_thread(self._save, entry)
+        return entry
+
+    async def _handle_archive(self, request):
+        if request.method not in ("GET", "HEAD"):
+            return web.Response(status=405)
+        url = request.query.get("url")
+        if url is None or urllib.parse.urlsplit(url).scheme not in ("http", "https"):
+            return web.Response(status=400, text="Expected an http(s) archive URL")
+        if not is_allowed(url, self.allowed):
+            return web.Response(status=403)
+        if url not in self._fills:
+            entry = await self._fresh_entry(url, request.query.get("etag"))
+            if entry is not None:
+                logger.debug("Hit %s", url)
+                return await self._serve(request, entry)
+        logger.debug("Miss %s", url)
+        fill = self._fill(url)
+        try:
+            entry = await fill.ready()
+        except ArchiveTooLarge:
+            return await self._pass_through(request, url)
+        except aiohttp.ClientResponseError as e:
+            return web.Response(status=e.status if e.status < 500 else 502)
+        except Exception:
+            return web.Response(status=502)
+        return await self._serve(request, entry, fill)
+
+    async def _serve(self, request, entry, fill=None):
+        '''
+        Answer from the stored archive, or from the part of it stored so far while fill is running.
+        '''
+        path = self._path(entry.url, ".zip")
+        headers = {"Accept-Ranges": "bytes"}
+        if entry.etag is not None: headers["ETag"] = entry.etag
+        if entry.last_modified is not None: headers["Last-Modified"] = entry.last_modified
+        ranges = None
+        if "Range" in request.headers and request.headers.get("If-Range", entry.validator()) == entry.validator():
+            ranges = parse_ranges(request.headers["Range"], entry.size)
+            if ranges is None:
+                return web.Response(status=416, headers={**headers, "Content-Range": f"bytes */{entry.size}"})
+        status, body_headers, parts, trailer = range_response(ranges, entry.size, "application/zip")
+        headers.update(body_headers)
+        if request.method == "HEAD":
+            return web.Response(status=status, headers=headers)
+        with open(path, "rb") as f:
+            if fill is None:
+                os.utime(path)
+            response = web.StreamResponse(status=status, headers=headers)
+            await response.prepare(request)
+            for start, end, header in parts:
+                await response.write(header)
+                pos = start
+                while pos <= end:
+                    stop = min(end + 1, pos + STREAM_CHUNK_SIZE)
+                    if fill is not None:
+                        await fill.available(stop)
+                    f.seek(pos)
+                    chunk = await asyncio.to_thread(f.read, stop - pos)
+                    if not chunk:
+                        raise RuntimeError(f"{path} was truncated")
+                    await response.write(chunk)
+                    pos += len(chunk)
+            await response.write(trailer)
+        await response.write_eof()
+        return response
+
+    async def _pass_through(self, request, url):
+        headers = {name: request.headers[name] for name in ("Range", "If-Range") if name in request.headers}
+        try:
+            async with self._session.request(request.method, url, headers=headers, allow_redirects=False) as upstream: # type: ignore
+                response = web.StreamResponse(status=upstream.status, headers={name: upstream.headers[name] for name in FORWARDED_HEADERS if name in upstream.headers})
+                await response.prepare(request)
+                async for chunk in upstream.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+        except aiohttp.ClientError as e:
+            logger.warning("Failed to fetch %s: %s", url, str(e) or type(e).__name__)
+            return web.Response(status=502)
+
+def main():
+    parser = argparse.ArgumentParser(description="Cache layer archives for updaters on the local network")
+    parser.add_argument("--root", help="Directory the archives are stored in", default="cupdater-cache")
+    parser.add_argument("--host", help="Address to listen on, 0.0.0.0 to serve the LAN (default: only this machine)", default=DEFAULT_HOST)
+    parser.add_argument("--port", help="Port to listen on", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--max-size", help="Maximum size of the stored archives in bytes, least recently used ones are removed first", type=int, default=DEFAULT_MAX_SIZE)
+    parser.add_argument("--allow", help="Only fetch archive URLs below this prefix, like https://cdn.example.com/game/ (repeatable, at least one is required)", action="append", default=[])
+    parser.add_argument("-v", "--verbose", help="Enable verbose logging", action="store_true")
+    args = parser.parse_args()
+    if not args.allow:
+        parser.error("--allow is required, without it the server would fetch any URL its clients ask for")
+    for prefix in args.allow:
+        if urllib.parse.urlsplit(prefix).scheme not in ("http", "https") or not urllib.parse.urlsplit(prefix).netloc:
+            parser.error(f"--allow {prefix} isn't an http(s) URL prefix")
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    server = CacheServer(args.root, args.allow, args.max_size)
+    web.run_app(server.application(), host=args.host, port=args.port, access_log=None)
+
+if __name__ == "__main__":
+    main()
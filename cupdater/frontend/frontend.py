@@ -1,3 +1,8 @@
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .progress import ProgressAggregator
+
 class ProgressReportInterface:
     def __init__(self, title, total=None) -> None:
         pass
@@ -13,8 +18,10 @@ class ProgressReportInterface:
         raise NotImplementedError()
 
 class Frontend:
+    _progress: "ProgressAggregator"
     def __init__(self, nopause=False) -> None:
-        pass
+        from .progress import ProgressAggregator
+        self._progress = ProgressAggregator(self.render_progress, self.progress_status)
     def notify(self, notice):
         raise NotImplementedError()
     async def ask(self, question):
@@ -22,6 +29,13 @@ class Frontend:
     def fatal(self, error):
         raise NotImplementedError()
     def progress(self, title, total=None, unit=None, leave=True) -> ProgressReportInterface:
+        return self._progress.task(title, total=total, unit=unit, leave=leave)
+    def render_progress(self, snapshot):
+        '''
+        Show a ProgressSnapshot of all running tasks. Called periodically from a background thread.
+        '''
+        raise NotImplementedError()
+    def progress_status(self, status):
         raise NotImplementedError()
     def set_branding(self, branding):
         raise NotImplementedError()
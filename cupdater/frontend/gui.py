@@ -2,4 +2,8 @@ from .frontend import Frontend
 
 class GUIFrontend(Frontend):
     def __init__(self, nopause=False) -> None:
-        super().__init__()
\ No newline at end of file
+        super().__init__()
+    def render_progress(self, snapshot):
+        pass # TODO: no progress view yet, the aggregator still calls this for every tick
+    def progress_status(self, status):
+        pass # TODO
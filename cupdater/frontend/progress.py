@@ -0,0 +1,169 @@
+import threading
+import time
+
+from .frontend import ProgressReportInterface
+
+
+PROGRESS_RENDER_INTERVAL = 0.2
+# units counted as bytes in the overall progress, with their size in bytes
+BYTE_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024 * 1024}
+FILE_UNITS = ("file", "files")
+# weight of the latest interval in the smoothed transfer rate
+RATE_SMOOTHING = 0.3
+
+class TaskProgress(ProgressReportInterface):
+    '''
+    Progress of one task, e.g. a download. Updates only add to a counter and are cheap enough to be made
+    for every chunk from any thread, the aggregator renders all tasks at a fixed rate.
+    '''
+    title: str
+    total: int | None
+    unit: str
+    leave: bool
+    n: int
+    started: float
+    closed: bool
+    _aggregator: "ProgressAggregator"
+    _lock: threading.Lock
+
+    def __init__(self, aggregator, title, total=None, unit=None, leave=True) -> None:
+        self.title = title
+        self.total = total
+        self.unit = unit if unit else "it"
+        self.leave = leave
+        self.n = 0
+        self.started = 0.0
+        self.closed = False
+        self._aggregator = aggregator
+        self._lock = threading.Lock()
+    def __enter__(self):
+        self.n = 0
+        self._aggregator._open(self)
+        return self
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self._aggregator._close(self)
+    def update(self, count=1):
+        with self._lock:
+            self.n += count
+    def set(self, value):
+        self.n = value
+    def status(self, status):
+        self._aggregator.status(status)
+
+class ProgressSnapshot:
+    '''
+    State of all tasks of a progress session at one point in time, handed to frontends for rendering.
+    '''
+    tasks: list[TaskProgress] # open tasks, the first one opened first
+    bytes_done: int
+    bytes_total: int | None # None if a byte task doesn't know its size
+    files_done: int
+    files_total: int | None
+    rate: float | None # bytes per second
+    finished: bool # the last task was closed, the session ends with this snapshot
+
+    def __init__(self, tasks, bytes_done, bytes_total, files_done, files_total, rate, finished) -> None:
+        self.tasks = tasks
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+        self.files_done = files_done
+        self.files_total = files_total
+        self.rate = rate
+        self.finished = finished
+
+    @property
+    def eta(self):
+        '''
+        Seconds until all known bytes are transferred, None if unknown.
+        '''
+        if self.bytes_total is None or not self.rate:
+            return None
+        return max(0.0, (self.bytes_total - self.bytes_done) / self.rate)
+
+class ProgressAggregator:
+    '''
+    Collects the tasks of a frontend and calls render with a ProgressSnapshot at a fixed rate from a
+    background thread while any task is open. Tasks opened until the last one is closed form a session
+    whose byte and file counts add up, including tasks that were already closed.
+    '''
+    _render: object
+    _status: object
+    _interval: float
+    _lock: threading.Lock
+    _tasks: list[TaskProgress]
+    _stop: threading.Event
+    _thread: threading.Thread | None
+    _rate: float | None
+    _last: tuple[float, int] | None # time and bytes of the previous snapshot
+
+    def __init__(self, render, status=None, interval=PROGRESS_RENDER_INTERVAL) -> None:
+        self._render = render
+        self._status = status
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._tasks = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._rate = None
+        self._last = None
+
+    def task(self, title, total=None, unit=None, leave=True):
+        return TaskProgress(self, title, total, unit, leave)
+
+    def status(self, status):
+        if self._status is not None:
+            self._status(status) # type: ignore
+
+    def _open(self, task):
+        with self._lock:
+            task.closed = False
+            if task in self._tasks:
+                return
+            task.started = time.monotonic()
+            self._tasks.append(task)
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+                self._thread.start()
+
+    def _close(self, task):
+        with self._lock:
+            if task.closed:
+                return
+            task.closed = True
+            if any(not t.closed for t in self._tasks):
+                return
+            thread, self._thread = self._thread, None
+        self._stop.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._render(self.snapshot()) # type: ignore
+        self._render(self.snapshot(finished=True)) # type: ignore
+        with self._lock:
+            if self._thread is None:
+                self._tasks = [t for t in self._tasks if not t.closed]
+                self._rate = None
+                self._last = None
+
+    def snapshot(self, finished=False):
+        with self._lock:
+            tasks = list(self._tasks)
+        bytes_done, bytes_total, files_done, files_total = 0, 0, 0, 0
+        for t in tasks:
+            if t.unit in BYTE_UNITS:
+                bytes_done += t.n * BYTE_UNITS[t.unit]
+                if bytes_total is not None:
+                    bytes_total = bytes_total + t.total * BYTE_UNITS[t.unit] if t.total is not None else None
+            elif t.unit in FILE_UNITS:
+                files_done += t.n
+                if files_total is not None:
+                    files_total = files_total + t.total if t.total is not None else None
+        now = time.monotonic()
+        if self._last is not None and now > self._last[0]:
+            rate = (bytes_done - self._last[1]) / (now - self._last[0])
+            self._rate = rate if self._rate is None else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self._rate
+        self._last = (now, bytes_done)
+        return ProgressSnapshot([t for t in tasks if not t.closed], bytes_done, bytes_total, files_done, files_total, self._rate, finished)
@@ -1,8 +1,12 @@
 import asyncio
 import logging
 import sys
-from tqdm import tqdm
-from .frontend import Frontend, ProgressReportInterface
+from typing import TYPE_CHECKING
+from .frontend import Frontend
+from .progress import BYTE_UNITS, FILE_UNITS
+
+if TYPE_CHECKING:
+    from tqdm import tqdm
 
 
 logger = logging.getLogger(__name__)
@@ -14,27 +18,42 @@ async def ainput(string: str) -> str:
     await asyncio.to_thread(writenflush, f'{string} ')
     return (await asyncio.to_thread(sys.stdin.readline)).rstrip("\n")
 
-class TUIProgressReport(ProgressReportInterface):
-    _tqdm: tqdm
-    def __init__(self, title, total=None, unit=None, leave=True) -> None:
-        self._tqdm = tqdm(desc=title, total=total, unit=unit if unit else "it", leave=leave, position=tqdm._get_free_pos()) # type: ignore
-    def __enter__(self):
-        self._tqdm.reset()
-        self._tqdm.refresh()
-        return self
-    def __exit__(self, exception_type, exception_value, exception_traceback):
+class _Bar:
+    '''
+    A tqdm bar following a counter that is only read when rendering.
+    '''
+    _tqdm: "tqdm"
+    _shown: int
+    mode: str
+    def __init__(self, mode, title, n=0, total=None, unit="it") -> None:
+        from tqdm import tqdm # imported on first use, launches without updates never show progress
+        # starting at the current count keeps the first interval out of the rate
+        self._tqdm = tqdm(desc=title, initial=n, total=total, unit=unit, unit_scale=unit == "B", unit_divisor=1024, leave=False, mininterval=0)
+        self._shown = n
+        self.mode = mode
+    def follow(self, n, total=None, description=None, postfix=None):
+        if total != self._tqdm.total:
+            self._tqdm.total = total
+        if description is not None:
+            self._tqdm.set_description_str(description, refresh=False)
+        if postfix is not None:
+            self._tqdm.set_postfix_str(postfix, refresh=False)
+        if n != self._shown:
+            self._tqdm.update(n - self._shown)
+            self._shown = n
+        else:
+            self._tqdm.refresh()
+    def close(self):
         self._tqdm.close()
-    def update(self, count=1):
-        self._tqdm.update(count)
-    def set(self, value):
-        self._tqdm.update(value - self._tqdm.n)
-    def status(self, status):
-        self._tqdm.write(status)
 
 class TUIFrontend(Frontend):
     nopause: bool
-    def __init__(self, nopause=False) -> None:
+    detail: bool
+    _bars: dict[object, _Bar] # None for the overall progress, tasks for their own bars
+    def __init__(self, nopause=False, detail=False) -> None:
         self.nopause = nopause
+        self.detail = detail
+        self._bars = {}
         super().__init__()
     def notify(self, notice):
         logger.info(notice)
@@ -44,8 +63,46 @@ class TUIFrontend(Frontend):
         logger.fatal(error)
         self.pause()
         sys.exit(1)
-    def progress(self, title, total=None, unit=None, leave=True):
-        return TUIProgressReport(title, total=total, unit=unit, leave=leave)
+    def render_progress(self, snapshot):
+        if snapshot.finished:
+            for bar in self._bars.values():
+                bar.close()
+            self._bars.clear()
+            return
+        if not snapshot.tasks:
+            return
+        outer = snapshot.tasks[0]
+        if snapshot.bytes_done or snapshot.bytes_total:
+            mode, n, total, postfix = "bytes", snapshot.bytes_done, snapshot.bytes_total, None
+            if snapshot.files_total:
+                postfix = f"{snapshot.files_done}/{snapshot.files_total} files"
+        elif snapshot.files_done or snapshot.files_total:
+            mode, n, total, postfix = "files", snapshot.files_done, snapshot.files_total, None
+        else:
+            mode, n, total, postfix = "tasks", outer.n, outer.total, None
+        description = outer.title
+        if mode != "tasks" and outer.total is not None and outer.unit not in (BYTE_UNITS.keys() | set(FILE_UNITS)):
+            description = f"{outer.title} ({outer.n}/{outer.total})"
+        overall = self._bars.get(None)
+        if overall is not None and overall.mode != mode:
+            overall.close()
+            overall = None
+        if overall is None:
+            overall = self._bars[None] = _Bar(mode, description, n, total, "B" if mode == "bytes" else ("file" if mode == "files" else outer.unit))
+        overall.follow(n, total, description, postfix)
+        if self.detail:
+            for task in snapshot.tasks[1:]:
+                scale = BYTE_UNITS.get(task.unit, 1)
+                n, total = task.n * scale, task.total * scale if task.total is not None else None
+                bar = self._bars.get(task)
+                if bar is None:
+                    bar = self._bars[task] = _Bar("task", task.title, n, total, "B" if task.unit in BYTE_UNITS else task.unit)
+                bar.follow(n, total)
+        for key in [key for key in self._bars if key is not None and key not in snapshot.tasks]:
+            self._bars.pop(key).close()
+    def progress_status(self, status):
+        from tqdm import tqdm
+        tqdm.write(status)
     def set_branding(self, branding):
         pass
     def pause(self):
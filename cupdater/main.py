@@ -1,53 +1,73 @@
 import asyncio
+import atexit
 import shutil
-import gevent.monkey
-
-gevent.monkey.patch_all()
-import gevent
-import asyncio_gevent
-asyncio.set_event_loop_policy(asyncio_gevent.EventLoopPolicy())
 
 import certifi
 import os
 os.environ["SSL_CERT_FILE"] = certifi.where()
 
-import zipfile_zstd # Hotpatch zipfile for later remotezip usage
-import remotezip # Load remotezip so it loads the patched zipfile version
-
 import logging
 import traceback
 import sys, os
 import argparse
 import mmap
 import json
+import struct
 from pathlib import Path
 
-from .backend import InstallerBackend
 from .frontend import TUIFrontend, GUIFrontend
 from .backend.filedb import UPDATE_DATA_DB_FILENAME
+from .backend.defaults import DEFAULT_RANGE_GAP, DEFAULT_SEGMENT_SIZE, DEFAULT_SEGMENT_CONNECTIONS
+from .backend.scheduler import DEFAULT_NETWORK_JOBS, DEFAULT_DISK_JOBS
+from .backend.objstore import LINK_MODES, DEFAULT_OBJECT_STORE_LIMIT
+from .backend.faststart import check_up_to_date
+from .backend import tracing
 
 
 PROVISIONING_EMBEDDED_HEADER = b"@@@CUPMANIFESTCFG@@@"
+# provisioned executables end with header, configuration, trailer so the configuration can be found
+# without scanning the whole executable: the trailer holds the configuration length and this marker
+PROVISIONING_EMBEDDED_TRAILER = struct.Struct("<Q20s")
+PROVISIONING_EMBEDDED_TRAILER_MAGIC = b"@@@CUPMANIFESTEND@@@"
+
+def embed_package_manifest(executable, configuration):
+    '''
+    Provision an executable by appending the configuration (a JSON string) to it.
+    '''
+    data = configuration.encode("utf-8")
+    with open(executable, "ab") as f:
+        f.write(PROVISIONING_EMBEDDED_HEADER + data + PROVISIONING_EMBEDDED_TRAILER.pack(len(data), PROVISIONING_EMBEDDED_TRAILER_MAGIC))
+
+def _decode_embedded_package_manifest(data):
+    try:
+        data = data.decode("utf-8")
+        if data.startswith("{"):
+            return data.strip()
+    except:
+        pass
+    return None
+
 def get_embedded_package_manifest():
     '''
     Extract the embedded manifest URL from the executable. None if file is not openable / none found.
     '''
     if not (getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS")):
         return None # not a frozen executable build
-    with open(sys.executable, "rb") as f, \
-            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as e:
-        pos = e.find(PROVISIONING_EMBEDDED_HEADER)
-        if pos is None:
-            return None # provisioning manifest url not found in executable data
-        e.seek(pos + len(PROVISIONING_EMBEDDED_HEADER))
-        data = e.read()
-        try:
-            data = data.decode("utf-8")
-            if data.startswith("{"):
-                return data.strip()
-        except:
-            pass
-        return None
+    with open(sys.executable, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size >= PROVISIONING_EMBEDDED_TRAILER.size:
+            f.seek(-PROVISIONING_EMBEDDED_TRAILER.size, os.SEEK_END)
+            length, magic = PROVISIONING_EMBEDDED_TRAILER.unpack(f.read(PROVISIONING_EMBEDDED_TRAILER.size))
+            if magic == PROVISIONING_EMBEDDED_TRAILER_MAGIC and length + PROVISIONING_EMBEDDED_TRAILER.size <= size:
+                f.seek(-(length + PROVISIONING_EMBEDDED_TRAILER.size), os.SEEK_END)
+                return _decode_embedded_package_manifest(f.read(length))
+        # provisioned without a trailer
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as e:
+            pos = e.find(PROVISIONING_EMBEDDED_HEADER)
+            if pos == -1:
+                return None # provisioning manifest url not found in executable data
+            e.seek(pos + len(PROVISIONING_EMBEDDED_HEADER))
+            return _decode_embedded_package_manifest(e.read())
 
 def get_default_package_manifest():
     '''
@@ -58,6 +78,18 @@ def get_default_package_manifest():
         return embedded
     return None
 
+def write_trace(tracer, path):
+    '''
+    Save the trace of this run and log its timing summary, also when the update failed.
+    '''
+    try:
+        tracer.write(path)
+        logging.info("Trace written to %s", path)
+    except OSError as e:
+        logging.warning("Failed to write trace to %s: %s", path, str(e))
+    for line in tracer.summary():
+        logging.info(line)
+
 def get_default_gui():
     return False # TODO
     # return sys.platform == "win32" or "DISPLAY" in os.environ
@@ -79,10 +111,38 @@ async def amain():
     parser.add_argument("-f", "--force", help="Force recheck manifest", action="store_true")
     parser.add_argument("--noselfupdate", help="Skip checking for self-update", action="store_true")
     parser.add_argument("--http-timeout", help="Set HTTP download timeout for content", default=3600)
+    parser.add_argument("--range-gap", help="Merge ranges of changed files separated by at most this many bytes", type=int, default=DEFAULT_RANGE_GAP)
+    parser.add_argument("--no-multipart-ranges", help="Don't request multiple byte ranges at once", action="store_true")
+    parser.add_argument("--cd-cache-ttl", help="Trust cached archive file lists for this many seconds without asking the server", type=float, default=0)
+    parser.add_argument("--index-workers", help="Number of threads used to verify modified files (default: based on CPU count)", type=int, default=None)
+    parser.add_argument("--no-stream-extract", help="Download archives to disk before extracting them on clean installs", action="store_true")
+    parser.add_argument("--extract-workers", help="Number of threads used to extract archives (default: CPU count)", type=int, default=None)
+    parser.add_argument("--segment-size", help="Download large archives in byte ranges of this size", type=int, default=DEFAULT_SEGMENT_SIZE)
+    parser.add_argument("--segment-connections", help="Number of parallel connections per archive download, 1 to disable segmented downloads", type=int, default=DEFAULT_SEGMENT_CONNECTIONS)
+    parser.add_argument("--network-jobs", help="Number of archives checked or downloaded at the same time", type=int, default=DEFAULT_NETWORK_JOBS)
+    parser.add_argument("--cpu-jobs", help="Number of archives decompressed at the same time (default: CPU count)", type=int, default=None)
+    parser.add_argument("--disk-jobs", help="Number of archives written to disk at the same time", type=int, default=DEFAULT_DISK_JOBS)
+    parser.add_argument("--object-store", help="Keep removed files and reuse identical local files instead of downloading them again", action="store_true")
+    parser.add_argument("--object-store-link", help="How files are restored from local copies (default: clone if supported, otherwise copy)", choices=LINK_MODES, default="auto")
+    parser.add_argument("--object-store-limit", help="Maximum size of the kept removed files in bytes", type=int, default=DEFAULT_OBJECT_STORE_LIMIT)
+    parser.add_argument("--max-connections", help="Maximum number of parallel HTTP connections", type=int, default=50)
+    parser.add_argument("--no-adaptive-connections", help="Always allow the maximum number of parallel archive requests instead of adjusting it to throughput and errors", action="store_true")
+    parser.add_argument("--limit-rate", help="Limit the download bandwidth to this many bytes per second, 0 for unlimited", type=int, default=0)
+    parser.add_argument("--hedge-delay", help="Also ask the next mirror for archive file lists if the best one didn't answer within this many seconds", type=float, default=None)
+    parser.add_argument("--source", help="Use archives from this directory or mounted network share if they match the manifest (repeatable)", action="append", default=[])
+    parser.add_argument("--cache-server", help="Fetch archives through this LAN cache server (python -m cupdater.cacheserver) before asking their origin", default=None)
+    parser.add_argument("--trace", help="Write a Chrome trace (for Perfetto or chrome://tracing) of the update to this file and log a timing summary", default=None)
+    parser.add_argument("--progress-detail", help="Show the progress of every running download and extraction below the overall progress", action="store_true")
+    parser.add_argument("--verify", help="Check all installed files against the manifest instead of updating", action="store_true")
+    parser.add_argument("--repair", help="Check all installed files and fetch only the corrupted or missing ones again", action="store_true")
     parser.add_argument("--nopause", help="Don't wait for user input, just exit the process", action="store_true")
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
-    frontend = TUIFrontend(nopause=args.nopause) if args.console else GUIFrontend(nopause=args.nopause)
+    if args.trace is not None:
+        atexit.register(write_trace, tracing.enable(), os.path.abspath(args.trace))
+    # relative to where the updater was started, not the installation directory
+    sources = [os.path.abspath(d) for d in args.source]
+    frontend = TUIFrontend(nopause=args.nopause, detail=args.progress_detail) if args.console else GUIFrontend(nopause=args.nopause)
     use_manifest_configuration_installdir = manifest_configuration is not None and "installdir" in manifest_configuration
     if args.installdir is not None:
         try:
@@ -106,7 +166,6 @@ async def amain():
             shutil.copy(sys.executable, updater_copy_path)
         except:
             logging.warning("Failed to copy this copy of the updater (%s) to the installation directory %s.", sys.executable, updater_copy_path)
-    backend = InstallerBackend(frontend, timeout=args.http_timeout)
     manifest = args.manifest
     if manifest is None:
         manifest = await frontend.ask("Please enter the manifest URL:")
@@ -114,13 +173,51 @@ async def amain():
             manifest = manifest.strip()
     if manifest is None or len(manifest) == 0:
         frontend.fatal("Cannot update without manifest URL present. Please enter the correct manifest URL.")
+    branch = args.branch if args.branch is not None else "public"
+    if not args.force and not args.verify and not args.repair:
+        with tracing.span("quick check", "network"):
+            cached = await asyncio.to_thread(check_up_to_date, manifest, branch, not args.noselfupdate)
+        if cached is not None:
+            frontend.set_branding(cached["brand"])
+            logging.info("Updating %s", cached["brand"]["name"])
+            logging.info("No update required")
+            frontend.pause()
+            return
+    from .backend import InstallerBackend
+    backend = InstallerBackend(
+        frontend,
+        tcp_connections=args.max_connections,
+        timeout=args.http_timeout,
+        range_gap=args.range_gap,
+        range_multipart=not args.no_multipart_ranges,
+        cd_cache_ttl=args.cd_cache_ttl,
+        index_workers=args.index_workers,
+        stream_extract=not args.no_stream_extract,
+        extract_workers=args.extract_workers,
+        segment_size=args.segment_size,
+        segment_connections=args.segment_connections,
+        network_jobs=args.network_jobs,
+        cpu_jobs=args.cpu_jobs,
+        disk_jobs=args.disk_jobs,
+        object_store=args.object_store,
+        object_store_link=args.object_store_link,
+        object_store_limit=args.object_store_limit,
+        hedge_delay=args.hedge_delay,
+        adaptive_connections=not args.no_adaptive_connections,
+        bandwidth_limit=args.limit_rate,
+        sources=sources,
+        cache_server=args.cache_server,
+    )
     try:
         await backend.load_manifest_from_url(manifest, force=args.force)
     except Exception as e:
         if args.verbose: traceback.print_exc()
         frontend.fatal("Manifest load error: " + str(e) + ". Please try again later or contact support.")
-    backend.set_branch(args.branch if args.branch is not None else "public")
-    await backend.update(force=args.force, ignore_self_update=args.noselfupdate)
+    backend.set_branch(branch)
+    if args.verify or args.repair:
+        await backend.verify(repair=args.repair)
+    else:
+        await backend.update(force=args.force, ignore_self_update=args.noselfupdate)
     frontend.pause()
 
 def main():
@@ -1,6 +1,10 @@
 import PyInstaller.__main__
+import json
+import sys
 from pathlib import Path
 
+from cupdater.main import embed_package_manifest
+
 HERE = Path(__file__).parent.absolute()
 path_to_main = str(HERE / "cli.py")
 
@@ -10,4 +14,16 @@ def install():
         "--onefile",
         "--name",
         "cupdater"
-    ])
\ No newline at end of file
+    ])
+
+def provision():
+    '''
+    Append the package configuration to a built executable: provision <executable> <configuration.json>
+    '''
+    if len(sys.argv) != 3:
+        sys.exit("usage: provision <executable> <configuration.json>")
+    executable, configuration = sys.argv[1:]
+    configuration = Path(configuration).read_text(encoding="utf-8").strip()
+    if "url" not in json.loads(configuration):
+        sys.exit("The configuration has no manifest url")
+    embed_package_manifest(executable, configuration)
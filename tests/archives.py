@@ -0,0 +1,38 @@
+import io
+import os
+import zipfile
+
+
+def make_archive(files, compression=zipfile.ZIP_DEFLATED):
+    '''
+    The bytes of a ZIP archive of files, a dict of member name to content.
+    '''
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression) as z:
+        for name, data in files.items():
+            z.writestr(name, data)
+    return buffer.getvalue()
+
+class _Unseekable:
+    def __init__(self) -> None:
+        self.data = bytearray()
+    def write(self, data):
+        self.data += data
+        return len(data)
+    def flush(self):
+        pass
+
+def make_streamed_archive(files, compression=zipfile.ZIP_DEFLATED, force_zip64=False):
+    '''
+    Like make_archive, but written without seeking, so the sizes and CRCs follow the data in data descriptors.
+    '''
+    output = _Unseekable()
+    with zipfile.ZipFile(output, "w", compression) as z: # type: ignore
+        for name, data in files.items():
+            with z.open(name, "w", force_zip64=force_zip64) as f:
+                f.write(data)
+    return bytes(output.data)
+
+def random_files(count, size=16 * 1024, prefix=""):
+    # half random, half repeated, so deflate has something to do
+    return {f"{prefix}dir{i % 3}/file{i}.bin": os.urandom(size // 2) + bytes([i % 256]) * (size - size // 2) for i in range(count)}
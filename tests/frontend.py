@@ -0,0 +1,39 @@
+from cupdater.frontend import Frontend
+from cupdater.frontend.frontend import ProgressReportInterface
+
+
+class FrontendError(Exception):
+    pass
+
+class QuietProgress(ProgressReportInterface):
+    def __enter__(self):
+        return self
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        pass
+    def update(self, count=1):
+        pass
+    def set(self, value):
+        pass
+    def status(self, status):
+        pass
+
+class QuietFrontend(Frontend):
+    '''
+    Frontend without output for tests. Questions and fatal errors raise FrontendError.
+    '''
+    def notify(self, notice):
+        pass
+    async def ask(self, question):
+        raise FrontendError("Asked for input: " + question)
+    def fatal(self, error):
+        raise FrontendError(error)
+    def progress(self, title, total=None, unit=None, leave=True):
+        return QuietProgress(title, total)
+    def render_progress(self, snapshot):
+        pass
+    def progress_status(self, status):
+        pass
+    def set_branding(self, branding):
+        pass
+    def pause(self):
+        pass
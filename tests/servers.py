@@ -0,0 +1,133 @@
+import asyncio
+import contextlib
+import os
+import socket
+import time
+
+from aiohttp import web
+
+from cupdater.byteranges import parse_ranges, range_response
+
+
+CHUNK_SIZE = 64 * 1024
+
+class StubServer:
+    '''
+    Serves one file over HTTP with ETag and range support for tests, optionally slowly or failing.
+    Records every request as (time, method, Range header).
+    '''
+    data: bytes
+    latency: float # seconds before the response starts
+    chunk_delay: float # seconds between chunks of the body
+    cut_after: int | None # bytes of the body sent before the connection is cut
+    overloaded: int | None # more concurrent requests than this are answered with overload_status
+    overload_status: int
+    ranges: bool # False ignores Range headers and always sends the whole file
+    max_parts: int | None # only the first this many of several requested ranges are sent
+    requests: list[tuple[float, str, str | None]]
+    in_flight: int
+    url: str
+
+    def __init__(self, data, latency=0.0, chunk_delay=0.0, cut_after=None, overloaded=None, overload_status=503, etag='"stub"',
+                 ranges=True, max_parts=None) -> None:
+        self.data = data
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.cut_after = cut_after
+        self.overloaded = overloaded
+        self.overload_status = overload_status
+        self.etag = etag
+        self.ranges = ranges
+        self.max_parts = max_parts
+        self.requests = []
+        self.in_flight = 0
+        self.url = ""
+
+    async def _handle(self, request):
+        self.requests.append((time.monotonic(), request.method, request.headers.get("Range")))
+        self.in_flight += 1
+        try:
+            if self.overloaded is not None and self.in_flight > self.overloaded:
+                return web.Response(status=self.overload_status)
+            await asyncio.sleep(self.latency)
+            headers = {"ETag": self.etag}
+            ranges = None
+            if self.ranges:
+                headers["Accept-Ranges"] = "bytes"
+                if "Range" in request.headers and request.headers.get("If-Range", self.etag) == self.etag:
+                    ranges = parse_ranges(request.headers["Range"], len(self.data))
+                    if ranges is None:
+                        return web.Response(status=416, headers={**headers, "Content-Range": f"bytes */{len(self.data)}"})
+                    ranges = ranges[:self.max_parts]
+            status, body_headers, parts, trailer = range_response(ranges, len(self.data), "application/zip")
+            headers.update(body_headers)
+            response = web.StreamResponse(status=status, headers=headers)
+            await response.prepare(request)
+            if request.method == "HEAD":
+                return response
+            body = b"".join(header + self.data[start:end + 1] for start, end, header in parts) + trailer
+            cut = self.cut_after is not None and len(body) > self.cut_after
+            if cut:
+                body = body[:self.cut_after]
+            for pos in range(0, len(body), CHUNK_SIZE):
+                if pos > 0:
+                    await asyncio.sleep(self.chunk_delay)
+                await response.write(body[pos:pos + CHUNK_SIZE])
+            if cut:
+                await asyncio.sleep(0.05)
+                request.transport.close()
+                return response
+            await response.write_eof()
+            return response
+        finally:
+            self.in_flight -= 1
+
+@contextlib.asynccontextmanager
+async def run_app(app):
+    '''
+    Run an aiohttp application on a free local port, yielding its base URL.
+    '''
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        yield f"http://127.0.0.1:{runner.addresses[0][1]}"
+    finally:
+        await runner.cleanup()
+
+@contextlib.asynccontextmanager
+async def serve(*servers):
+    '''
+    Run the StubServers, setting their url to that of the served file.
+    '''
+    async with contextlib.AsyncExitStack() as stack:
+        for server in servers:
+            app = web.Application()
+            app.router.add_route("*", "/archive.zip", server._handle)
+            server.url = await stack.enter_async_context(run_app(app)) + "/archive.zip"
+        yield servers
+
+@contextlib.asynccontextmanager
+async def serve_files(servers):
+    '''
+    Run the StubServers of a dict of file name to server under one base URL, setting their url to that of their file.
+    '''
+    app = web.Application()
+    for name, server in servers.items():
+        app.router.add_route("*", "/" + name, server._handle)
+    async with run_app(app) as base:
+        for name, server in servers.items():
+            server.url = f"{base}/{name}"
+        yield base
+
+def dead_url():
+    '''
+    URL of a local port nothing listens on.
+    '''
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return f"http://127.0.0.1:{port}/archive.zip"
+
+def random_data(size):
+    return os.urandom(size)
@@ -0,0 +1,98 @@
+import asyncio
+import time
+import urllib.parse
+
+import aiohttp
+
+from cupdater.cacheserver import CacheServer, is_allowed
+
+from .servers import StubServer, random_data, run_app, serve
+
+
+def _archive_url(cache, url):
+    return f"{cache}/archive?{urllib.parse.urlencode({'url': url})}"
+
+async def _get(session, url, headers=None):
+    async with session.get(url, headers=headers) as response:
+        return response.status, await response.read()
+
+def test_prefixes_are_matched_by_host_and_path():
+    prefixes = ["https://cdn.example.com/game/"]
+    assert is_allowed("https://cdn.example.com/game/base.zip", prefixes)
+    assert is_allowed("https://CDN.example.com/game/base.zip", prefixes)
+    assert not is_allowed("https://cdn.example.com/other/base.zip", prefixes)
+    assert not is_allowed("https://cdn.example.com/game/../other/base.zip", prefixes)
+    assert not is_allowed("https://cdn.example.com/game/%2e%2e/other/base.zip", prefixes)
+    assert not is_allowed("http://cdn.example.com/game/base.zip", prefixes)
+    assert not is_allowed("https://cdn.example.com.evil.net/game/base.zip", ["https://cdn.example.com"])
+    assert not is_allowed("https://cdn.example.com@evil.net/game/base.zip", ["https://cdn.example.com"])
+
+def test_refuses_urls_outside_the_prefixes(tmp_path):
+    async def run():
+        origin = StubServer(random_data(1024))
+        async with serve(origin), run_app(CacheServer(str(tmp_path), ["http://127.0.0.1:1/"]).application()) as cache, \
+                aiohttp.ClientSession() as session:
+            assert (await _get(session, _archive_url(cache, origin.url)))[0] == 403
+        assert origin.requests == []
+    asyncio.run(run())
+
+def test_clients_share_one_download(tmp_path):
+    data = random_data(1024 * 1024)
+    async def run():
+        origin = StubServer(data, chunk_delay=0.01)
+        async with serve(origin):
+            allowed = [origin.url.rpartition("/")[0] + "/"]
+            async with run_app(CacheServer(str(tmp_path), allowed).application()) as cache, aiohttp.ClientSession() as session:
+                url = _archive_url(cache, origin.url)
+                results = await asyncio.gather(*(_get(session, url) for _ in range(3)),
+                                               _get(session, url, {"Range": "bytes=-1000"}),
+                                               _get(session, url, {"Range": "bytes=0-9,2000-2999"}))
+                assert results[:3] == [(200, data)] * 3
+                assert results[3] == (206, data[-1000:])
+                status, body = results[4]
+                assert status == 206 and data[:10] in body and data[2000:3000] in body
+                # stored now, answered without asking the origin again
+                assert await _get(session, url, {"Range": "bytes=100-199"}) == (206, data[100:200])
+        assert [(method, r) for _, method, r in origin.requests] == [("GET", None)]
+    asyncio.run(run())
+
+def test_range_is_served_before_the_download_completes(tmp_path):
+    data = random_data(1024 * 1024)
+    async def run():
+        # the whole archive takes over 3 seconds to arrive
+        origin = StubServer(data, chunk_delay=0.2)
+        async with serve(origin):
+            allowed = [origin.url.rpartition("/")[0] + "/"]
+            async with run_app(CacheServer(str(tmp_path), allowed).application()) as cache, aiohttp.ClientSession() as session:
+                start = time.monotonic()
+                assert await _get(session, _archive_url(cache, origin.url), {"Range": "bytes=0-99"}) == (206, data[:100])
+                assert time.monotonic() - start < 1.5
+        assert [(method, r) for _, method, r in origin.requests] == [("GET", None)]
+    asyncio.run(run())
+
+def test_archives_larger_than_the_cache_pass_through(tmp_path):
+    data = random_data(256 * 1024)
+    async def run():
+        origin = StubServer(data)
+        async with serve(origin):
+            allowed = [origin.url.rpartition("/")[0] + "/"]
+            async with run_app(CacheServer(str(tmp_path), allowed, max_size=len(data) - 1).application()) as cache, \
+                    aiohttp.ClientSession() as session:
+                assert await _get(session, _archive_url(cache, origin.url)) == (200, data)
+    asyncio.run(run())
+    assert [name for name in (tmp_path).iterdir() if name.suffix == ".zip"] == []
+
+def test_clients_are_answered_when_storing_fails_early(tmp_path):
+    async def run():
+        origin = StubServer(random_data(1024))
+        async with serve(origin):
+            server = CacheServer(str(tmp_path), [origin.url.rpartition("/")[0] + "/"])
+            def remove(url):
+                raise PermissionError("Stored copy is locked")
+            server._remove = remove
+            async with run_app(server.application()) as cache, aiohttp.ClientSession() as session:
+                url = _archive_url(cache, origin.url)
+                results = await asyncio.wait_for(asyncio.gather(_get(session, url), _get(session, url)), 10)
+                assert [status for status, _ in results] == [502, 502]
+                assert server._fills == {}
+    asyncio.run(run())
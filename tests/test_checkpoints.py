@@ -0,0 +1,69 @@
+import asyncio
+import json
+import logging
+
+import pytest
+
+from cupdater.backend.backend import InstallerBackend
+from cupdater.backend.filedb import CLEAN_INSTALL_COMPLETE
+
+from .archives import make_archive, random_files
+from .frontend import FrontendError, QuietFrontend
+from .servers import StubServer, serve_files
+
+
+LAYERS = {"base": 3, "patch": 3}
+
+def _content():
+    return {f"{layer}-{i}.zip": random_files(8, 128 * 1024, prefix=f"{layer}{i}/") for layer, count in LAYERS.items() for i in range(count)}
+
+def _manifest(base):
+    return json.dumps({
+        "brand": {"name": "Test"},
+        "self": {platform: {"url": f"{base}/updater", "sha256": "0" * 64} for platform in ("linux", "windows")},
+        "branches": {"public": {"layers": list(LAYERS)}},
+        "version": 1,
+        "layers": {layer: {"updated": 1, "url": [f"{base}/{layer}-{i}.zip" for i in range(count)]} for layer, count in LAYERS.items()},
+    }).encode()
+
+async def _update(url):
+    backend = InstallerBackend(QuietFrontend())
+    try:
+        await backend.load_manifest_from_url(url)
+        backend.set_branch("public")
+        await backend.update(ignore_self_update=True)
+        return await asyncio.to_thread(backend._db.get_checkpoints), await asyncio.to_thread(backend._db.get_meta, CLEAN_INSTALL_COMPLETE)
+    finally:
+        await backend._close_session()
+        backend._db.close()
+
+def _installed(root):
+    return {str(p.relative_to(root)): p.read_bytes() for p in root.rglob("*.bin")}
+
+def test_interrupted_clean_install_resumes_from_checkpoints(tmp_path, monkeypatch, caplog):
+    monkeypatch.chdir(tmp_path)
+    content = _content()
+    servers = {name: StubServer(make_archive(files)) for name, files in content.items()}
+    # the central directory can be read, downloading the whole archive always fails
+    failing = servers["patch-2.zip"]
+    failing.cut_after, failing.chunk_delay = 72 * 1024, 0.02
+    manifest = servers["manifest.json"] = StubServer(b"")
+    async def run():
+        async with serve_files(servers) as base:
+            manifest.data = _manifest(base)
+            with pytest.raises(FrontendError):
+                await _update(manifest.url)
+            failing.cut_after = None
+            for server in servers.values():
+                server.requests.clear()
+            with caplog.at_level(logging.INFO):
+                return await _update(manifest.url)
+    checkpoints, clean_install_complete = asyncio.run(run())
+    assert _installed(tmp_path) == {path: data for files in content.values() for path, data in files.items()}
+    assert "Resuming interrupted installation, 5 of 6 archives are complete" in caplog.text
+    # archives finished before the interruption weren't downloaded again
+    for name, server in servers.items():
+        if name not in ("manifest.json", "patch-2.zip"):
+            assert [r for _, method, r in server.requests if method == "GET"] == [], name
+    assert [r for _, method, r in failing.requests if method == "GET"] != []
+    assert checkpoints == {} and clean_install_complete == "1"
@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+from cupdater.backend.filedb import FileDB
+
+
+def test_failed_write_is_raised_and_the_writer_keeps_going(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = FileDB()
+    try:
+        # too large for an SQLite integer, binding raises OverflowError instead of an sqlite3.Error
+        db.set_meta("a", 2 ** 64)
+        with pytest.raises(OverflowError):
+            db.get_meta("a")
+        db.set_meta("b", "1")
+        assert db.get_meta("b") == "1"
+        db.set_meta("c", 2 ** 64)
+        with pytest.raises(OverflowError):
+            asyncio.run(db.flush())
+    finally:
+        db.close()
+    db = FileDB()
+    try:
+        assert db.get_meta("a") is None and db.get_meta("b") == "1"
+    finally:
+        db.close()
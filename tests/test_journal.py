@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from cupdater.backend import backend as backend_module
+from cupdater.backend.backend import InstallerBackend
+
+from .archives import make_archive, random_files
+from .frontend import FrontendError, QuietFrontend
+from .servers import StubServer, random_data, serve
+
+
+def _range_start(request):
+    _, _, header = request
+    return 0 if header is None else int(header.removeprefix("bytes=").partition("-")[0])
+
+async def _in_new_backend(call):
+    '''
+    Run call(backend) in a backend of its own, as a separate run of the updater would.
+    '''
+    backend = InstallerBackend(QuietFrontend())
+    try:
+        return await call(backend)
+    finally:
+        await backend._close_session()
+        backend._db.close()
+
+async def _journal(backend):
+    return await asyncio.to_thread(backend._db.get_download, "archive.zip"), await asyncio.to_thread(backend._db.get_extracted, "archive.zip")
+
+def _extracted(root):
+    return {str(p.relative_to(root)): p.read_bytes() for p in root.rglob("*") if p.is_file() and p.suffix == ".bin"}
+
+@pytest.fixture
+def journaled(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(backend_module, "DOWNLOAD_JOURNAL_INTERVAL", 32 * 1024)
+    monkeypatch.setattr(backend_module, "IN_MEMORY_ARCHIVE_LIMIT", 0)
+    return tmp_path
+
+def test_streamed_extraction_continues_in_the_next_run(journaled):
+    files = random_files(24, 32 * 1024)
+    archive = make_archive(files)
+    # paced, so the extraction keeps up and journals members it completed
+    server = StubServer(archive, chunk_delay=0.05, cut_after=len(archive) // 2)
+    async def extract(backend):
+        return await backend._download_and_unzip_streaming(server.url, "archive.zip", retries=1, size=len(archive))
+    async def run():
+        async with serve(server):
+            with pytest.raises(FrontendError):
+                await _in_new_backend(extract)
+            (_, url, validator, offset, streamed), extracted = await _in_new_backend(_journal)
+            assert (url, validator, streamed) == (server.url, server.etag, 1)
+            assert 0 < offset < len(archive) // 2 and len(extracted) > 0
+            assert set(extracted) <= set(_extracted(journaled))
+            server.cut_after = None
+            server.requests.clear()
+            members = await _in_new_backend(extract)
+            assert sorted(m.filename for m in members) == sorted(files)
+            # only the part after the last journaled member was downloaded again
+            assert [_range_start(r) for r in server.requests] == [offset]
+            assert await _in_new_backend(_journal) == (None, {})
+    asyncio.run(run())
+    assert _extracted(journaled) == files
+
+def test_streamed_extraction_starts_over_when_the_archive_changed(journaled):
+    files = random_files(24, 32 * 1024)
+    archive = make_archive(files)
+    server = StubServer(archive, cut_after=len(archive) // 2)
+    async def extract(backend):
+        return await backend._download_and_unzip_streaming(server.url, "archive.zip", retries=1, size=len(archive))
+    async def run():
+        nonlocal files, archive
+        async with serve(server):
+            with pytest.raises(FrontendError):
+                await _in_new_backend(extract)
+            files = random_files(24, 32 * 1024)
+            archive = make_archive(files)
+            server.data, server.etag, server.cut_after = archive, '"changed"', None
+            members = await _in_new_backend(extract)
+            assert sorted(m.filename for m in members) == sorted(files)
+    asyncio.run(run())
+    assert _extracted(journaled) == files
+
+def test_download_continues_in_the_next_run(journaled):
+    data = random_data(512 * 1024)
+    server = StubServer(data, cut_after=len(data) // 2)
+    async def download(backend):
+        return await backend._download_file_with_retries(server.url, "archive.zip", retries=1, size=len(data))
+    async def run():
+        async with serve(server):
+            with pytest.raises(FrontendError):
+                await _in_new_backend(download)
+            (_, _, validator, written, streamed), _ = await _in_new_backend(_journal)
+            assert (validator, streamed) == (server.etag, 0)
+            assert 0 < written <= (journaled / "archive.zip").stat().st_size
+            server.cut_after = None
+            server.requests.clear()
+            await _in_new_backend(download)
+            assert [_range_start(r) for r in server.requests] == [written]
+    asyncio.run(run())
+    assert (journaled / "archive.zip").read_bytes() == data
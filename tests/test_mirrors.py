@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import aiohttp
+
+from cupdater.backend.backend import InstallerBackend
+from cupdater.backend.mirrors import Mirrors, PROBE_SIZE
+
+from .frontend import QuietFrontend
+from .servers import StubServer, dead_url, random_data, serve
+
+
+def test_probe_orders_mirrors_by_speed():
+    async def run():
+        fast, slow = StubServer(random_data(4 * PROBE_SIZE)), StubServer(random_data(4 * PROBE_SIZE), latency=0.3)
+        async with serve(fast, slow), aiohttp.ClientSession() as session:
+            dead = dead_url()
+            mirrors = Mirrors(session)
+            await mirrors.probe([dead, slow.url, fast.url])
+            assert mirrors.order([dead, slow.url, fast.url]) == [fast.url, slow.url, dead]
+            assert mirrors.host(dead).failures == 1
+            assert mirrors.host(fast.url).failures == 0
+            # hosts are only probed once per update
+            await mirrors.probe([fast.url])
+            assert len(fast.requests) == 1
+    asyncio.run(run())
+
+def test_download_fails_over_mid_transfer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = random_data(1024 * 1024)
+    async def run():
+        broken, working = StubServer(data, cut_after=len(data) // 2), StubServer(data)
+        async with serve(broken, working):
+            backend = InstallerBackend(QuietFrontend())
+            try:
+                backend._sources = {broken.url: [broken.url, working.url]}
+                await backend._download_file_with_retries(broken.url, "archive.zip", size=len(data))
+                assert backend._mirrors.host(broken.url).failures == 1
+            finally:
+                await backend._close_session()
+        # the second mirror continued where the first one stopped
+        ranges = [r for _, _, r in working.requests]
+        assert len(ranges) == 1 and ranges[0] is not None
+        assert int(ranges[0].removeprefix("bytes=").partition("-")[0]) > 0
+    asyncio.run(run())
+    assert (tmp_path / "archive.zip").read_bytes() == data
+
+def test_hedged_request_takes_first_answer():
+    data = random_data(PROBE_SIZE)
+    async def run():
+        slow, fast = StubServer(data, latency=2.0), StubServer(data)
+        cancelled = []
+        async with serve(slow, fast), aiohttp.ClientSession() as session:
+            async def fetch(url):
+                try:
+                    async with session.get(url) as response:
+                        return url, await response.read()
+                except asyncio.CancelledError:
+                    cancelled.append(url)
+                    raise
+            mirrors = Mirrors(session, hedge_delay=0.1)
+            start = time.monotonic()
+            url, body = await mirrors.hedged([slow.url, fast.url], fetch)
+            elapsed = time.monotonic() - start
+        assert url == fast.url and body == data
+        assert cancelled == [slow.url]
+        assert elapsed < 1.0
+        # a cancelled attempt isn't held against the mirror
+        assert mirrors.host(slow.url).failures == 0
+    asyncio.run(run())
+
+def test_hedged_request_moves_on_after_failure():
+    data = random_data(PROBE_SIZE)
+    async def run():
+        working = StubServer(data)
+        async with serve(working), aiohttp.ClientSession() as session:
+            async def fetch(url):
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    return await response.read()
+            dead = dead_url()
+            mirrors = Mirrors(session, hedge_delay=10.0)
+            start = time.monotonic()
+            assert await mirrors.hedged([dead, working.url], fetch) == data
+            # the failure started the next attempt without waiting for the hedge delay
+            assert time.monotonic() - start < 5.0
+            assert mirrors.host(dead).failures == 1
+            assert mirrors.order([dead, working.url]) == [working.url, dead]
+    asyncio.run(run())
@@ -0,0 +1,32 @@
+import json
+import sys
+
+from cupdater.main import PROVISIONING_EMBEDDED_HEADER, embed_package_manifest, get_embedded_package_manifest
+
+
+def _as_frozen(monkeypatch, executable):
+    monkeypatch.setattr(sys, "frozen", True, raising=False)
+    monkeypatch.setattr(sys, "_MEIPASS", str(executable.parent), raising=False)
+    monkeypatch.setattr(sys, "executable", str(executable))
+
+def test_embedded_configuration_is_read_from_the_trailer(tmp_path, monkeypatch):
+    executable = tmp_path / "cupdater"
+    # the executable itself may contain the header, as the frozen code does
+    executable.write_bytes(b"\x7fELF" + PROVISIONING_EMBEDDED_HEADER + b"code" * 1000)
+    configuration = json.dumps({"url": "https://example.com/manifest.json"})
+    embed_package_manifest(str(executable), configuration)
+    _as_frozen(monkeypatch, executable)
+    assert get_embedded_package_manifest() == configuration
+
+def test_configuration_without_trailer_is_found(tmp_path, monkeypatch):
+    executable = tmp_path / "cupdater"
+    configuration = json.dumps({"url": "https://example.com/manifest.json"})
+    executable.write_bytes(b"\x7fELF" + b"code" * 1000 + PROVISIONING_EMBEDDED_HEADER + configuration.encode())
+    _as_frozen(monkeypatch, executable)
+    assert get_embedded_package_manifest() == configuration
+
+def test_unprovisioned_executable_has_no_configuration(tmp_path, monkeypatch):
+    executable = tmp_path / "cupdater"
+    executable.write_bytes(b"\x7fELF" + b"code" * 1000)
+    _as_frozen(monkeypatch, executable)
+    assert get_embedded_package_manifest() is None
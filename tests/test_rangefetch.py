@@ -0,0 +1,77 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from cupdater.backend.rangefetch import RangedMemberFetcher, RangeNotSupported
+from cupdater.backend.zipdir import ZipMember, read_central_directory
+
+from .archives import make_archive, random_files
+from .servers import StubServer, serve
+
+
+def _member(offset):
+    return ZipMember(f"file{offset}", 0, 0, 0, offset, 0, 0)
+
+def test_plan_coalesces_members_within_the_gap():
+    members = [_member(offset) for offset in (0, 100, 200, 1000, 1100)]
+    wanted = [members[3], members[0], members[1]]
+    spans = RangedMemberFetcher(None, "", gap=50).plan(members, wanted, 1500)
+    assert [(s.start, s.end, s.members) for s in spans] == [(0, 199, members[:2]), (1000, 1099, [members[3]])]
+    # the last member ends before the central directory
+    spans = RangedMemberFetcher(None, "", gap=800).plan(members, wanted + [members[4]], 1500)
+    assert [(s.start, s.end, s.members) for s in spans] == [(0, 1499, members[:2] + members[3:])]
+
+def test_requests_are_grouped_up_to_the_concurrency():
+    spans = RangedMemberFetcher(None, "", gap=0).plan([_member(o) for o in range(0, 1000, 100)], [_member(o) for o in range(0, 1000, 200)], 1000)
+    assert [len(group) for group in RangedMemberFetcher(None, "", concurrency=2)._group(spans)] == [3, 2]
+    assert [len(group) for group in RangedMemberFetcher(None, "", multipart=False)._group(spans)] == [1] * 5
+
+def _fetch(tmp_path, monkeypatch, server, files, wanted, **options):
+    monkeypatch.chdir(tmp_path)
+    async def run():
+        async with serve(server), aiohttp.ClientSession() as session:
+            directory = await read_central_directory(session, server.url)
+            members = {m.filename: m for m in directory.members}
+            server.requests.clear()
+            fetcher = RangedMemberFetcher(session, server.url, gap=0, **options)
+            await fetcher.fetch(fetcher.plan(directory.members, [members[name] for name in wanted], directory.cd_offset))
+    asyncio.run(run())
+    assert {name: (tmp_path / name).read_bytes() for name in wanted} == {name: files[name] for name in wanted}
+    assert sorted(str(p.relative_to(tmp_path)) for p in tmp_path.rglob("*") if p.is_file()) == sorted(wanted)
+
+def test_members_are_fetched_in_one_multipart_request(tmp_path, monkeypatch):
+    files = random_files(9)
+    wanted = list(files)[::2]
+    server = StubServer(make_archive(files))
+    _fetch(tmp_path, monkeypatch, server, files, wanted, concurrency=1)
+    assert [r.count(",") for _, _, r in server.requests if r is not None] == [len(wanted) - 1]
+
+def test_missing_parts_of_multipart_response_are_fetched_again(tmp_path, monkeypatch):
+    files = random_files(9)
+    wanted = list(files)[::2]
+    server = StubServer(make_archive(files), max_parts=2)
+    _fetch(tmp_path, monkeypatch, server, files, wanted, concurrency=1)
+    # one request for all, then one for each of the ranges left out, without multipart from then on
+    assert len(server.requests) == 1 + len(wanted) - 2
+    assert all(r is not None and "," not in r for _, _, r in server.requests[1:])
+
+def test_server_ignoring_ranges(tmp_path, monkeypatch):
+    files = random_files(4)
+    archive = make_archive(files)
+    server = StubServer(archive)
+    async def read_directory():
+        async with serve(server), aiohttp.ClientSession() as session:
+            return await read_central_directory(session, server.url)
+    directory = asyncio.run(read_directory())
+    server = StubServer(archive, ranges=False)
+    async def run():
+        async with serve(server), aiohttp.ClientSession() as session:
+            fetcher = RangedMemberFetcher(session, server.url)
+            await fetcher.fetch(fetcher.plan(directory.members, directory.members[:1], directory.cd_offset))
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(RangeNotSupported):
+        asyncio.run(run())
+    # not retried, the caller downloads the whole archive instead
+    assert len(server.requests) == 1
+    assert list(tmp_path.iterdir()) == []
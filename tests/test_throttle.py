@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+
+from cupdater.backend.backend import InstallerBackend
+from cupdater.backend.throttle import ADJUST_INTERVAL, INITIAL_REQUESTS, Throttle
+
+from .frontend import QuietFrontend
+from .servers import StubServer, random_data, serve
+
+
+async def _load(session, throttle, url, duration, limits):
+    '''
+    Keep many more requests going than the throttle allows for duration seconds, recording its limit after every request.
+    '''
+    end = time.monotonic() + duration
+    async def worker():
+        while time.monotonic() < end:
+            try:
+                async with throttle.request():
+                    async with session.get(url) as response:
+                        response.raise_for_status()
+                        await throttle.received(len(await response.read()))
+            except aiohttp.ClientResponseError:
+                pass
+            limits.append(throttle.concurrency.limit) # type: ignore
+    await asyncio.gather(*(worker() for _ in range(32)))
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_concurrency_backs_off_and_recovers(status):
+    async def run():
+        server = StubServer(random_data(16 * 1024), latency=0.02, overloaded=4, overload_status=status)
+        throttle = Throttle(max_requests=32)
+        async with serve(server), aiohttp.ClientSession() as session:
+            overloaded = []
+            await _load(session, throttle, server.url, 8 * ADJUST_INTERVAL, overloaded)
+            server.overloaded = None
+            recovered = []
+            await _load(session, throttle, server.url, 8 * ADJUST_INTERVAL, recovered)
+        return overloaded, recovered
+    overloaded, recovered = asyncio.run(run())
+    # slow start went past what the server takes, the errors halved the limit again
+    assert max(overloaded) > INITIAL_REQUESTS
+    peak = overloaded.index(max(overloaded))
+    assert min(overloaded[peak:]) <= max(overloaded) // 2
+    # without errors it grows by one per interval after the errors of the last overloaded one
+    lowest = recovered.index(min(recovered))
+    assert recovered[-1] >= recovered[lowest] + 4
+
+def test_bandwidth_limit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rate, data = 1024 * 1024, random_data(3 * 1024 * 1024)
+    async def run():
+        server = StubServer(data)
+        async with serve(server):
+            # several segments share the limit
+            backend = InstallerBackend(QuietFrontend(), bandwidth_limit=rate, segment_size=512 * 1024, segment_connections=4)
+            try:
+                start = time.monotonic()
+                await backend._download_file_with_retries(server.url, "archive.zip", size=len(data))
+                return time.monotonic() - start
+            finally:
+                await backend._close_session()
+    elapsed = asyncio.run(run())
+    assert (tmp_path / "archive.zip").read_bytes() == data
+    # the initial burst lets the measured rate exceed the limit a little
+    assert rate * 0.8 < len(data) / elapsed < rate * 1.15
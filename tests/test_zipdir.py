@@ -0,0 +1,107 @@
+import asyncio
+import io
+import struct
+import zipfile
+
+import aiohttp
+import pytest
+
+from cupdater.backend.rangefetch import RangeNotSupported
+from cupdater.backend.zipdir import CENTRAL_DIR_HEADER, CENTRAL_DIR_HEADER_SIGNATURE, END_OF_CENTRAL_DIR, \
+    END_OF_CENTRAL_DIR_SIGNATURE, ZIP64_END_OF_CENTRAL_DIR, ZIP64_END_OF_CENTRAL_DIR_LOCATOR, \
+    ZIP64_END_OF_CENTRAL_DIR_LOCATOR_SIGNATURE, ZIP64_END_OF_CENTRAL_DIR_SIGNATURE, ZIP64_EXTRA_TAG, \
+    read_central_directory, read_local_central_directory
+
+from .archives import make_archive, random_files
+from .servers import StubServer, serve
+
+
+def _zip64(archive):
+    '''
+    Rewrite the central directory of archive the way Zip64 archives store it: sizes and offsets in Zip64 extra
+    fields, and the counts, size and offset of the directory in a Zip64 end record.
+    '''
+    infos = zipfile.ZipFile(io.BytesIO(archive)).infolist()
+    cd_offset = END_OF_CENTRAL_DIR.unpack_from(archive, len(archive) - END_OF_CENTRAL_DIR.size)[6]
+    cd = b""
+    for info in infos:
+        name = info.filename.encode()
+        extra = struct.pack("<HH3Q", ZIP64_EXTRA_TAG, 24, info.file_size, info.compress_size, info.header_offset)
+        cd += CENTRAL_DIR_HEADER.pack(CENTRAL_DIR_HEADER_SIGNATURE, 45, 3, 45, 0, info.flag_bits, info.compress_type, 0, 0x21,
+                                      info.CRC, 0xFFFFFFFF, 0xFFFFFFFF, len(name), len(extra), 0, 0, 0, 0, 0xFFFFFFFF) + name + extra
+    zip64_offset = cd_offset + len(cd)
+    return archive[:cd_offset] + cd \
+        + ZIP64_END_OF_CENTRAL_DIR.pack(ZIP64_END_OF_CENTRAL_DIR_SIGNATURE, ZIP64_END_OF_CENTRAL_DIR.size - 12, 45, 45, 0, 0,
+                                        len(infos), len(infos), len(cd), cd_offset) \
+        + ZIP64_END_OF_CENTRAL_DIR_LOCATOR.pack(ZIP64_END_OF_CENTRAL_DIR_LOCATOR_SIGNATURE, 0, zip64_offset, 1) \
+        + END_OF_CENTRAL_DIR.pack(END_OF_CENTRAL_DIR_SIGNATURE, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0)
+
+def _expected(archive):
+    return [(i.filename, i.CRC, i.compress_size, i.file_size, i.header_offset) for i in zipfile.ZipFile(io.BytesIO(archive)).infolist()]
+
+def _members(directory):
+    return [(m.filename, m.CRC, m.compress_size, m.file_size, m.header_offset) for m in directory.members]
+
+def _read_file(tmp_path, archive, tail_size):
+    path = tmp_path / "archive.zip"
+    path.write_bytes(archive)
+    return asyncio.run(read_local_central_directory(str(path), "https://example.com/archive.zip", tail_size))
+
+# the whole end of the file, only the end records, and only the end of central directory record and its locator
+@pytest.mark.parametrize("tail_size", [64 * 1024, ZIP64_END_OF_CENTRAL_DIR.size + ZIP64_END_OF_CENTRAL_DIR_LOCATOR.size + END_OF_CENTRAL_DIR.size,
+                                       ZIP64_END_OF_CENTRAL_DIR_LOCATOR.size + END_OF_CENTRAL_DIR.size])
+def test_zip64_central_directory(tmp_path, tail_size):
+    archive = _zip64(make_archive(random_files(5, 1024)))
+    assert zipfile.ZipFile(io.BytesIO(archive)).testzip() is None
+    directory = _read_file(tmp_path, archive, tail_size)
+    assert _members(directory) == _expected(archive)
+    assert directory.size == len(archive)
+
+def test_central_directory_of_prepended_archive(tmp_path):
+    archive = make_archive(random_files(5, 1024))
+    directory = _read_file(tmp_path, b"\x7fELF" * 256 + archive, 64 * 1024)
+    assert [(f, crc, c, s, offset - 1024) for f, crc, c, s, offset in _members(directory)] == _expected(archive)
+
+def test_central_directory_over_http_in_few_requests():
+    archive = _zip64(make_archive(random_files(50, 1024)))
+    async def run():
+        server = StubServer(archive)
+        async with serve(server), aiohttp.ClientSession() as session:
+            directory = await read_central_directory(session, server.url, tail_size=1024)
+        assert _members(directory) == _expected(archive)
+        assert directory.etag == server.etag
+        # the suffix request, then the rest of the directory
+        assert [r for _, _, r in server.requests] == ["bytes=-1024", f"bytes={directory.cd_offset}-{len(archive) - 1024 - 1}"]
+    asyncio.run(run())
+
+def test_central_directory_needs_ranges():
+    archive = make_archive(random_files(10, 1024))
+    async def run():
+        server = StubServer(archive, ranges=False)
+        async with serve(server), aiohttp.ClientSession() as session:
+            with pytest.raises(RangeNotSupported):
+                await read_central_directory(session, server.url, tail_size=1024)
+    asyncio.run(run())
+
+def test_garbage_is_not_an_archive(tmp_path):
+    with pytest.raises(ValueError, match="not a zip file"):
+        _read_file(tmp_path, bytes(range(256)) * 64, 64 * 1024)
+
+def test_truncated_end_record(tmp_path):
+    archive = make_archive(random_files(3, 1024))
+    with pytest.raises(ValueError, match="not a zip file"):
+        _read_file(tmp_path, archive[:-5], 64 * 1024)
+
+def test_end_record_pointing_outside_the_file(tmp_path):
+    archive = bytearray(make_archive(random_files(3, 1024)))
+    # directory size larger than the file
+    struct.pack_into("<L", archive, len(archive) - END_OF_CENTRAL_DIR.size + 12, len(archive) * 2)
+    with pytest.raises(ValueError, match="Bad offset"):
+        _read_file(tmp_path, bytes(archive), 64 * 1024)
+
+def test_end_record_pointing_at_garbage(tmp_path):
+    archive = bytearray(make_archive(random_files(3, 1024)))
+    cd_offset = END_OF_CENTRAL_DIR.unpack_from(archive, len(archive) - END_OF_CENTRAL_DIR.size)[6]
+    archive[cd_offset:cd_offset + 4] = b"JUNK"
+    with pytest.raises(ValueError, match="Bad magic number"):
+        _read_file(tmp_path, bytes(archive), 64 * 1024)
@@ -0,0 +1,75 @@
+import asyncio
+import zipfile
+
+import pytest
+
+from cupdater.backend.zipstream import StreamingNotSupported, StreamState, download_and_extract
+
+from .archives import make_archive, make_streamed_archive, random_files
+
+
+async def _chunks(data, size=4096):
+    for pos in range(0, len(data), size):
+        yield data[pos:pos + size]
+        await asyncio.sleep(0)
+
+async def _cut_chunks(data, state, members, size=4096):
+    # cut once the worker extracted some members, chunks it hasn't taken yet are dropped
+    for pos in range(0, len(data), size):
+        if len(state.completed) >= members:
+            raise ConnectionResetError("Connection cut")
+        yield data[pos:pos + size]
+        await asyncio.sleep(0.005)
+
+def _extracted(root):
+    return {str(p.relative_to(root)): p.read_bytes() for p in root.rglob("*") if p.is_file()}
+
+@pytest.mark.parametrize("archive", [
+    lambda files: make_archive(files),
+    lambda files: make_archive(files, zipfile.ZIP_STORED),
+    lambda files: make_streamed_archive(files),
+    lambda files: make_streamed_archive(files, force_zip64=True),
+], ids=["deflated", "stored", "data descriptors", "zip64 data descriptors"])
+def test_archive_is_extracted_while_streaming(tmp_path, monkeypatch, archive):
+    monkeypatch.chdir(tmp_path)
+    files = random_files(12)
+    members = asyncio.run(download_and_extract(_chunks(archive(files))))
+    assert _extracted(tmp_path) == files
+    assert sorted(m.filename for m in members) == sorted(files)
+
+def test_only_the_given_names_are_extracted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = random_files(6)
+    names = set(list(files)[1::2])
+    state = StreamState()
+    asyncio.run(download_and_extract(_chunks(make_archive(files)), state=state, names=names))
+    assert _extracted(tmp_path) == {name: files[name] for name in names}
+    # skipped members are still checked against the central directory
+    assert set(state.extracted) == set(files)
+
+def test_interrupted_stream_continues_at_the_first_incomplete_member(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = random_files(12)
+    archive = make_archive(files)
+    state = StreamState()
+    with pytest.raises(ConnectionResetError):
+        asyncio.run(download_and_extract(_cut_chunks(archive, state, 4), state=state))
+    done = dict(state.extracted)
+    assert 4 <= len(done) < len(files)
+    assert archive[state.offset:state.offset + 4] == b"PK\x03\x04"
+    asyncio.run(download_and_extract(_chunks(archive[state.offset:]), state=state))
+    assert _extracted(tmp_path) == files
+    assert state.completed[:len(done)] == list(done.items())
+
+def test_corrupted_member_is_detected(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = {"a.bin": b"a" * 1000, "b.bin": b"b" * 1000}
+    archive = bytearray(make_archive(files, zipfile.ZIP_STORED))
+    archive[archive.index(b"b" * 1000) + 500] ^= 0xFF
+    with pytest.raises(zipfile.BadZipFile, match="b.bin"):
+        asyncio.run(download_and_extract(_chunks(bytes(archive))))
+
+def test_stored_member_with_data_descriptor_needs_the_central_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(StreamingNotSupported):
+        asyncio.run(download_and_extract(_chunks(make_streamed_archive(random_files(2), zipfile.ZIP_STORED))))